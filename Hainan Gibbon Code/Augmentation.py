@@ -18,6 +18,10 @@ from shutil import copyfile
 
 import pickle
 
+from Spectrogram_Helper import melspectrogram_batch
+from Dtype_Policy import policy_dtype, enforce_dtype
+from Profiling import profiled, profiler
+
 
 def blend(audio_1, audio_2, w_1, w_2):
     augmented = w_1 * audio_1 + w_2 * audio_2
@@ -27,30 +31,46 @@ def blend(audio_1, audio_2, w_1, w_2):
 
 def time_shift(audio, time, sample_rate):
 
-    augmented = np.zeros(len(audio))
+    augmented = np.zeros(len(audio), dtype=audio.dtype)
     augmented [0:sample_rate*time] = audio[-sample_rate*time:]
     augmented [sample_rate*time:] = audio[:-sample_rate*time]
     return augmented
 
-def convert_to_image(audio):
+def time_shift_batch(audio, shifts):
+    '''
+    time_shift applied to every row of audio, each with its own shift in
+    samples, using a single gather.
+    '''
+    positions = (np.arange(audio.shape[1])[None,:] - np.asarray(shifts)[:,None]) % audio.shape[1]
+    return np.take_along_axis(audio, positions, axis=1)
+
+@profiled('spectrogram')
+def convert_to_image(audio, chunk_size=32):
+    '''
+    Convert segments of shape (N, samples) into mel-spectrograms of shape
+    (N, 128, frames, 1). The STFTs of chunk_size segments are computed
+    together and written straight into the output, of the policy dtype.
+    '''
     n_fft = 1024
     hop_length = 256
     n_mels = 128
     f_min = 1000
     f_max = 2000
     
-    X_img = []
+    audio = np.asarray(audio)
+    if audio.dtype == object:
+        audio = np.stack(list(audio))
 
-    for data in audio:
-        S = librosa.feature.melspectrogram(data, n_fft=n_fft, hop_length=hop_length, n_mels=n_mels, sr=4800, power=1.0, fmin = f_min, fmax=f_max)
-        X_img.append(S)
+    X_img = np.empty((audio.shape[0], n_mels, 1 + audio.shape[1] // hop_length, 1), dtype=policy_dtype())
 
-    X_img = np.asarray(X_img)
-    X_img = np.reshape(X_img, (X_img.shape[0],X_img.shape[1],X_img.shape[2],1))
+    melspectrogram_batch(audio, 4800, n_fft, hop_length, n_mels, f_min, f_max, 
+                         power=1.0, chunk_size=chunk_size, out=X_img[..., 0])
+    profiler.count('images', len(X_img))
     
     return X_img
 
 
+@profiled('augment')
 def augment_data(seed, augmentation_amount, augmentation_probability,
                  gibbon_calls, background_noise, sample_rate, alpha):
     
@@ -101,9 +121,10 @@ def augment_data(seed, augmentation_amount, augmentation_probability,
 
 
     # Convert to numpy array
-    return np.asarray(augmented_data)
+    return enforce_dtype(np.asarray(augmented_data), 'augment_data')
 
 
+@profiled('augment')
 def augment_background(seed, augmentation_amount, augmentation_probability,
                  background_noise, sample_rate, alpha):
     
@@ -146,5 +167,111 @@ def augment_background(seed, augmentation_amount, augmentation_probability,
 
 
     # Convert to numpy array
-    return np.asarray(augmented_data)
+    return enforce_dtype(np.asarray(augmented_data), 'augment_background')
+
+
+
+def time_shift_into(out, audio, shifts):
+    '''
+    Write time_shift(audio[i], shifts[i], ...) into out[i] for every row,
+    with shifts in samples. Rows with the same shift are copied together
+    with two slice assignments, so nothing is allocated per row.
+    '''
+    shifts = np.asarray(shifts)
+    for shift in np.unique(shifts):
+        rows = np.flatnonzero(shifts == shift)
+        if shift == 0:
+            out[rows] = audio[rows]
+            continue
+        out[rows, :shift] = audio[rows, -shift:]
+        out[rows, shift:] = audio[rows, :-shift]
+
+def draw_augmentations(seed, augmentation_amount, augmentation_probability,
+                       number_segments, number_background, alpha, equivalent):
+    '''
+    Draw every random decision of augment_data / augment_background up
+    front: the segment each augmented sample comes from, the background
+    segment it is blended with (when number_background is given) and the
+    time shift in seconds.
+
+    With equivalent=True the values are drawn from Python's random module
+    in exactly the order of the original loops, so the samples are the
+    same as those of augment_data / augment_background for the same seed.
+    Otherwise they are drawn as arrays from np.random.default_rng(seed),
+    with the same distribution.
+    '''
+    np.random.seed(seed)
+    random.seed(seed)
+
+    if equivalent:
+        sources, backgrounds, shifts = [], [], []
+        for index in range(0, number_segments):
+            for i in range (0, augmentation_amount):
+                if random.random() <= augmentation_probability:
+                    sources.append(index)
+                    if number_background is not None:
+                        backgrounds.append(random.randint(0, number_background-1))
+                    shifts.append(random.randint(1, alpha-1))
+        return (np.asarray(sources, dtype=np.int64), np.asarray(backgrounds, dtype=np.int64),
+                np.asarray(shifts, dtype=np.int64))
+
+    rng = np.random.default_rng(seed)
+    augment = rng.random((number_segments, augmentation_amount)) <= augmentation_probability
+    sources = np.repeat(np.arange(number_segments), augment.sum(axis=1))
+    backgrounds = np.zeros(0, dtype=np.int64)
+    if number_background is not None:
+        backgrounds = rng.integers(0, number_background, size=len(sources))
+    shifts = rng.integers(1, alpha, size=len(sources))
+    return sources, backgrounds, shifts
+
+@profiled('augment')
+def augment_data_vectorised(seed, augmentation_amount, augmentation_probability,
+                            gibbon_calls, background_noise, sample_rate, alpha, 
+                            equivalent=False, dtype=None):
+    '''
+    Vectorised augment_data. All random decisions are drawn first (see
+    draw_augmentations, equivalent=True reproduces augment_data exactly)
+    and the shifted background and blend are then written straight into
+    one preallocated array of dtype (default the policy dtype).
+    '''
+    if dtype is None:
+        dtype = policy_dtype()
+    gibbon_calls = np.asarray(gibbon_calls)
+    background_noise = np.asarray(background_noise)
+    sources, backgrounds, shifts = draw_augmentations(seed, augmentation_amount, 
+                                        augmentation_probability, len(gibbon_calls), 
+                                        len(background_noise), alpha, equivalent)
+
+    augmented_data = np.empty((len(sources), gibbon_calls.shape[-1]), dtype=dtype)
+    # Process in chunks to bound the temporary copies
+    for start in range(0, len(sources), 1024):
+        end = min(start + 1024, len(sources))
+        out = augmented_data[start:end]
+        time_shift_into(out, background_noise[backgrounds[start:end]], shifts[start:end] * sample_rate)
+        # Blend the two files, 0.9 gibbon and 0.1 background
+        out *= 0.1
+        out += 0.9 * gibbon_calls[sources[start:end]]
+
+    return augmented_data
+
+@profiled('augment')
+def augment_background_vectorised(seed, augmentation_amount, augmentation_probability,
+                                  background_noise, sample_rate, alpha,
+                                  equivalent=False, dtype=None):
+    '''
+    Vectorised augment_background, see augment_data_vectorised.
+    '''
+    if dtype is None:
+        dtype = policy_dtype()
+    background_noise = np.asarray(background_noise)
+    sources, _, shifts = draw_augmentations(seed, augmentation_amount, 
+                                    augmentation_probability, len(background_noise), 
+                                    None, alpha, equivalent)
+
+    augmented_data = np.empty((len(sources), background_noise.shape[-1]), dtype=dtype)
+    for start in range(0, len(sources), 1024):
+        end = min(start + 1024, len(sources))
+        time_shift_into(augmented_data[start:end], background_noise[sources[start:end]], 
+                        shifts[start:end] * sample_rate)
 
+    return augmented_data
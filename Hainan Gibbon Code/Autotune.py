@@ -0,0 +1,216 @@
+'''
+Autotuning of the batch size and TensorFlow thread pools for prediction.
+
+    python Autotune.py --weights weights_model5_2022.hdf5 --batch-sizes 32 64 128 256 512
+
+The model is benchmarked on synthetic (128, 188, 1) spectrograms at every
+batch size for every combination of intra-op and inter-op thread counts,
+and the windows per second of each configuration are reported. The best
+configuration is saved to autotune.json under the name of the host (and the
+backend), and PredictionHelper applies it when it is created on that host.
+
+TensorFlow's thread pools cannot be changed once it has started, so each
+thread setting is benchmarked in its own Python process. 0 threads means
+TensorFlow's default.
+'''
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from Inference_Backend import BACKENDS, backend_for_file
+
+AUTOTUNE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'autotune.json')
+
+
+def host_name():
+    ''' Key of this host in the autotune file. '''
+    return '{}-{}cpu'.format(platform.node(), os.cpu_count())
+
+def thread_counts(cpus=None):
+    '''
+    Default thread counts to try: TensorFlow's default (0), then powers of
+    two up to the number of CPUs, and the number of CPUs.
+    '''
+    cpus = cpus or os.cpu_count() or 1
+    counts = [0]
+    count = 1
+    while count < cpus:
+        counts.append(count)
+        count = count * 2
+    counts.append(cpus)
+    return counts
+
+def apply_threads(intra_op_threads, inter_op_threads):
+    '''
+    Set TensorFlow's thread pools. Has to be called before TensorFlow runs
+    anything; returns False (and leaves them as they are) if it is too late.
+    '''
+    import tensorflow as tf
+    try:
+        tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+        tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+    except RuntimeError:
+        print ('TensorFlow has already started, its thread pools are left as they are')
+        return False
+    return True
+
+def load_configuration(backend='keras', config_file=AUTOTUNE_FILE, host=None):
+    '''
+    The tuned configuration of this host for backend, or None if it has
+    not been tuned.
+    '''
+    if config_file is None or not os.path.exists(config_file):
+        return None
+    with open(config_file) as fp:
+        configurations = json.load(fp)
+    return configurations.get(host or host_name(), {}).get(backend)
+
+def save_configuration(configuration, backend='keras', config_file=AUTOTUNE_FILE, host=None):
+    ''' Save configuration as the tuned one of this host for backend, keeping other hosts'. '''
+    configurations = {}
+    if os.path.exists(config_file):
+        with open(config_file) as fp:
+            configurations = json.load(fp)
+    configurations.setdefault(host or host_name(), {})[backend] = configuration
+    with open(config_file, 'w') as fp:
+        json.dump(configurations, fp, indent=1)
+
+def load_benchmark_model(backend='keras', weights_name=None, backend_file=None, threads=None):
+    '''
+    The model to benchmark: the social group network, with weights_name
+    if given (the weights do not change the speed), or the exported model
+    in backend_file.
+    '''
+    if backend == 'keras':
+        from CNN_Network import network
+        model = network()
+        if weights_name is not None:
+            model.load_weights(weights_name)
+        return model
+
+    from Inference_Backend import load_exported_model
+    return load_exported_model(backend_file, threads or None)
+
+def benchmark_batch_sizes(model, batch_sizes, windows=512, repeats=3, input_shape=(128, 188, 1), seed=0):
+    '''
+    Windows per second of model.predict on windows synthetic spectrograms
+    at each batch size, the median of repeats runs after a warm up run.
+    '''
+    spectrograms = np.random.default_rng(seed).random((windows,) + tuple(input_shape), dtype=np.float32)
+    results = []
+    for batch_size in batch_sizes:
+        model.predict(spectrograms[:batch_size], batch_size=batch_size, verbose=0)
+        seconds = []
+        for repeat in range(repeats):
+            start = time.perf_counter()
+            model.predict(spectrograms, batch_size=batch_size, verbose=0)
+            seconds.append(time.perf_counter() - start)
+        results.append({'batch_size': batch_size,
+                        'seconds': float(np.median(seconds)),
+                        'windows_per_second': windows / float(np.median(seconds))})
+    return results
+
+def run_worker(arguments):
+    '''
+    Benchmark every batch size with one thread setting, in this process,
+    and print the results as JSON on the last line.
+    '''
+    if arguments.backend == 'keras':
+        apply_threads(arguments.intra_op_threads, arguments.inter_op_threads)
+    model = load_benchmark_model(arguments.backend, arguments.weights, arguments.backend_file,
+                                 arguments.intra_op_threads)
+    results = benchmark_batch_sizes(model, arguments.batch_sizes, arguments.windows, arguments.repeats)
+    print (json.dumps(results))
+
+def autotune(weights_name=None, batch_sizes=(32, 64, 128, 256, 512), intra_op_threads=None,
+             inter_op_threads=(0, 1, 2), windows=512, repeats=3, backend='keras', backend_file=None,
+             config_file=AUTOTUNE_FILE):
+    '''
+    Benchmark every batch size with every combination of intra-op and
+    inter-op thread counts (intra_op_threads defaults to thread_counts()),
+    one process per thread setting, and save the fastest configuration for
+    this host to config_file (unless it is None).
+
+    The ONNX and TFLite backends only have one thread count, tuned as
+    intra_op_threads.
+
+    Returns the best configuration and the results of every configuration.
+    '''
+    if backend not in BACKENDS:
+        raise ValueError('Unknown backend {}, expected one of {}'.format(backend, BACKENDS))
+    if backend != 'keras' and (backend_file is None or backend_for_file(backend_file) != backend):
+        raise ValueError('The {} backend needs backend_file, a .{} model'.format(backend, backend))
+    if intra_op_threads is None:
+        intra_op_threads = thread_counts()
+    if backend != 'keras':
+        inter_op_threads = (0,)
+
+    results = []
+    for intra in intra_op_threads:
+        for inter in inter_op_threads:
+            command = [sys.executable, os.path.abspath(__file__), '--worker',
+                       '--backend', backend,
+                       '--batch-sizes'] + [str(batch_size) for batch_size in batch_sizes] + [
+                       '--intra-op-threads', str(intra), '--inter-op-threads', str(inter),
+                       '--windows', str(windows), '--repeats', str(repeats)]
+            if weights_name is not None:
+                command += ['--weights', weights_name]
+            if backend_file is not None:
+                command += ['--backend-file', backend_file]
+
+            output = subprocess.run(command, stdout=subprocess.PIPE, check=True,
+                                    cwd=os.path.dirname(os.path.abspath(__file__)))
+            for result in json.loads(output.stdout.decode().strip().splitlines()[-1]):
+                result.update({'intra_op_threads': intra, 'inter_op_threads': inter})
+                results.append(result)
+                print ('intra-op {:>3} inter-op {:>3} batch {:>5}: {:9.1f} windows/s'.format(
+                       intra, inter, result['batch_size'], result['windows_per_second']))
+
+    best = max(results, key=lambda result: result['windows_per_second'])
+    configuration = {'batch_size': best['batch_size'],
+                     'intra_op_threads': best['intra_op_threads'],
+                     'inter_op_threads': best['inter_op_threads'],
+                     'windows_per_second': best['windows_per_second'],
+                     'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    print ('Best configuration:', configuration)
+
+    if config_file is not None:
+        save_configuration(configuration, backend, config_file)
+        print ('Saved to:', config_file)
+
+    return configuration, results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Tune the batch size and thread pools for prediction.')
+    parser.add_argument('--weights', default=None,
+                        help='weights of the social group network (the speed does not depend on them)')
+    parser.add_argument('--backend', default='keras', choices=BACKENDS)
+    parser.add_argument('--backend-file', default=None,
+                        help='the exported .onnx or .tflite model, for those backends')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[32, 64, 128, 256, 512])
+    parser.add_argument('--intra-op-threads', type=int, nargs='+', default=None,
+                        help='intra-op thread counts to try, 0 for the default (default: 0, powers of two, CPUs)')
+    parser.add_argument('--inter-op-threads', type=int, nargs='+', default=[0, 1, 2],
+                        help='inter-op thread counts to try, 0 for the default')
+    parser.add_argument('--windows', type=int, default=512,
+                        help='synthetic spectrograms predicted per run')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--output', default=AUTOTUNE_FILE)
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    arguments = parser.parse_args()
+
+    if arguments.worker:
+        arguments.intra_op_threads = arguments.intra_op_threads[0]
+        arguments.inter_op_threads = arguments.inter_op_threads[0]
+        run_worker(arguments)
+    else:
+        autotune(arguments.weights, arguments.batch_sizes, arguments.intra_op_threads,
+                 arguments.inter_op_threads, arguments.windows, arguments.repeats,
+                 arguments.backend, arguments.backend_file, arguments.output)
@@ -0,0 +1,187 @@
+import os
+
+import numpy as np
+
+from Extract_Audio_Helper import read_and_process_gibbon_timestamps
+
+# Statistics BandPrefilter can score windows with
+STATISTICS = ('band_power', 'spectral_flux')
+
+
+class BandPrefilter:
+    '''
+    Cheap test of whether a window can hold a gibbon call, run before the
+    spectrogram and the CNN.
+
+    The downsampled audio is cut into short non-overlapping frames
+    (frames_per_hop per hop), and the energy of each frame between f_min
+    and f_max Hz (band_power) or its increase on the previous frame
+    (spectral_flux) is computed, all in one vectorised pass. A window's
+    score is the mean over its frames, in dB above the noise floor of the
+    recording, so the threshold does not depend on the recorder's gain. The
+    noise floor is a low percentile (floor_percentile) of the statistic of
+    the short frames, not of the windows: in a recording where calls fill
+    most windows the gaps between calls still give enough frames of
+    background.
+
+    The band is not taken from the helper's f_min and f_max, which are the
+    range of the mel spectrogram: the caller passes the band of the calls
+    (e.g. 1000 to 2000 Hz), which has to be below the Nyquist frequency of
+    the downsampled audio.
+
+    Windows scoring below threshold dB are not converted to spectrograms or
+    given to the model; they get skipped_score, a certain 'no-gibbon', as
+    their prediction.
+
+    If label_directory holds g_<file>.data call labels for a recording,
+    record() also counts the windows overlapping a labelled call which were
+    skipped, from which report() gives the recall lost to the prefilter.
+    '''
+
+    def __init__(self, f_min, f_max, threshold=1.0, statistic='band_power',
+                 frames_per_hop=10, floor_percentile=10, skipped_score=(1.0, 0.0, 0.0, 0.0),
+                 label_directory='Call_Labels_Testing/', min_overlap=1):
+        if statistic not in STATISTICS:
+            raise ValueError('Unknown statistic {}, expected one of {}'.format(statistic, STATISTICS))
+        self.threshold = threshold
+        self.f_min = f_min
+        self.f_max = f_max
+        self.statistic = statistic
+        self.frames_per_hop = frames_per_hop
+        self.floor_percentile = floor_percentile
+        self.skipped_score = np.array(skipped_score, dtype=np.float32)
+        self.label_directory = label_directory
+        self.min_overlap = min_overlap
+        self.reset()
+
+    def reset(self):
+        self.windows = 0
+        self.skipped = 0
+        self.call_windows = 0
+        self.skipped_call_windows = 0
+        self.files = {}
+
+    def frame_statistic(self, audio, frame_length, sample_rate):
+        '''
+        Band power or spectral flux of every frame of frame_length samples.
+        '''
+        number_frames = len(audio) // frame_length
+        frames = np.reshape(audio[:number_frames * frame_length], (number_frames, frame_length))
+        window = np.hanning(frame_length).astype(audio.dtype)
+        frequencies = np.fft.rfftfreq(frame_length, 1 / sample_rate)
+        band = (frequencies >= self.f_min) & (frequencies <= self.f_max)
+        if not band.any():
+            raise ValueError('The band {} to {} Hz has no frequency bins at a sample rate of {} Hz'.format(
+                             self.f_min, self.f_max, sample_rate))
+
+        values = np.empty(number_frames, dtype=np.float64)
+        previous = None
+        # A chunk of frames at a time keeps the spectra small
+        for start in range(0, number_frames, 8192):
+            magnitudes = np.abs(np.fft.rfft(frames[start:start + 8192] * window, axis=1)[:, band])
+            if self.statistic == 'band_power':
+                values[start:start + 8192] = (magnitudes ** 2).sum(axis=1) / frame_length
+            else:
+                if previous is None:
+                    previous = magnitudes[:1]
+                increases = np.diff(np.concatenate([previous, magnitudes]), axis=0)
+                values[start:start + 8192] = np.maximum(increases, 0).sum(axis=1)
+                previous = magnitudes[-1:]
+        return values
+
+    def window_scores(self, audio, sample_rate, segment_duration, hop_seconds, number_windows):
+        '''
+        Score of each of the first number_windows windows of segment_duration
+        seconds, hop_seconds apart, of audio: the mean frame statistic over
+        the window in dB above the noise floor (the floor_percentile
+        percentile of the frame statistic).
+        '''
+        hop_samples = int(hop_seconds * sample_rate)
+        if hop_samples % self.frames_per_hop:
+            raise ValueError('A hop of {} samples cannot be split into {} frames'.format(
+                             hop_samples, self.frames_per_hop))
+        frame_length = hop_samples // self.frames_per_hop
+        window_frames = int(segment_duration * sample_rate) // frame_length
+        if number_windows == 0:
+            return np.zeros(0)
+
+        values = self.frame_statistic(np.asarray(audio), frame_length, sample_rate)
+        totals = np.concatenate([[0], np.cumsum(values)])
+        starts = np.arange(number_windows) * self.frames_per_hop
+        ends = np.minimum(starts + window_frames, len(values))
+        means = (totals[ends] - totals[starts]) / np.maximum(ends - starts, 1)
+
+        eps = 1e-12
+        noise_floor = np.percentile(values, self.floor_percentile)
+        return 10 * np.log10((means + eps) / (noise_floor + eps))
+
+    def keep(self, scores):
+        ''' Which windows go on to the spectrogram and the CNN. '''
+        return scores >= self.threshold
+
+    def call_windows_of(self, file_name_no_extension, number_windows, segment_duration, hop_seconds):
+        '''
+        Which windows overlap a labelled call by at least min_overlap
+        seconds (or the whole call, if shorter), or None if the recording
+        has no labels.
+        '''
+        if self.label_directory is None:
+            return None
+        label_file = 'g_' + os.path.basename(file_name_no_extension) + '.data'
+        if not os.path.exists(os.path.join(self.label_directory, label_file)):
+            return None
+
+        calls = read_and_process_gibbon_timestamps(self.label_directory, label_file, 1, sep=',')
+        starts = np.arange(number_windows) * hop_seconds
+        ends = starts + segment_duration
+        overlapping = np.zeros(number_windows, dtype=bool)
+        for call_start, call_end in zip(calls['Start'], calls['End']):
+            overlap = np.minimum(ends, call_end) - np.maximum(starts, call_start)
+            overlapping |= overlap >= min(self.min_overlap, call_end - call_start)
+        return overlapping
+
+    def record(self, file_name_no_extension, scores, keep, segment_duration, hop_seconds):
+        '''
+        Add the windows of a recording to the skip rate and, if it has
+        labels, to the recall loss. Returns its own counts.
+        '''
+        calls = self.call_windows_of(file_name_no_extension, len(scores), segment_duration, hop_seconds)
+        counts = {'windows': len(scores), 'skipped': int((~keep).sum())}
+        if calls is not None:
+            counts['call_windows'] = int(calls.sum())
+            counts['skipped_call_windows'] = int((calls & ~keep).sum())
+            self.call_windows = self.call_windows + counts['call_windows']
+            self.skipped_call_windows = self.skipped_call_windows + counts['skipped_call_windows']
+        self.windows = self.windows + counts['windows']
+        self.skipped = self.skipped + counts['skipped']
+        self.files[file_name_no_extension] = counts
+        return counts
+
+    def report(self):
+        '''
+        Skip rate over every recording, and recall loss: the fraction of
+        the windows overlapping a labelled call which were skipped (None if
+        no recording had labels).
+        '''
+        return {'threshold': self.threshold,
+                'statistic': self.statistic,
+                'windows': self.windows,
+                'skipped': self.skipped,
+                'skip_rate': self.skipped / self.windows if self.windows > 0 else 0.0,
+                'call_windows': self.call_windows,
+                'skipped_call_windows': self.skipped_call_windows,
+                'recall_loss': self.skipped_call_windows / self.call_windows if self.call_windows > 0 else None}
+
+    def sweep(self, scores, calls, thresholds):
+        '''
+        Skip rate and recall loss at each threshold, from the window scores
+        and call windows (boolean) of labelled recordings, concatenated.
+        Used to tune the threshold without running the CNN.
+        '''
+        rows = []
+        for threshold in thresholds:
+            skipped = scores < threshold
+            rows.append({'threshold': threshold,
+                         'skip_rate': float(skipped.mean()) if len(scores) > 0 else 0.0,
+                         'recall_loss': float((skipped & calls).sum() / calls.sum()) if calls.sum() > 0 else None})
+        return rows
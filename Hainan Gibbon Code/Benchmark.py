@@ -0,0 +1,274 @@
+'''
+Benchmarks of every stage of the training and prediction pipelines on
+synthetic recordings, reporting time, throughput, real-time factor and peak
+memory. Results are saved as JSON so runs can be compared across commits.
+
+    python Benchmark.py --durations 3600 10800 --segments 50 --batch-sizes 32 256
+
+The real-time factor is processing time divided by the duration of the audio
+processed: below 1 is faster than real time.
+'''
+import argparse
+import gc
+import json
+import os
+import platform
+import subprocess
+import time
+
+import numpy as np
+import soundfile as sf
+import librosa
+
+from Extract_Audio_Helper import *
+from Augmentation import (augment_data, augment_background, augment_data_vectorised,
+                          augment_background_vectorised, convert_to_image)
+from Dtype_Policy import policy_dtype
+from Memory_Governor import current_rss, reset_peak_rss, peak_rss
+
+
+def write_synthetic_recording(directory, name, duration, number_segments, sample_rate=16000, seed=0):
+    '''
+    Write a synthetic recording <name>.wav of duration seconds, and matching
+    g_<name>.data and n_<name>.data label files, into directory.
+
+    The recording is background noise with number_segments gibbon-like
+    calls (1-2 kHz frequency sweeps of 5 to 8 seconds). number_segments
+    stretches of 20 to 60 seconds without calls are labelled as background.
+    It is written one minute at a time, so any duration fits in memory.
+    '''
+    rng = np.random.default_rng(seed)
+    os.makedirs(directory, exist_ok=True)
+
+    # Non-overlapping slots of 90 seconds, each holding a call or a background stretch
+    number_slots = int(duration // 90) - 1
+    if number_slots < 2 * number_segments:
+        raise ValueError('{} seconds is too short for {} calls and {} background stretches'.format(
+                         duration, number_segments, number_segments))
+    slots = rng.permutation(np.arange(1, number_slots + 1))[:2 * number_segments] * 90
+    call_starts = np.sort(slots[:number_segments]) + rng.integers(10, 60, number_segments)
+    call_ends = call_starts + rng.integers(5, 9, number_segments)
+    noise_starts = np.sort(slots[number_segments:])
+    noise_ends = noise_starts + rng.integers(20, 61, number_segments)
+
+    with open(os.path.join(directory, 'g_' + name + '.data'), 'w') as fp:
+        fp.write('Start,End,Duration,Type,Notes\n')
+        for start, end in zip(call_starts, call_ends):
+            fp.write('{},{},{},2,1 calls\n'.format(start, end, end - start))
+    with open(os.path.join(directory, 'n_' + name + '.data'), 'w') as fp:
+        fp.write('Start,End,Duration,Type\n')
+        for start, end in zip(noise_starts, noise_ends):
+            fp.write('{},{},{},1\n'.format(start, end, end - start))
+
+    with sf.SoundFile(os.path.join(directory, name + '.wav'), 'w', sample_rate, 1, 'PCM_16') as audio_file:
+        for block_start in range(0, int(duration), 60):
+            block_length = min(60, int(duration) - block_start) * sample_rate
+            time_points = block_start + np.arange(block_length) / sample_rate
+            block = 0.05 * rng.standard_normal(block_length)
+            for start, end in zip(call_starts, call_ends):
+                inside = (time_points >= start) & (time_points < end)
+                if inside.any():
+                    t = time_points[inside] - start
+                    sweep = 1000 + 1000 * t / (end - start)
+                    block[inside] += 0.3 * np.sin(2 * np.pi * np.cumsum(sweep) / sample_rate)
+            audio_file.write(block.astype(np.float32))
+
+    return os.path.join(directory, name + '.wav')
+
+def measure(results, pipeline, stage, function, audio_seconds, items, **parameters):
+    '''
+    Run function once, append its timing and memory to results and return
+    its result. items is the number of items processed, or a function of
+    the result giving it.
+    '''
+    gc.collect()
+    reset_peak_rss()
+    start_rss = current_rss()
+    start = time.perf_counter()
+    result = function()
+    seconds = time.perf_counter() - start
+    if callable(items):
+        items = items(result)
+
+    row = {'pipeline': pipeline,
+           'stage': stage,
+           'seconds': seconds,
+           'items': int(items),
+           'throughput': items / seconds if seconds > 0 else None,
+           'audio_seconds': float(audio_seconds),
+           'real_time_factor': seconds / audio_seconds if audio_seconds > 0 else None,
+           'peak_rss_mb': peak_rss() / 1024**2,
+           'rss_increase_mb': (peak_rss() - start_rss) / 1024**2}
+    row.update(parameters)
+    results.append(row)
+    print ('{:>10} {:>30} {:9.3f}s  {:10.1f} items/s  RTF {:8.5f}  peak {:8.1f} MB'.format(
+           pipeline, stage, seconds, row['throughput'] or 0, row['real_time_factor'] or 0,
+           row['peak_rss_mb']))
+    return result
+
+def benchmark_training(results, file_name, label_directory, duration, sample_rate=4800,
+                       number_seconds_to_extract=10, augmentation_amount=2, seed=42):
+    '''
+    Time the stages of execute_audio_extraction and execute_augmentation
+    on one recording.
+    '''
+    name = os.path.basename(file_name)[:-4]
+    parameters = {'duration': duration}
+    segment = lambda result: len(result)
+
+    audio, _ = measure(results, 'training', 'librosa.load',
+                       lambda: librosa.load(file_name, sr=sample_rate, dtype=policy_dtype()),
+                       duration, 1, **parameters)
+    gibbon_timestamps = read_and_process_gibbon_timestamps(label_directory, 'g_' + name + '.data',
+                                                            sample_rate, sep=',')
+    non_gibbon_timestamps = read_and_process_nongibbon_timestamps(label_directory, 'n_' + name + '.data',
+                                                                  sample_rate, sep=',')
+
+    gibbon = measure(results, 'training', 'extract_all_gibbon_calls',
+                     lambda: extract_all_gibbon_calls(audio, gibbon_timestamps, number_seconds_to_extract,
+                                                      1, sample_rate, 0),
+                     duration, segment, **parameters)
+    noise = measure(results, 'training', 'extract_all_nongibbon_calls',
+                    lambda: extract_all_nongibbon_calls(audio, non_gibbon_timestamps, number_seconds_to_extract,
+                                                        5, sample_rate, 0),
+                    duration, segment, **parameters)
+    del audio
+
+    segment_seconds = lambda count: count * number_seconds_to_extract
+    noise_augmented = measure(results, 'training', 'augment_background',
+                              lambda: augment_background(seed, augmentation_amount, 1.0, noise,
+                                                         sample_rate, number_seconds_to_extract),
+                              segment_seconds(len(noise) * augmentation_amount), segment, **parameters)
+    measure(results, 'training', 'augment_background_vectorised',
+            lambda: augment_background_vectorised(seed, augmentation_amount, 1.0, noise,
+                                                  sample_rate, number_seconds_to_extract),
+            segment_seconds(len(noise) * augmentation_amount), segment, **parameters)
+    gibbon_augmented = measure(results, 'training', 'augment_data',
+                               lambda: augment_data(seed, augmentation_amount, 1.0, gibbon, noise_augmented,
+                                                    sample_rate, number_seconds_to_extract),
+                               segment_seconds(len(gibbon) * augmentation_amount), segment, **parameters)
+    measure(results, 'training', 'augment_data_vectorised',
+            lambda: augment_data_vectorised(seed, augmentation_amount, 1.0, gibbon, noise_augmented,
+                                            sample_rate, number_seconds_to_extract),
+            segment_seconds(len(gibbon) * augmentation_amount), segment, **parameters)
+    measure(results, 'training', 'convert_to_image',
+            lambda: convert_to_image(gibbon_augmented),
+            segment_seconds(len(gibbon_augmented)), segment, **parameters)
+
+def benchmark_prediction(results, file_name, duration, batch_sizes, model=None,
+                         segment_duration=10):
+    '''
+    Time the stages of PredictionHelper.predict_all_test_files on one
+    recording, and model.predict at each batch size.
+    '''
+    from PredictionHelper import PredictionHelper
+
+    helper = PredictionHelper('', 2000, 4800, 2400, segment_duration, 1024, 256, 128, 1000, 2000, '')
+    name = os.path.basename(file_name)[:-4]
+    parameters = {'duration': duration}
+    windows = lambda result: len(result)
+
+    filtered, sample_rate = measure(results, 'prediction', 'read_and_downsample',
+                                    lambda: helper.read_and_downsample(file_name),
+                                    duration, 1, **parameters)
+    end_index = int(len(filtered) / sample_rate)
+
+    segments = measure(results, 'prediction', 'create_X_new',
+                       lambda: helper.create_X_new(filtered, segment_duration, sample_rate, 0, end_index,
+                                                   name, False),
+                       duration, windows, **parameters)
+    window_seconds = len(segments) * segment_duration
+    measure(results, 'prediction', 'convert_all_to_image',
+            lambda: helper.convert_all_to_image(segments), window_seconds, windows, **parameters)
+    del segments
+
+    spectrograms = measure(results, 'prediction', 'convert_recording_to_image',
+                           lambda: helper.convert_recording_to_image(filtered, segment_duration,
+                                                                     sample_rate, 0, end_index),
+                           duration, windows, **parameters)
+    del filtered
+
+    if model is None:
+        return
+    spectrograms = helper.add_keras_dim(spectrograms)
+    for batch_size in batch_sizes:
+        measure(results, 'prediction', 'model.predict',
+                lambda: model.predict(spectrograms, batch_size=batch_size, verbose=0),
+                window_seconds, windows, batch_size=batch_size, **parameters)
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(durations=(3600,), number_segments=50, batch_sizes=(32, 256),
+                   directory='Benchmark_Data/', output_file=None, pipelines=('training', 'prediction'),
+                   original_sample_rate=16000, seed=0):
+    '''
+    Generate a synthetic recording of each duration (seconds) with
+    number_segments labelled calls and background stretches, unless it
+    already exists, and benchmark the selected pipelines on it.
+
+    Returns the report, and saves it as JSON to output_file if given.
+    '''
+    model = None
+    if 'prediction' in pipelines:
+        from CNN_Network import network
+        model = network()
+
+    results = []
+    for duration in durations:
+        name = 'synthetic_{}s_{}calls'.format(int(duration), number_segments)
+        file_name = os.path.join(directory, name + '.wav')
+        if not os.path.exists(file_name):
+            print ('Writing', file_name)
+            write_synthetic_recording(directory, name, duration, number_segments,
+                                      original_sample_rate, seed)
+
+        if 'training' in pipelines:
+            benchmark_training(results, file_name, directory, duration)
+        if 'prediction' in pipelines:
+            benchmark_prediction(results, file_name, duration, batch_sizes, model)
+
+    report = {'commit': git_commit(),
+              'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'machine': {'platform': platform.platform(),
+                          'processor': platform.processor(),
+                          'cpus': os.cpu_count(),
+                          'python': platform.python_version(),
+                          'numpy': np.__version__,
+                          'librosa': librosa.__version__},
+              'parameters': {'durations': list(durations),
+                             'number_segments': number_segments,
+                             'batch_sizes': list(batch_sizes),
+                             'original_sample_rate': original_sample_rate,
+                             'dtype': policy_dtype().name},
+              'results': results}
+
+    if output_file is not None:
+        with open(output_file, 'w') as fp:
+            json.dump(report, fp, indent=1)
+        print ('Benchmark saved to:', output_file)
+
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the training and prediction pipelines.')
+    parser.add_argument('--durations', type=float, nargs='+', default=[3600],
+                        help='lengths of the synthetic recordings in seconds')
+    parser.add_argument('--segments', type=int, default=50,
+                        help='number of labelled calls and background stretches per recording')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[32, 256],
+                        help='batch sizes for model.predict')
+    parser.add_argument('--pipelines', nargs='+', default=['training', 'prediction'],
+                        choices=['training', 'prediction'])
+    parser.add_argument('--directory', default='Benchmark_Data/',
+                        help='where the synthetic recordings are written')
+    parser.add_argument('--output', default='benchmark.json')
+    arguments = parser.parse_args()
+
+    run_benchmarks(arguments.durations, arguments.segments, arguments.batch_sizes,
+                   arguments.directory, arguments.output, arguments.pipelines)
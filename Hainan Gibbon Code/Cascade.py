@@ -0,0 +1,105 @@
+import time
+
+import numpy as np
+
+# Classes of the social group network, the columns of its predictions
+GROUP_NAMES = ('no-gibbon', 'B', 'C', 'D')
+
+
+class CascadeModel:
+    '''
+    The binary gibbon detector (CNN_Network_Binary) and the social group
+    classifier (CNN_Network) run as a cascade, with the predict method of a
+    Keras model so it can be used wherever the social group model is.
+
+    For a batch of spectrograms the detector scores every window. Only
+    windows whose gibbon probability (column 1 of the detector) reaches
+    threshold go to the social group classifier, taken from the same
+    batch of spectrograms. The others are given skipped_score, a certain
+    'no-gibbon'.
+
+    stats() gives the number of windows which reached the second stage and
+    the time and throughput of both stages.
+    '''
+
+    def __init__(self, binary_model, group_model, threshold=0.5,
+                 skipped_score=(1.0, 0.0, 0.0, 0.0)):
+        self.binary_model = binary_model
+        self.group_model = group_model
+        self.threshold = threshold
+        self.skipped_score = np.array(skipped_score, dtype=np.float32)
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.windows = 0
+        self.stage_two_windows = 0
+        self.binary_seconds = 0.0
+        self.group_seconds = 0.0
+
+    def predict(self, spectrograms, batch_size=None, verbose=None):
+        spectrograms = np.asarray(spectrograms)
+        start = time.perf_counter()
+        detections = self.binary_model.predict(spectrograms, batch_size=batch_size, verbose=0)
+        flagged = np.flatnonzero(detections[:, 1] >= self.threshold)
+        self.binary_seconds = self.binary_seconds + time.perf_counter() - start
+
+        predictions = np.tile(self.skipped_score, (len(spectrograms), 1))
+        if len(flagged) > 0:
+            start = time.perf_counter()
+            predictions[flagged] = self.group_model.predict(spectrograms[flagged],
+                                                            batch_size=batch_size, verbose=0)
+            self.group_seconds = self.group_seconds + time.perf_counter() - start
+
+        self.windows = self.windows + len(spectrograms)
+        self.stage_two_windows = self.stage_two_windows + len(flagged)
+        return predictions
+
+    def stats(self):
+        '''
+        Windows scored, the fraction of them which reached the social group
+        classifier, and seconds and windows per second of each stage.
+        '''
+        return {'windows': self.windows,
+                'stage_two_windows': self.stage_two_windows,
+                'stage_two_fraction': self.stage_two_windows / self.windows if self.windows > 0 else 0.0,
+                'binary_seconds': self.binary_seconds,
+                'group_seconds': self.group_seconds,
+                'binary_windows_per_second': self.windows / self.binary_seconds
+                                             if self.binary_seconds > 0 else None,
+                'group_windows_per_second': self.stage_two_windows / self.group_seconds
+                                            if self.group_seconds > 0 else None,
+                'windows_per_second': self.windows / (self.binary_seconds + self.group_seconds)
+                                      if self.binary_seconds + self.group_seconds > 0 else None}
+
+
+def group_labels(predictions, hop_seconds=1, segment_duration=10):
+    '''
+    Social group label of every second of a recording, from the window
+    predictions of the social group classifier or a CascadeModel: the class
+    with the highest mean probability over the windows (hop_seconds apart,
+    segment_duration long) which cover the whole second. Returns a list of
+    (second, label).
+    '''
+    predictions = np.asarray(predictions, dtype=np.float64)
+    if len(predictions) == 0:
+        return []
+    starts = np.arange(len(predictions)) * hop_seconds
+    first_seconds = np.ceil(starts).astype(int)
+    end_seconds = np.floor(starts + segment_duration).astype(int)
+    number_seconds = end_seconds.max()
+
+    # Sum the predictions of the windows covering each second, as the
+    # running total of +prediction where a window starts and -prediction
+    # where it ends
+    changes = np.zeros((number_seconds + 1, predictions.shape[1]))
+    np.add.at(changes, first_seconds, predictions)
+    np.add.at(changes, end_seconds, -predictions)
+    count_changes = np.zeros(number_seconds + 1)
+    np.add.at(count_changes, first_seconds, 1)
+    np.add.at(count_changes, end_seconds, -1)
+    totals = np.cumsum(changes, axis=0)[:number_seconds]
+    counts = np.cumsum(count_changes)[:number_seconds]
+
+    # Seconds no window fully covers are 'no-gibbon'
+    indices = np.where(counts > 0, (totals / np.maximum(counts, 1)[:, None]).argmax(axis=1), 0)
+    return [(second, GROUP_NAMES[index]) for second, index in enumerate(indices)]
@@ -0,0 +1,123 @@
+import math
+from functools import lru_cache
+
+import numpy as np
+import librosa
+from scipy import signal
+
+from Dtype_Policy import policy_dtype
+from Profiling import profiled
+
+
+@lru_cache(maxsize=None)
+def decimation_filter(original_sr, new_sample_rate, cutoff, attenuation=60.0):
+    '''
+    Low pass FIR filter for polyphase resampling from original_sr to
+    new_sample_rate, built once per set of parameters.
+
+    The filter runs at the upsampled rate original_sr * up. Its pass band
+    ends at cutoff (Hz) and it reaches attenuation (dB) by the Nyquist
+    frequency of the new sample rate, so the one filter both replaces the
+    Butterworth low pass filter and prevents aliasing.
+
+    Returns up, down and the float32 filter coefficients.
+    '''
+    divisor = math.gcd(int(original_sr), int(new_sample_rate))
+    up = int(new_sample_rate) // divisor
+    down = int(original_sr) // divisor
+
+    nyquist = original_sr * up / 2
+    stop = min(new_sample_rate, original_sr) / 2
+    if cutoff >= stop:
+        cutoff = 0.9 * stop
+    numtaps, beta = signal.kaiserord(attenuation, (stop - cutoff) / nyquist)
+    # Odd length keeps the filter delay on a whole sample
+    numtaps = numtaps + 1 - numtaps % 2
+    taps = signal.firwin(numtaps, (cutoff + stop) / 2, window=('kaiser', beta), fs=2 * nyquist)
+
+    taps = taps.astype(np.float32)
+    taps.flags.writeable = False
+    return up, down, taps
+
+@profiled('decimate')
+def decimate(audio, original_sr, new_sample_rate, cutoff):
+    '''
+    Low pass filter audio at cutoff (Hz) and resample it from original_sr to
+    new_sample_rate in a single polyphase stage, in the policy dtype (float32
+    by default). Gives as many samples as librosa.resample.
+    '''
+    up, down, taps = decimation_filter(original_sr, new_sample_rate, cutoff)
+    dtype = policy_dtype()
+    audio = np.asarray(audio, dtype=dtype)
+    taps = taps.astype(dtype, copy=False)
+    if up == down:
+        return signal.oaconvolve(audio, taps, mode='same').astype(dtype, copy=False)
+    resampled = signal.resample_poly(audio, up, down, window=taps)
+    return resampled[:int(math.ceil(len(audio) * up / down))].astype(dtype, copy=False)
+
+def butterworth_chain(audio, original_sr, new_sample_rate, cutoff, nyquist_rate, order=4):
+    '''
+    The original prediction front end: zero-phase Butterworth low pass
+    filter, then librosa.resample with kaiser_fast.
+    '''
+    b, a = signal.butter(order, float(cutoff) / nyquist_rate, btype='lowpass')
+    filtered = signal.filtfilt(b, a, audio)
+    return librosa.resample(filtered, orig_sr=original_sr, target_sr=new_sample_rate,
+                            res_type='kaiser_fast')
+
+def frequency_response(resample, original_sr, frequencies, duration=2):
+    '''
+    Gain (dB) of a resampling function resample(audio) at each frequency,
+    measured with a pure tone. The first and last quarter of the output are
+    left out to avoid edge effects. Tones above the new Nyquist frequency
+    measure how much energy aliases into the output.
+    '''
+    time = np.arange(int(duration * original_sr)) / original_sr
+    gains = []
+    for frequency in frequencies:
+        tone = np.sin(2 * np.pi * frequency * time).astype(np.float32)
+        output = np.asarray(resample(tone), dtype=np.float64)
+        middle = output[len(output) // 4:3 * len(output) // 4]
+        rms = np.sqrt(np.mean(middle ** 2))
+        gains.append(20 * np.log10(max(rms * np.sqrt(2), 1e-12)))
+    return np.array(gains)
+
+def check_frequency_response(original_sr, new_sample_rate, cutoff, nyquist_rate,
+                             pass_band_tolerance=1.0, verbose=True):
+    '''
+    Compare the frequency response of decimate with the Butterworth and
+    kaiser_fast chain it replaces.
+
+    In the pass band (up to 90% of cutoff) the two must agree within
+    pass_band_tolerance dB. Above the new Nyquist frequency decimate must
+    let no more energy alias into the output than the old chain.
+
+    Returns a dictionary of the measured gains and raises AssertionError if
+    the check fails.
+    '''
+    new_nyquist = new_sample_rate / 2
+    pass_band = np.linspace(50, 0.9 * cutoff, 12)
+    stop_band = np.linspace(1.1 * new_nyquist, min(4 * new_nyquist, 0.45 * original_sr), 12)
+
+    fused = lambda audio: decimate(audio, original_sr, new_sample_rate, cutoff)
+    chain = lambda audio: butterworth_chain(audio, original_sr, new_sample_rate, cutoff, nyquist_rate)
+
+    report = {'pass_band_frequencies': pass_band,
+              'pass_band_fused': frequency_response(fused, original_sr, pass_band),
+              'pass_band_chain': frequency_response(chain, original_sr, pass_band),
+              'stop_band_frequencies': stop_band,
+              'stop_band_fused': frequency_response(fused, original_sr, stop_band),
+              'stop_band_chain': frequency_response(chain, original_sr, stop_band)}
+
+    pass_band_difference = np.abs(report['pass_band_fused'] - report['pass_band_chain']).max()
+    if verbose:
+        print ('Largest pass band difference: {:.3f} dB'.format(pass_band_difference))
+        print ('Worst stop band gain: fused {:.1f} dB, chain {:.1f} dB'.format(
+               report['stop_band_fused'].max(), report['stop_band_chain'].max()))
+
+    assert pass_band_difference <= pass_band_tolerance, \
+        'Pass band differs from the Butterworth chain by {:.3f} dB'.format(pass_band_difference)
+    assert report['stop_band_fused'].max() <= report['stop_band_chain'].max(), \
+        'More aliasing than the Butterworth chain'
+
+    return report
@@ -0,0 +1,119 @@
+import argparse
+import os
+
+import numpy as np
+
+# The policy is kept in environment variables so that worker processes
+# (e.g. the spawned feature workers of the pipelined prediction) use the
+# same dtype and strictness as the process which set it.
+DTYPE_VARIABLE = 'GIBBON_DTYPE'
+STRICT_VARIABLE = 'GIBBON_STRICT_DTYPE'
+
+
+def policy_dtype():
+    ''' Floating point dtype used for audio, features and model input
+    throughout extraction, augmentation, training and prediction.
+    float32 unless changed with set_dtype.
+    '''
+    return np.dtype(os.environ.get(DTYPE_VARIABLE, 'float32'))
+
+def set_dtype(dtype):
+    ''' Change the floating point dtype of the pipeline, e.g. to float64
+    to reproduce results computed before the policy existed.
+    '''
+    dtype = np.dtype(dtype)
+    if dtype.kind != 'f':
+        raise ValueError('The pipeline dtype must be a floating point dtype, not {}'.format(dtype))
+    os.environ[DTYPE_VARIABLE] = dtype.name
+
+def is_strict():
+    return os.environ.get(STRICT_VARIABLE, '0') == '1'
+
+def set_strict(strict=True):
+    ''' In strict mode enforce_dtype raises instead of converting, so any
+    stage which silently produces another floating point dtype fails.
+    '''
+    os.environ[STRICT_VARIABLE] = '1' if strict else '0'
+
+def enforce_dtype(array, stage):
+    '''
+    Return array in the policy dtype, converting it only if needed.
+
+    Called where data leaves a stage. In strict mode a floating point array
+    of any other dtype raises TypeError naming the stage, which is how
+    check_dtype_policy finds silent upcasts. Integer audio is always
+    converted.
+    '''
+    array = np.asarray(array)
+    dtype = policy_dtype()
+    if array.dtype == dtype:
+        return array
+    if is_strict() and array.dtype.kind in 'fc' and array.size > 0:
+        raise TypeError('{} produced {} instead of {}'.format(stage, array.dtype, dtype))
+    return array.astype(dtype)
+
+def check_dtype_policy(sample_rate=4800, alpha=10, original_sample_rate=16000):
+    '''
+    Run every stage of the pipeline on synthetic audio in strict mode and
+    raise TypeError if any of them upcasts. Prints the dtype each stage
+    produced.
+    '''
+    import pandas as pd
+    from Extract_Audio_Helper import extract_all_gibbon_calls, extract_all_nongibbon_calls
+    from Augmentation import (augment_data, augment_background, augment_data_vectorised,
+                              augment_background_vectorised, convert_to_image)
+    from PredictionHelper import PredictionHelper
+
+    strict = is_strict()
+    set_strict(True)
+    try:
+        dtype = policy_dtype()
+        rng = np.random.default_rng(0)
+        recording = rng.standard_normal(120 * sample_rate).astype(dtype)
+        gibbon_timestamps = pd.DataFrame({'Start': [30 * sample_rate], 'End': [35 * sample_rate]})
+        noise_timestamps = pd.DataFrame({'Start': [60 * sample_rate], 'End': [90 * sample_rate]})
+
+        outputs = {}
+        gibbon = extract_all_gibbon_calls(recording, gibbon_timestamps, alpha, 1, sample_rate)
+        noise = extract_all_nongibbon_calls(recording, noise_timestamps, alpha, 5, sample_rate)
+        outputs['extract_all_gibbon_calls'] = gibbon
+        outputs['extract_all_nongibbon_calls'] = noise
+        outputs['augment_background'] = augment_background(0, 2, 1.0, noise, sample_rate, alpha)
+        outputs['augment_data'] = augment_data(0, 2, 1.0, gibbon, noise, sample_rate, alpha)
+        outputs['augment_background_vectorised'] = augment_background_vectorised(0, 2, 1.0, noise,
+                                                                     sample_rate, alpha)
+        outputs['augment_data_vectorised'] = augment_data_vectorised(0, 2, 1.0, gibbon, noise,
+                                                                     sample_rate, alpha)
+        outputs['convert_to_image'] = convert_to_image(gibbon)
+
+        helper = PredictionHelper('', 2000, sample_rate, 2400, alpha, 1024, 256, 128, 1000, 2000, '')
+        for resampler in ('polyphase', 'kaiser_fast'):
+            helper.resampler = resampler
+            audio = rng.standard_normal(40 * original_sample_rate).astype(dtype)
+            filtered, _ = helper.lowpass_and_downsample(audio, original_sample_rate)
+            outputs['lowpass_and_downsample ({})'.format(resampler)] = filtered
+        outputs['convert_recording_to_image'] = helper.convert_recording_to_image(recording[:30 * sample_rate],
+                                                                alpha, sample_rate, 0, 30)
+        outputs['convert_all_to_image'] = helper.convert_all_to_image(gibbon[:2])
+        # Windows too short for the shared STFT grid are converted one by one
+        short_helper = PredictionHelper('', 2000, sample_rate, 2400, 0.4, 1024, 256, 128, 1000, 2000, '')
+        outputs['convert_recording_to_image (per window)'] = short_helper.convert_recording_to_image(
+                                                                recording[:10 * sample_rate], 0.4,
+                                                                sample_rate, 0, 10)
+
+        for stage, output in outputs.items():
+            print ('{}: {}'.format(stage, output.dtype))
+            enforce_dtype(output, stage)
+    finally:
+        set_strict(strict)
+
+    print ('No stage upcasts from {}.'.format(dtype))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check that no stage of the pipeline upcasts.')
+    parser.add_argument('--dtype', default='float32', help='pipeline dtype to check')
+    arguments = parser.parse_args()
+
+    set_dtype(arguments.dtype)
+    check_dtype_policy()
@@ -1,5 +1,6 @@
 import pandas as pd
 import librosa
+import soundfile
 from scipy import signal
 import numpy as np
 import scipy
@@ -13,6 +14,9 @@ import time
 import librosa.display
 import scipy.fftpack
 
+from Dtype_Policy import policy_dtype, enforce_dtype
+from Profiling import profiled, profiler
+
 def read_and_process_gibbon_timestamps(directory, file_name, sample_rate, sep):
     ''' Read in a single file containing the timestamps of the gibbon calls
     and returns a Pandas dataframe with the start and end times converted
@@ -41,6 +45,7 @@ def read_and_process_nongibbon_timestamps(directory, file_name, sample_rate, sep
     non_gibbon_timestamps['End'] = non_gibbon_timestamps['End'] * sample_rate    
     return non_gibbon_timestamps
 
+@profiled('extract')
 def extract_all_gibbon_calls(librosa_audio, gibbon_timestamp_df = None, alpha=10, 
                              jump_seconds=1 ,sample_rate = 0, verbose=0):
 
@@ -87,8 +92,10 @@ def extract_all_gibbon_calls(librosa_audio, gibbon_timestamp_df = None, alpha=10
              # Append the audio data
             gibbon_extracted.append(librosa_audio[int(start_position):int(end_position)])
 
-    return np.asarray(gibbon_extracted)
+    profiler.count('gibbon_segments', len(gibbon_extracted))
+    return enforce_dtype(np.asarray(gibbon_extracted), 'extract_all_gibbon_calls')
 
+@profiled('extract')
 def extract_all_nongibbon_calls(librosa_audio, non_gibbon_timestamps = None,alpha=10, 
                                 jump_seconds=1 ,sample_rate = 0, verbose=0):
 
@@ -135,5 +142,108 @@ def extract_all_nongibbon_calls(librosa_audio, non_gibbon_timestamps = None,alph
              # Append the audio data
             noise_extracted.append(librosa_audio[int(start_position):int(end_position)])
 
-    return np.asarray(noise_extracted)
+    profiler.count('noise_segments', len(noise_extracted))
+    return enforce_dtype(np.asarray(noise_extracted), 'extract_all_nongibbon_calls')
+
+
+
+def gibbon_call_spans(gibbon_timestamp_df, alpha=10, jump_seconds=1, sample_rate=0):
+    '''
+    (start, end) sample positions of every window extract_all_gibbon_calls
+    reads for these timestamps, without reading any audio.
+    '''
+    alpha_converted = alpha * sample_rate
+    spans = []
+    for index, row in gibbon_timestamp_df.iterrows():
+        jump = 0
+        while True:
+            start_position = row['Start'] - sample_rate - (jump * jump_seconds * sample_rate)
+            end_position = start_position + alpha_converted
+            jump = jump + 1
+            if end_position <= row['End']:
+                break
+            spans.append((int(start_position), int(end_position)))
+    return spans
+
+def nongibbon_call_spans(non_gibbon_timestamps, alpha=10, jump_seconds=1, sample_rate=0):
+    '''
+    (start, end) sample positions of every window 
+    extract_all_nongibbon_calls reads for these timestamps, without 
+    reading any audio.
+    '''
+    alpha_converted = alpha * sample_rate
+    spans = []
+    for index, row in non_gibbon_timestamps.iterrows():
+        jump = 0
+        while True:
+            start_position = row['Start'] + (jump * jump_seconds * sample_rate)
+            end_position = start_position + alpha_converted
+            jump = jump + 1
+            if end_position >= row['End']:
+                break
+            spans.append((int(start_position), int(end_position)))
+    return spans
+
+def merge_spans(spans, sample_rate, margin_seconds=1):
+    '''
+    Merge overlapping (start, end) sample positions into the smallest set
+    of spans, each widened to whole seconds plus margin_seconds on either
+    side so the resampler sees the same neighbouring audio as when
+    resampling the whole file.
+    '''
+    merged = []
+    for start, end in sorted(spans):
+        start = max(0, (start // sample_rate - margin_seconds) * sample_rate)
+        end = (-(-end // sample_rate) + margin_seconds) * sample_rate
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [tuple(span) for span in merged]
+
+
+class SpanAudio:
+    '''
+    Audio of a recording of which only some spans were decoded. Slicing
+    behaves like slicing the whole recording, as long as the slice lies
+    within one decoded span.
+    '''
 
+    def __init__(self, spans, length):
+        # List of (start sample, decoded audio)
+        self.spans = spans
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, item):
+        start, stop, step = item.indices(self.length)
+        if stop <= start:
+            return np.zeros(0, dtype=policy_dtype())
+        for span_start, audio in self.spans:
+            if span_start <= start and stop <= span_start + len(audio):
+                return audio[start - span_start:stop - span_start:step]
+        raise ValueError('Samples {} to {} were not decoded'.format(start, stop))
+
+@profiled('decode')
+def load_audio_spans(file_name, spans, sample_rate):
+    '''
+    Decode and resample only the given (start, end) spans, in samples at
+    sample_rate, of an audio file. Spans should start on whole seconds
+    (see merge_spans) so they line up with the resampled whole file.
+    Returns a SpanAudio.
+    '''
+    info = soundfile.info(file_name)
+    length = int(np.ceil(info.frames * sample_rate / info.samplerate))
+
+    decoded = []
+    for start, end in spans:
+        end = min(end, length)
+        if end <= start:
+            continue
+        audio, _ = librosa.load(file_name, sr=sample_rate, offset=start / sample_rate, 
+                                duration=(end - start) / sample_rate, dtype=policy_dtype())
+        decoded.append((start, audio))
+
+    return SpanAudio(decoded, length)
@@ -0,0 +1,178 @@
+import hashlib
+import json
+import os
+import threading
+import weakref
+
+import numpy as np
+
+
+class FeatureCache:
+    '''
+    On-disk cache of the spectrograms computed for an audio file.
+
+    Entries are keyed on the SHA-256 of the audio file's content together
+    with every parameter used to compute the features, so a changed file
+    or a changed parameter never returns stale spectrograms. Entries are
+    stored as .npy files and returned memory-mapped. When the cache grows
+    beyond max_size bytes the least recently used entries are removed,
+    except those whose memory-mapped arrays are still in use.
+
+    Safe to share between threads, e.g. the request threads of the
+    prediction service.
+    '''
+
+    def __init__(self, cache_directory, max_size=10 * 1024**3):
+        self.cache_directory = cache_directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+        # Weak references to the arrays returned by get, per entry path
+        self.in_use = {}
+        os.makedirs(self.cache_directory, exist_ok=True)
+
+        # Content hashes of audio files, reused while a file's size and
+        # modification time are unchanged
+        self.hash_index_path = os.path.join(self.cache_directory, 'file_hashes.json')
+        if os.path.exists(self.hash_index_path):
+            with open(self.hash_index_path) as fp:
+                self.hash_index = json.load(fp)
+        else:
+            self.hash_index = {}
+
+    def __getstate__(self):
+        # Locks cannot be pickled, e.g. when the helper holding the cache is
+        # sent to the spawned feature workers of the pipelined prediction
+        state = self.__dict__.copy()
+        del state['lock']
+        del state['in_use']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.RLock()
+        self.in_use = {}
+
+    def file_hash(self, file_name):
+        '''
+        SHA-256 of the content of a file.
+        '''
+        stat = os.stat(file_name)
+        path = os.path.abspath(file_name)
+        # The index is read and written under the lock, so a thread never
+        # sees it while another one is updating it
+        with self.lock:
+            known = self.hash_index.get(path)
+            if known is not None and known['size'] == stat.st_size and known['mtime'] == stat.st_mtime:
+                return known['sha256']
+
+            sha256 = hashlib.sha256()
+            with open(file_name, 'rb') as fp:
+                for block in iter(lambda: fp.read(1024 * 1024), b''):
+                    sha256.update(block)
+
+            self.hash_index[path] = {'size': stat.st_size, 'mtime': stat.st_mtime,
+                                     'sha256': sha256.hexdigest()}
+            with open(self.hash_index_path, 'w') as fp:
+                json.dump(self.hash_index, fp)
+
+            return sha256.hexdigest()
+
+    def key(self, file_name, parameters):
+        '''
+        Cache key for the features of file_name computed with parameters,
+        a dictionary of every setting the features depend on.
+        '''
+        description = json.dumps({'file': self.file_hash(file_name),
+                                  'parameters': parameters}, sort_keys=True)
+        return hashlib.sha256(description.encode()).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_directory, key + '.npy')
+
+    def get(self, key):
+        '''
+        Memory-mapped array stored under key, or None. The entry is not
+        evicted while the array (or a view of it) is in use.
+        '''
+        path = self.entry_path(key)
+        with self.lock:
+            if not os.path.exists(path):
+                self.misses = self.misses + 1
+                return None
+
+            self.hits = self.hits + 1
+            # Mark as recently used
+            os.utime(path)
+            array = np.load(path, mmap_mode='r')
+            self.in_use[path] = [reference for reference in self.in_use.get(path, [])
+                                 if reference() is not None] + [weakref.ref(array)]
+            return array
+
+    def is_in_use(self, path):
+        '''
+        Whether an array returned by get for the entry at path is still alive.
+        '''
+        with self.lock:
+            references = [reference for reference in self.in_use.get(path, [])
+                          if reference() is not None]
+            if references:
+                self.in_use[path] = references
+            else:
+                self.in_use.pop(path, None)
+            return len(references) > 0
+
+    def put(self, key, array):
+        '''
+        Store an array under key and evict old entries if needed.
+        '''
+        path = self.entry_path(key)
+        # Write to a temporary file first so a crash never leaves a partial entry
+        temporary_path = path + '.tmp'
+        with self.lock:
+            with open(temporary_path, 'wb') as fp:
+                np.save(fp, array)
+            os.replace(temporary_path, path)
+
+            self.evict()
+
+    def entries(self):
+        '''
+        (path, size, last use) of every entry, least recently used first.
+        '''
+        entries = []
+        for name in os.listdir(self.cache_directory):
+            if name.endswith('.npy'):
+                stat = os.stat(os.path.join(self.cache_directory, name))
+                entries.append((os.path.join(self.cache_directory, name), stat.st_size, stat.st_mtime))
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def evict(self):
+        '''
+        Remove the least recently used entries until the cache fits in
+        max_size. Entries still in use are kept, so the cache can stay over
+        max_size until they are released.
+        '''
+        with self.lock:
+            entries = self.entries()
+            total_size = sum(entry[1] for entry in entries)
+            for path, size, _ in entries:
+                if total_size <= self.max_size:
+                    break
+                if self.is_in_use(path):
+                    continue
+                os.remove(path)
+                total_size = total_size - size
+
+    def stats(self):
+        '''
+        Hit/miss counts of this session and the current size of the cache.
+        '''
+        entries = self.entries()
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups > 0 else 0.0,
+                'entries': len(entries),
+                'size': sum(entry[1] for entry in entries)}
@@ -0,0 +1,219 @@
+import os
+import tempfile
+
+import numpy as np
+
+# Backends PredictionHelper can run the model with. 'keras' is the Keras
+# model itself; the others run a model exported with export_model.
+BACKENDS = ('keras', 'onnx', 'tflite')
+# Post-training quantisation of export_model: None (float32), 'dynamic'
+# (int8 weights, float activations) or 'int8' (int8 weights and
+# activations, calibrated on representative spectrograms)
+QUANTISATIONS = (None, 'dynamic', 'int8')
+
+
+def backend_for_file(file_name):
+    ''' Backend which runs an exported model file, from its extension. '''
+    extension = os.path.splitext(file_name)[1].lower()
+    if extension == '.onnx':
+        return 'onnx'
+    if extension == '.tflite':
+        return 'tflite'
+    raise ValueError('Cannot tell the backend of {}: expected a .onnx or .tflite file'.format(file_name))
+
+def calibration_batches(calibration_data, number_samples=200, seed=0):
+    '''
+    Up to number_samples spectrograms of calibration_data (samples, 128,
+    188, 1), picked at random, one at a time as float32 batches of one.
+    '''
+    if calibration_data is None:
+        raise ValueError('int8 quantisation needs calibration_data: spectrograms representative of the input')
+    calibration_data = np.asarray(calibration_data, dtype=np.float32)
+    rng = np.random.default_rng(seed)
+    indices = rng.permutation(len(calibration_data))[:number_samples]
+    return [calibration_data[index:index + 1] for index in np.sort(indices)]
+
+def model_function(model):
+    '''
+    The inference function of a Keras model, with a free batch dimension.
+    '''
+    import tensorflow as tf
+
+    input_shape = (None,) + tuple(model.inputs[0].shape[1:])
+    function = tf.function(lambda spectrograms: model(spectrograms, training=False),
+                           input_signature=[tf.TensorSpec(input_shape, tf.float32, name='spectrograms')])
+    return function
+
+def export_tflite(model, output_file, quantisation=None, calibration_data=None):
+    '''
+    Export a Keras model to TFLite. Inputs and outputs stay float32 in every
+    case, so the exported model is a drop in replacement.
+    '''
+    import tensorflow as tf
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if quantisation is not None:
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantisation == 'int8':
+        batches = calibration_batches(calibration_data)
+        converter.representative_dataset = lambda: ([batch] for batch in batches)
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+
+    with open(output_file, 'wb') as fp:
+        fp.write(converter.convert())
+
+def export_onnx(model, output_file, quantisation=None, calibration_data=None, opset=13):
+    '''
+    Export a Keras model to ONNX with tf2onnx, and quantise it with
+    onnxruntime.quantization if asked. int8 quantisation is static, with
+    quantise and dequantise nodes around every convolution and dense layer.
+    '''
+    try:
+        import tf2onnx
+    except ImportError:
+        raise ImportError('Exporting to ONNX needs tf2onnx: pip install tf2onnx onnxruntime')
+
+    function = model_function(model)
+    if quantisation is None:
+        tf2onnx.convert.from_function(function, input_signature=function.input_signature,
+                                      opset=opset, output_path=output_file)
+        return
+
+    from onnxruntime import quantization
+
+    with tempfile.TemporaryDirectory() as directory:
+        float_file = os.path.join(directory, 'float.onnx')
+        tf2onnx.convert.from_function(function, input_signature=function.input_signature,
+                                      opset=opset, output_path=float_file)
+        if quantisation == 'dynamic':
+            quantization.quantize_dynamic(float_file, output_file, weight_type=quantization.QuantType.QInt8)
+            return
+
+        class CalibrationReader(quantization.CalibrationDataReader):
+            def __init__(self, batches):
+                self.batches = iter(batches)
+
+            def get_next(self):
+                batch = next(self.batches, None)
+                return None if batch is None else {'spectrograms': batch}
+
+        quantization.quantize_static(float_file, output_file,
+                                     CalibrationReader(calibration_batches(calibration_data)),
+                                     quant_format=quantization.QuantFormat.QDQ,
+                                     activation_type=quantization.QuantType.QUInt8,
+                                     weight_type=quantization.QuantType.QInt8)
+
+def export_model(model, output_file, quantisation=None, calibration_data=None):
+    '''
+    Export a trained Keras model to output_file, as ONNX or TFLite from its
+    extension, optionally quantised (see QUANTISATIONS). calibration_data,
+    spectrograms with the Keras channel dimension, is needed for 'int8'.
+    '''
+    if quantisation not in QUANTISATIONS:
+        raise ValueError('Unknown quantisation {}, expected one of {}'.format(quantisation, QUANTISATIONS))
+
+    backend = backend_for_file(output_file)
+    print ('Exporting model to {} ({}, {})'.format(output_file, backend, quantisation or 'float32'))
+    if backend == 'onnx':
+        export_onnx(model, output_file, quantisation, calibration_data)
+    else:
+        export_tflite(model, output_file, quantisation, calibration_data)
+    print ('Model size: {:.1f} kB'.format(os.path.getsize(output_file) / 1024))
+
+
+class OnnxModel:
+    '''
+    An exported ONNX model run with ONNX Runtime, with the predict method of
+    a Keras model.
+    '''
+
+    def __init__(self, model_file, threads=None):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError('The onnx backend needs onnxruntime: pip install onnxruntime')
+
+        options = onnxruntime.SessionOptions()
+        if threads is not None:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(model_file, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+        self.model_file = model_file
+
+    def predict(self, spectrograms, batch_size=None, verbose=None):
+        spectrograms = np.asarray(spectrograms, dtype=np.float32)
+        batch_size = batch_size or 32
+        predictions = [self.session.run(None, {self.input_name: spectrograms[start:start + batch_size]})[0]
+                       for start in range(0, len(spectrograms), batch_size)]
+        if not predictions:
+            return np.zeros((0,) + tuple(self.session.get_outputs()[0].shape[1:]), dtype=np.float32)
+        return np.concatenate(predictions)
+
+
+class TFLiteModel:
+    '''
+    An exported TFLite model, with the predict method of a Keras model. Uses
+    the standalone LiteRT interpreter when it is installed, which starts
+    much faster than TensorFlow.
+    '''
+
+    def __init__(self, model_file, threads=None):
+        try:
+            from ai_edge_litert.interpreter import Interpreter
+        except ImportError:
+            try:
+                from tflite_runtime.interpreter import Interpreter
+            except ImportError:
+                import tensorflow as tf
+                Interpreter = tf.lite.Interpreter
+
+        self.interpreter = Interpreter(model_path=model_file, num_threads=threads)
+        self.input_index = self.interpreter.get_input_details()[0]['index']
+        self.output_index = self.interpreter.get_output_details()[0]['index']
+        self.batch_size = None
+        self.model_file = model_file
+
+    def resize(self, batch_size):
+        if batch_size != self.batch_size:
+            shape = self.interpreter.get_input_details()[0]['shape']
+            self.interpreter.resize_tensor_input(self.input_index, [batch_size] + list(shape[1:]))
+            self.interpreter.allocate_tensors()
+            self.batch_size = batch_size
+
+    def predict(self, spectrograms, batch_size=None, verbose=None):
+        spectrograms = np.asarray(spectrograms, dtype=np.float32)
+        batch_size = batch_size or 32
+        predictions = []
+        for start in range(0, len(spectrograms), batch_size):
+            batch = spectrograms[start:start + batch_size]
+            self.resize(len(batch))
+            self.interpreter.set_tensor(self.input_index, batch)
+            self.interpreter.invoke()
+            predictions.append(self.interpreter.get_tensor(self.output_index).copy())
+        if not predictions:
+            return np.zeros((0, self.interpreter.get_output_details()[0]['shape'][-1]), dtype=np.float32)
+        return np.concatenate(predictions)
+
+
+def load_exported_model(model_file, threads=None):
+    ''' Load an exported .onnx or .tflite model for prediction. '''
+    if backend_for_file(model_file) == 'onnx':
+        return OnnxModel(model_file, threads)
+    return TFLiteModel(model_file, threads)
+
+def agreement(reference, predictions, threshold=0.5):
+    '''
+    How closely predictions (samples, classes) agree with reference: the
+    largest absolute difference, the fraction of segments with the same
+    most likely class, and the fraction of segment and class decisions at
+    threshold (as save_predictions makes them) which are the same.
+    '''
+    reference = np.asarray(reference, dtype=np.float64)
+    predictions = np.asarray(predictions, dtype=np.float64)
+    if len(reference) == 0:
+        return {'segments': 0, 'max_abs_difference': 0.0,
+                'argmax_agreement': 1.0, 'decision_agreement': 1.0}
+    return {'segments': len(reference),
+            'max_abs_difference': float(np.abs(reference - predictions).max()),
+            'argmax_agreement': float(np.mean(reference.argmax(axis=1) == predictions.argmax(axis=1))),
+            'decision_agreement': float(np.mean((reference >= threshold) == (predictions >= threshold)))}
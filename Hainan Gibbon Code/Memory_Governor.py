@@ -0,0 +1,215 @@
+import contextlib
+import os
+import platform
+import resource
+
+import numpy as np
+import soundfile as sf
+
+from Dtype_Policy import policy_dtype
+
+# Block lengths (seconds) tried when a whole recording does not fit
+BLOCK_DURATIONS = (3600, 1800, 900, 600, 300, 120, 60)
+# Batch sizes and spectrogram chunk sizes tried, largest first
+BATCH_SIZES = (256, 128, 64, 32, 16, 8, 4, 2, 1)
+CHUNK_SIZES = (256, 128, 64, 32, 16, 8)
+# Per sample activations of a model whose layers cannot be inspected
+DEFAULT_ACTIVATION_BYTES = 2 * 1024**2
+# Resident memory of a worker process before it does any work (Python,
+# numpy, librosa and TensorFlow imported)
+WORKER_PROCESS_BYTES = 400 * 1024**2
+
+
+def parse_size(size):
+    '''
+    Number of bytes in a size such as 2G, 512M, 1.5GB or 1000000.
+    '''
+    if isinstance(size, (int, float)):
+        return int(size)
+    text = size.strip().upper().rstrip('B').rstrip('I')
+    units = {'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(float(text))
+
+def format_size(size):
+    return '{:.0f} MB'.format(size / 1024**2)
+
+def current_rss():
+    ''' Resident memory of this process in bytes. '''
+    try:
+        with open('/proc/self/statm') as fp:
+            return int(fp.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return peak_rss()
+
+def reset_peak_rss():
+    ''' Reset the peak resident memory to the current one, on Linux.
+    Elsewhere the peak covers the whole run so far.
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as fp:
+            fp.write('5')
+    except OSError:
+        pass
+
+def peak_rss():
+    ''' Peak resident memory in bytes since the last reset_peak_rss. '''
+    try:
+        with open('/proc/self/status') as fp:
+            for line in fp:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if platform.system() == 'Darwin' else maxrss * 1024
+
+def activation_bytes(model):
+    ''' Bytes of the outputs of every layer of model for one sample. '''
+    try:
+        return 4 * sum(int(np.prod(layer.output.shape[1:])) for layer in model.layers)
+    except (AttributeError, TypeError, ValueError):
+        return DEFAULT_ACTIVATION_BYTES
+
+
+class MemoryGovernor:
+    '''
+    Keeps prediction and preprocessing under a resident memory budget
+    max_rss (bytes, or a size such as '2G').
+
+    Before a recording is processed its memory use is estimated from its
+    length, and the governor picks the block length, model batch size,
+    spectrogram chunk size and worker counts which fit in what is left of
+    the budget. If even the smallest settings do not fit it raises
+    MemoryError straight away, rather than the process being killed part
+    way through.
+
+    stage() records the peak resident memory of every stage, and raises
+    MemoryError as soon as a stage has gone over the budget.
+    '''
+
+    def __init__(self, max_rss):
+        self.max_rss = parse_size(max_rss)
+        self.stage_peaks = {}
+
+    def available(self):
+        return self.max_rss - current_rss()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        '''
+        Context manager recording the peak memory of a stage and checking
+        it against the budget.
+        '''
+        reset_peak_rss()
+        yield
+        peak = peak_rss()
+        self.stage_peaks[name] = max(self.stage_peaks.get(name, 0), peak)
+        if peak > self.max_rss:
+            raise MemoryError('Stage {} reached {} of resident memory, over the budget of {}'.format(
+                              name, format_size(peak), format_size(self.max_rss)))
+
+    def report(self):
+        ''' Peak resident memory of every stage, in MB. '''
+        return {name: peak / 1024**2 for name, peak in self.stage_peaks.items()}
+
+    def prediction_memory(self, helper, duration, original_sample_rate, block_duration,
+                          batch_size, chunk_size, sample_bytes):
+        '''
+        Estimated bytes needed on top of the current memory to predict a
+        recording of duration seconds with PredictionHelper helper. The
+        largest of:
+
+        - decoding: the decoded audio (and librosa's copy while mixing and
+          converting it) plus the downsampled audio,
+        - spectrograms: the downsampled audio, the mel energies of the whole
+          recording on the STFT grid, the chunk being normalised and the
+          spectrograms of every window,
+        - inference: the spectrograms and the activations of one batch.
+
+        block_duration None means the whole recording at once.
+        '''
+        itemsize = policy_dtype().itemsize
+        if block_duration is not None:
+            # Two seconds of context either side, and a partial segment carried over
+            duration = min(duration, block_duration + 4 + helper.segment_duration)
+
+        audio = 2 * duration * original_sample_rate * itemsize
+        downsampled = duration * helper.downsample_rate * itemsize
+        number_windows = max(0, int((duration - helper.segment_duration) / helper.hop_seconds) + 1)
+        number_frames = 1 + helper.segment_duration * helper.downsample_rate // helper.hop_length
+        spectrogram = helper.n_mels * number_frames * itemsize
+        spectrograms = number_windows * spectrogram
+        grid = duration * helper.downsample_rate / 64 * helper.n_mels * itemsize
+        chunk = 4 * min(chunk_size, number_windows) * spectrogram
+
+        decoding = audio + downsampled
+        converting = downsampled + grid + chunk + spectrograms
+        inference = spectrograms + (batch_size or 32) * sample_bytes
+        return int(max(decoding, converting, inference))
+
+    def plan_prediction(self, helper, file_name, model=None):
+        '''
+        Settings with which PredictionHelper helper can predict file_name
+        within the budget: a dictionary of block_duration (None to read
+        the whole file), batch_size and chunk_size.
+
+        Reading the whole file is preferred, then the longest block, then
+        the largest batch and chunk sizes.
+        '''
+        info = sf.info(file_name)
+        available = self.available()
+        sample_bytes = activation_bytes(model) if model is not None else DEFAULT_ACTIVATION_BYTES
+
+        block_durations = (None,) + tuple(block for block in BLOCK_DURATIONS if block < info.duration)
+        smallest = None
+        for block_duration in block_durations:
+            for batch_size in BATCH_SIZES:
+                for chunk_size in CHUNK_SIZES:
+                    needed = self.prediction_memory(helper, info.duration, info.samplerate,
+                                                    block_duration, batch_size, chunk_size, sample_bytes)
+                    if needed <= available:
+                        return {'block_duration': block_duration,
+                                'batch_size': batch_size,
+                                'chunk_size': chunk_size,
+                                'estimated_bytes': needed}
+                    smallest = needed
+
+        smallest_block = 'whole file' if block_durations[-1] is None else '{} s blocks'.format(block_durations[-1])
+        raise MemoryError('{} ({:.0f} s at {} Hz) needs about {} even in {} with batch size {}, '
+                          'but only {} of the {} budget is left ({} already in use). '
+                          'Increase the budget or use a shorter block length.'.format(
+                          file_name, info.duration, info.samplerate, format_size(smallest),
+                          smallest_block, BATCH_SIZES[-1], format_size(max(available, 0)),
+                          format_size(self.max_rss), format_size(current_rss())))
+
+    def plan_workers(self, bytes_per_worker, requested, what='workers'):
+        '''
+        Largest number of workers, up to requested, each needing
+        bytes_per_worker, which fit in the budget. Raises MemoryError if
+        not even one does.
+        '''
+        available = self.available()
+        workers = min(requested, int(available // max(bytes_per_worker, 1)))
+        if workers < 1:
+            raise MemoryError('One of the {} needs about {}, but only {} of the {} budget is left.'.format(
+                              what, format_size(bytes_per_worker), format_size(max(available, 0)),
+                              format_size(self.max_rss)))
+        return workers
+
+    def preprocessing_memory(self, file_name, sample_rate, number_segments,
+                             number_seconds_to_extract, augmentation_amount):
+        '''
+        Estimated bytes needed to extract and augment one recording with
+        number_segments labelled segments: the decoded and resampled audio,
+        the segments and their augmented copies, and their spectrograms.
+        '''
+        info = sf.info(file_name)
+        itemsize = policy_dtype().itemsize
+        audio = 2 * info.duration * info.samplerate * itemsize + info.duration * sample_rate * itemsize
+        segment = number_seconds_to_extract * sample_rate * itemsize
+        spectrogram = 128 * (1 + number_seconds_to_extract * sample_rate // 256) * itemsize
+        segments = number_segments * (1 + augmentation_amount) * (segment + spectrogram)
+        return int(audio + segments)
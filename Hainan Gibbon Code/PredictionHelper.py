@@ -4,12 +4,29 @@ import glob, os
 import librosa.display
 import librosa
 import numpy as np
+import soundfile as sf
 from scipy import signal
 from tensorflow.keras.utils import to_categorical
 import gc
+import collections
+import contextlib
+import concurrent.futures
+import multiprocessing
 import matplotlib.pyplot as plt
 
-from CNNNetwork import *
+from CNN_Network import network
+from CNN_Network_Binary import network as binary_network
+from Spectrogram_Helper import *
+from Feature_Cache import FeatureCache
+from Decimation import decimate
+from Dtype_Policy import policy_dtype, enforce_dtype
+from Profiling import profiled, profiler
+from Memory_Governor import MemoryGovernor, WORKER_PROCESS_BYTES
+from Inference_Backend import (BACKENDS, backend_for_file, export_model, load_exported_model,
+                               agreement)
+from Cascade import GROUP_NAMES, CascadeModel, group_labels
+from Shared_Convolution import SharedConvolutionModel
+from Autotune import AUTOTUNE_FILE, load_configuration, apply_threads
 
 import ntpath
 
@@ -18,7 +35,10 @@ class PredictionHelper:
     def __init__(self, species_folder, lowpass_cutoff, 
                  downsample_rate, nyquist_rate, segment_duration, 
                  n_fft, hop_length, n_mels, f_min, f_max, 
-                 weights_name):
+                 weights_name, hop_seconds=1, block_duration=None, feature_cache=None,
+                 resampler='polyphase', max_rss=None, backend='keras', backend_file=None,
+                 backend_threads=None, prefilter=None, binary_weights_name=None, 
+                 binary_threshold=0.5, shared_convolution=False, autotune_file=AUTOTUNE_FILE):
 
         self.species_folder = species_folder
         self.lowpass_cutoff = lowpass_cutoff
@@ -34,7 +54,62 @@ class PredictionHelper:
         self.f_min = f_min
         self.f_max = f_max
         self.weights_name = weights_name      
+        self.hop_seconds = hop_seconds
+        self.block_duration = block_duration
+        self.feature_cache = feature_cache
+        # 'polyphase' (one fused FIR stage) or 'kaiser_fast' (Butterworth
+        # filter then librosa.resample, as originally)
+        self.resampler = resampler
+        # With a memory budget (e.g. '2G') the block length, batch size and
+        # chunk size are chosen per file to fit in it
+        self.governor = MemoryGovernor(max_rss) if max_rss is not None else None
+        self.batch_size = None
+        self.chunk_size = 256
+        # 'keras', or 'onnx' / 'tflite' to predict with the model exported
+        # to backend_file by export_backend
+        if backend not in BACKENDS:
+            raise ValueError('Unknown backend {}, expected one of {}'.format(backend, BACKENDS))
+        if backend != 'keras' and (backend_file is None or backend_for_file(backend_file) != backend):
+            raise ValueError('The {} backend needs backend_file, a .{} model exported with export_backend'.format(
+                             backend, backend))
+        self.backend = backend
+        self.backend_file = backend_file
+        self.backend_threads = backend_threads
+        # Band_Prefilter.BandPrefilter which skips windows without energy in
+        # the call band before the spectrogram and the CNN
+        self.prefilter = prefilter
+        # With the weights of the binary detector, predict as a cascade: the
+        # social group model only sees the windows the detector flags
+        self.binary_weights_name = binary_weights_name
+        self.binary_threshold = binary_threshold
+        # Run the first convolution of the Keras model once over the whole
+        # recording rather than once per window (see Shared_Convolution)
+        if shared_convolution and (backend != 'keras' or binary_weights_name is not None):
+            raise ValueError('shared_convolution needs the keras backend without the binary cascade')
+        # Both work on whole files, not on blocks
+        if block_duration is not None and (prefilter is not None or shared_convolution):
+            raise ValueError('The prefilter and shared_convolution cannot be used with block_duration')
+        self.shared_convolution = shared_convolution
+        # The batch size and thread pools tuned for this host by Autotune.py,
+        # if it has been run (autotune_file=None to ignore them)
+        self.tuned = load_configuration(backend, autotune_file)
+        if self.tuned is not None:
+            self.apply_tuned_configuration()
 
+    def apply_tuned_configuration(self):
+        '''
+        Use the tuned batch size and thread counts. The thread pools of
+        TensorFlow can only be set before it starts, so the helper has to
+        be created before any model is loaded.
+        '''
+        print ('Autotuned configuration:', self.tuned)
+        self.batch_size = self.tuned['batch_size']
+        if self.backend == 'keras':
+            apply_threads(self.tuned['intra_op_threads'], self.tuned['inter_op_threads'])
+        elif self.backend_threads is None and self.tuned['intra_op_threads'] > 0:
+            self.backend_threads = self.tuned['intra_op_threads']
+
+    @profiled('decode')
     def read_audio_file(self, file_name):
         '''
         file_name: string, name of file including extension, e.g. "audio1.wav"
@@ -44,10 +119,98 @@ class PredictionHelper:
         audio_folder = os.path.join(file_name)
         
         # Read the amplitudes and sample rate
-        audio_amps, audio_sample_rate = librosa.load(audio_folder, sr=None)
+        audio_amps, audio_sample_rate = librosa.load(audio_folder, sr=None, dtype=policy_dtype())
+        profiler.count('audio_seconds', len(audio_amps) / audio_sample_rate)
         
         return audio_amps, audio_sample_rate
     
+    def stream_audio_file(self, file_name, block_duration=60, context_duration=2):
+        '''
+        Read, low pass filter and downsample an audio file one block at a 
+        time, yielding the downsampled blocks in order.
+
+        Only block_duration seconds of audio (plus the context on either 
+        side) are held in memory, whatever the length of the recording.
+        filtfilt is zero-phase and cannot carry its state forward, so the
+        state carried between blocks is context_duration seconds of audio
+        on either side of each block. The filter and resampler see this 
+        context and it is trimmed off again afterwards, which makes the
+        concatenated blocks match the whole-file chain up to float error.
+        '''
+        if block_duration < context_duration:
+            raise ValueError('block_duration must be at least context_duration')
+
+        with sf.SoundFile(file_name) as audio_file:
+            original_sample_rate = audio_file.samplerate
+            block_length = block_duration * original_sample_rate
+            context_length = context_duration * original_sample_rate
+
+            def read_block():
+                # Mix down to mono, as librosa.load does
+                with profiler.stage('decode'):
+                    return audio_file.read(block_length, dtype=policy_dtype().name, always_2d=True).mean(axis=1)
+
+            previous = np.zeros(0, dtype=policy_dtype())
+            current = read_block()
+            while len(current) > 0:
+                following = read_block()
+                chunk = np.concatenate([previous, current, following[:context_length]])
+
+                filtered, filtered_sample_rate = self.lowpass_and_downsample(chunk, original_sample_rate)
+
+                # Trim the context off again
+                start = len(previous) * filtered_sample_rate // original_sample_rate
+                if len(following) > 0:
+                    yield filtered[start:start + len(current) * filtered_sample_rate // original_sample_rate]
+                else:
+                    yield filtered[start:]
+
+                previous = current[-context_length:]
+                current = following
+
+    def predict_file_streaming(self, model, file_name, block_duration=60):
+        '''
+        Predict every segment of an audio file while holding at most one 
+        block of audio, and the spectrograms of its segments, in memory.
+        Gives the same predictions as reading the whole file.
+        '''
+        # Segments must end within the whole seconds of the file
+        info = sf.info(file_name)
+        end_index = int(info.frames / info.samplerate)
+
+        hop_length = int(self.hop_seconds * self.downsample_rate)
+        
+        buffer = np.zeros(0, dtype=policy_dtype())
+        # Time (seconds) of the first sample in the buffer, which is always
+        # the start of the next segment to predict
+        buffer_start = 0
+        predictions = []
+        
+        for block in self.stream_audio_file(file_name, block_duration):
+            buffer = np.concatenate([buffer, block])
+            buffer_end = min(buffer_start + len(buffer) / self.downsample_rate, end_index)
+            if buffer_end - buffer_start < self.segment_duration:
+                continue
+
+            spectrograms = self.convert_recording_to_image(buffer, self.segment_duration, 
+                                        self.downsample_rate, 0, buffer_end - buffer_start, 
+                                        self.hop_seconds, self.chunk_size)
+            with profiler.stage('inference'):
+                predictions.append(model.predict(self.add_keras_dim(spectrograms), 
+                                                 batch_size=self.batch_size))
+
+            # Keep the audio which later segments still overlap
+            buffer = buffer[len(spectrograms) * hop_length:]
+            buffer_start = buffer_start + len(spectrograms) * self.hop_seconds
+            del spectrograms
+
+        if len(predictions) == 0:
+            # Only Keras models have output_shape, so the width comes from
+            # the social group classes every model predicts
+            return np.zeros((0, len(GROUP_NAMES)), dtype=np.float32)
+
+        return np.concatenate(predictions)
+
     def create_X_new(self, mono_data, time_to_extract, sampleRate,start_index, 
         end_index, file_name_no_extension, verbose):
         '''
@@ -92,17 +255,77 @@ class PredictionHelper:
 
         return X_frequences
 
+    def window_layout(self, number_samples, time_to_extract, sampleRate, start_index,
+        end_index, hop_seconds=1):
+        '''
+        Work out where the windows of a recording lie, in samples.
+        Returns the offset of the first window, the window length, the hop
+        and the number of windows.
+        '''
+        window_length = int(time_to_extract * sampleRate)
+        hop_length = hop_seconds * sampleRate
+        if hop_length <= 0 or hop_length != int(hop_length):
+            raise ValueError('hop_seconds must cover a whole number of samples, '
+                             'got {} seconds at {} Hz'.format(hop_seconds, sampleRate))
+        hop_length = int(hop_length)
+
+        # Number of complete windows between start_index and end_index
+        number_windows = int(np.floor((end_index - start_index - time_to_extract) / hop_seconds + 1e-9)) + 1
+        number_windows = max(number_windows, 0)
+
+        offset = int(start_index * sampleRate)
+        if number_windows > 0 and offset + (number_windows - 1) * hop_length + window_length > number_samples:
+            raise ValueError('end_index lies beyond the end of the audio')
+
+        return offset, window_length, hop_length, number_windows
+
+    def create_X_strided(self, mono_data, time_to_extract, sampleRate, start_index,
+        end_index, hop_seconds=1, verbose=False):
+        '''
+        Create X input data as a read-only strided view over the audio.
+
+        Same windows as create_X_new (for hop_seconds=1) but no window is
+        copied: every row of the returned array points into mono_data.
+        hop_seconds may be smaller than a second, as long as it covers a
+        whole number of samples.
+        '''
+
+        mono_data = np.ascontiguousarray(mono_data)
+
+        offset, window_length, hop_length, number_windows = self.window_layout(len(mono_data), 
+                                    time_to_extract, sampleRate, start_index, end_index, hop_seconds)
+
+        X_frequences = np.lib.stride_tricks.as_strided(mono_data[offset:],
+                                    shape=(number_windows, window_length),
+                                    strides=(hop_length * mono_data.strides[0], mono_data.strides[0]),
+                                    writeable=False)
+
+        if verbose:
+            print ('-----------------------')
+            print ('start (seconds)', start_index)
+            print ('end (seconds)', end_index)
+            print ('hop (seconds)', hop_seconds)
+            print ('windows', number_windows)
+            print()
+
+        print (X_frequences.shape)
+
+        return X_frequences
+
     def butter_lowpass(self, cutoff, nyq_freq, order=4):
         normal_cutoff = float(cutoff) / nyq_freq
         b, a = signal.butter(order, normal_cutoff, btype='lowpass')
         return b, a
 
+    @profiled('filter')
     def butter_lowpass_filter(self, data, cutoff_freq, nyq_freq, order=4):
         # Source: https://github.com/guillaume-chevalier/filtering-stft-and-laplace-transform
         b, a = self.butter_lowpass(cutoff_freq, nyq_freq, order=order)
         y = signal.filtfilt(b, a, data)
-        return y
+        # filtfilt always works in float64
+        return y.astype(policy_dtype(), copy=False)
     
+    @profiled('resample')
     def downsample_file(self, amplitudes, original_sr, new_sample_rate):
         '''
         Downsample an audio file to a given new sample rate.
@@ -112,21 +335,32 @@ class PredictionHelper:
         
         '''
         return librosa.resample(amplitudes, 
-                                original_sr, 
-                                new_sample_rate, 
+                                orig_sr=original_sr, 
+                                target_sr=new_sample_rate, 
                                 res_type='kaiser_fast'), new_sample_rate
 
+    def lowpass_and_downsample(self, amplitudes, original_sr):
+        '''
+        Low pass filter and downsample audio to self.downsample_rate, with
+        the fused polyphase stage of Decimation.decimate by default or the
+        Butterworth filter and kaiser_fast resampler if self.resampler is
+        'kaiser_fast'.
+        '''
+        if self.resampler == 'polyphase':
+            return decimate(amplitudes, original_sr, self.downsample_rate, 
+                            self.lowpass_cutoff), self.downsample_rate
+        filtered = self.butter_lowpass_filter(amplitudes, self.lowpass_cutoff, self.nyquist_rate)
+        filtered, new_sample_rate = self.downsample_file(filtered, original_sr, self.downsample_rate)
+        return enforce_dtype(filtered, 'downsample_file'), new_sample_rate
+
     def convert_single_to_image(self, audio):
         '''
         Convert amplitude values into a mel-spectrogram.
         '''
-        S = librosa.feature.melspectrogram(audio, n_fft=self.n_ftt,hop_length=self.hop_length, 
+        S = librosa.feature.melspectrogram(y=audio, n_fft=self.n_ftt,hop_length=self.hop_length, 
                                            n_mels=self.n_mels, fmin=self.f_min, fmax=self.f_max)
         
         image = librosa.core.power_to_db(S)
-        image_np = np.asmatrix(image)
-        image_np_scaled_temp = (image_np - np.min(image_np))
-        image_np_scaled = image_np_scaled_temp / np.max(image_np_scaled_temp)
         mean = image.flatten().mean()
         std = image.flatten().std()
         eps=1e-8
@@ -139,6 +373,7 @@ class PredictionHelper:
         # 3 different input
         return S1
 
+    @profiled('spectrogram')
     def convert_all_to_image(self, segments):
         '''
         Convert a number of segments into their corresponding spectrograms.
@@ -148,8 +383,133 @@ class PredictionHelper:
             spectrograms.append(self.convert_single_to_image(segment))
         
         
-        return np.array(spectrograms)
+        return enforce_dtype(np.array(spectrograms), 'convert_all_to_image')
     
+    def recording_grid(self, audio, time_to_extract, sampleRate, start_index, end_index,
+        hop_seconds=1):
+        '''
+        Mel energies of a recording on a grid of gcd(hop_length, hop)
+        samples, from which the frames of every window are taken (see
+        convert_recording_to_image). Returns a dictionary of the grid and
+        the layout of the windows on it, or None if the windows are too
+        short for the grid to be used.
+        '''
+        audio = np.ascontiguousarray(audio)
+
+        offset, window_length, hop_samples, number_windows = self.window_layout(len(audio), 
+                                    time_to_extract, sampleRate, start_index, end_index, hop_seconds)
+        audio = audio[offset:]
+
+        n_fft = self.n_ftt
+        hop_length = self.hop_length
+        pad = n_fft // 2
+        number_frames = 1 + window_length // hop_length
+
+        # Frames first_inner..end_inner-1 lie fully inside a window, the
+        # others overlap the padding librosa adds at both ends
+        first_inner = -(-pad // hop_length)
+        end_inner = (window_length - (n_fft - pad)) // hop_length + 1
+
+        if number_windows == 0 or end_inner <= first_inner or window_length < 2 * n_fft:
+            return None
+
+        # Every window starts on a multiple of step samples, so do the frames
+        step = math.gcd(hop_length, hop_samples)
+        stride = hop_length // step
+
+        # Mel energies of grid frame g, centred on sample g * step
+        first_grid = first_inner * stride
+        last_grid = (number_windows - 1) * hop_samples // step + (end_inner - 1) * stride
+        grid_frames = np.lib.stride_tricks.as_strided(audio[first_grid * step - pad:],
+                                    shape=(last_grid - first_grid + 1, n_fft),
+                                    strides=(step * audio.strides[0], audio.strides[0]),
+                                    writeable=False)
+        grid = np.empty((len(grid_frames), self.n_mels), dtype=audio.dtype)
+        for i in range(0, len(grid_frames), 4096):
+            grid[i:i+4096] = self.frames_to_mel(grid_frames[i:i+4096])
+
+        return {'audio': audio, 'window_length': window_length, 'hop_samples': hop_samples,
+                'number_windows': number_windows, 'number_frames': number_frames,
+                'first_inner': first_inner, 'end_inner': end_inner, 'step': step,
+                'stride': stride, 'first_grid': first_grid, 'grid': grid}
+
+    def frames_to_mel(self, frames):
+        # convert_single_to_image does not pass sr, so librosa builds the
+        # filterbank for its default sample rate
+        return frames_to_mel(frames, LIBROSA_DEFAULT_SR, self.n_ftt, self.n_mels, 
+                             self.f_min, self.f_max)
+
+    def window_mel_images(self, grid, windows):
+        '''
+        Mel energies (windows, n_mels, frames) of the windows numbered
+        windows of a recording_grid: the inner frames are slices of the
+        grid, the few frames at either edge are computed per window.
+        '''
+        audio = grid['audio']
+        n_fft = self.n_ftt
+        hop_length = self.hop_length
+        pad = n_fft // 2
+        first_inner = grid['first_inner']
+        end_inner = grid['end_inner']
+        window_length = grid['window_length']
+
+        pad_mode = stft_pad_mode()
+        inner_frames = np.arange(first_inner, end_inner)
+        left_frames = np.arange(0, first_inner)
+        right_frames = np.arange(end_inner, grid['number_frames'])
+        left_length = max((first_inner - 1) * hop_length - pad + n_fft, pad + 1)
+        right_start = min(end_inner * hop_length - pad, window_length - pad - 1)
+
+        window_starts = np.asarray(windows) * grid['hop_samples']
+        images = np.empty((len(window_starts), grid['number_frames'], self.n_mels), dtype=audio.dtype)
+
+        # Inner frames are column slices of the grid
+        images[:, first_inner:end_inner] = grid['grid'][(window_starts // grid['step'])[:,None] 
+                                                        + inner_frames * grid['stride'] - grid['first_grid']]
+
+        # Edge frames, padded the same way librosa pads a single window
+        segments = audio[window_starts[:,None] + np.arange(left_length)]
+        segments = np.pad(segments, ((0,0),(pad,0)), mode=pad_mode)
+        images[:, :first_inner] = self.frames_to_mel(segments[:, left_frames[:,None] * hop_length 
+                                                              + np.arange(n_fft)])
+
+        segments = audio[window_starts[:,None] + np.arange(right_start, window_length)]
+        segments = np.pad(segments, ((0,0),(0,pad)), mode=pad_mode)
+        images[:, end_inner:] = self.frames_to_mel(segments[:, (right_frames * hop_length - pad - right_start)[:,None] 
+                                                            + np.arange(n_fft)])
+
+        return images.transpose(0,2,1)
+
+    @profiled('spectrogram')
+    def convert_recording_to_image(self, audio, time_to_extract, sampleRate, start_index,
+        end_index, hop_seconds=1, chunk_size=256):
+        '''
+        Convert every window of a recording into its spectrogram using a
+        single STFT over the whole recording.
+
+        Equivalent (within float tolerance) to
+        convert_all_to_image(create_X_strided(...)), but the STFT frames are
+        computed once on a grid of gcd(hop_length, hop) samples and each
+        window takes its 188 columns as a slice of that grid. Only the few
+        frames at the edges of a window, which see librosa's padding, are
+        computed per window. chunk_size windows are normalised at a time.
+        '''
+        grid = self.recording_grid(audio, time_to_extract, sampleRate, start_index, end_index, 
+                                   hop_seconds)
+        if grid is None:
+            offset = int(start_index * sampleRate)
+            return self.convert_all_to_image(self.create_X_strided(np.ascontiguousarray(audio)[offset:], 
+                                    time_to_extract, sampleRate, 0, end_index - start_index, hop_seconds))
+
+        number_windows = grid['number_windows']
+        spectrograms = np.empty((number_windows, self.n_mels, grid['number_frames']), dtype=policy_dtype())
+        for start in range(0, number_windows, chunk_size):
+            images = self.window_mel_images(grid, np.arange(start, min(start + chunk_size, number_windows)))
+            spectrograms[start:start + len(images)] = normalise_images(power_to_db(images))
+
+        profiler.count('windows', number_windows)
+        return spectrograms
+
     def add_keras_dim(self, spectrograms):
         spectrograms = np.reshape(spectrograms, 
                                   (spectrograms.shape[0],
@@ -157,17 +517,438 @@ class PredictionHelper:
                                    spectrograms.shape[2],1))
         return spectrograms
     
-    def load_model(self):
+    def load_keras_model(self):
 
         print('Initialising cnn network.')
-        networks = CNNNetwork()
-        model = networks.custom_CNN_network()
+        model = network()
 
         print('Loading weights: ', self.weights_name)
         model.load_weights("{}".format(self.weights_name))
                 
         return model
+
+    def load_binary_model(self):
+
+        print('Initialising binary cnn network.')
+        model = binary_network()
+
+        print('Loading binary weights: ', self.binary_weights_name)
+        model.load_weights("{}".format(self.binary_weights_name))
+
+        return model
+
+    def load_model(self):
+        '''
+        The model to predict with: the Keras model, or the exported model
+        of the selected backend, behind the binary detector if
+        binary_weights_name is set. All have the same predict method.
+        '''
+        if self.backend == 'keras':
+            model = self.load_keras_model()
+        else:
+            print ('Loading {} model: {}'.format(self.backend, self.backend_file))
+            model = load_exported_model(self.backend_file, self.backend_threads)
+
+        if self.binary_weights_name is not None:
+            model = CascadeModel(self.load_binary_model(), model, self.binary_threshold)
+        if self.shared_convolution:
+            model = SharedConvolutionModel(model)
+        return model
+
+    def save_group_labels(self, file_name_no_extension, model_prediction):
+        '''
+        Save the social group label of every second to
+        <file_name>_groups.csv.
+        '''
+        labels = group_labels(model_prediction, self.hop_seconds, self.segment_duration)
+        pd.DataFrame(labels, columns=['Second', 'Group']).to_csv(file_name_no_extension+'_groups.csv', 
+                                                                index=False)
+
+    def testing_file_names(self):
+        '''
+        Paths of the audio files listed in the testing file which exist.
+        '''
+        testing_files = pd.read_csv(self.testing_files, header=None)
+        file_names = [self.audio_path+testing_file[0]+'.wav' for testing_file in testing_files.values]
+        return [file_name for file_name in file_names if os.path.exists(file_name)]
+
+    def export_backend(self, output_file, quantisation=None, calibration_files=None,
+                       calibration_samples=200):
+        '''
+        Export the Keras model with weights weights_name to output_file, an
+        ONNX (.onnx) or TFLite (.tflite) model, optionally quantised:
+        'dynamic' (int8 weights) or 'int8' (int8 weights and activations).
+
+        int8 quantisation is calibrated on up to calibration_samples
+        spectrograms of calibration_files (by default the testing files).
+        '''
+        model = self.load_keras_model()
+
+        calibration_data = None
+        if quantisation == 'int8':
+            if calibration_files is None:
+                calibration_files = self.testing_file_names()
+            spectrograms = [self.load_spectrograms(file_name) for file_name in calibration_files]
+            calibration_data = np.concatenate(spectrograms)
+            rng = np.random.default_rng(0)
+            calibration_data = calibration_data[np.sort(rng.permutation(len(calibration_data))[:calibration_samples])]
+
+        export_model(model, output_file, quantisation, calibration_data)
+
+    def check_backend_agreement(self, file_names=None, min_argmax_agreement=0.99,
+                                max_abs_difference=None, verbose=True):
+        '''
+        Predict file_names (by default the testing files) with both the
+        Keras model and the selected backend, and compare them.
+
+        Returns the agreement (see Inference_Backend.agreement) per file
+        and over all files. Raises AssertionError if fewer than
+        min_argmax_agreement of the segments have the same most likely
+        class, or, if given, the outputs differ by more than
+        max_abs_difference.
+        '''
+        if file_names is None:
+            file_names = self.testing_file_names()
+        keras_model = self.load_keras_model()
+        model = self.load_model()
+
+        report = {'files': {}}
+        reference = []
+        predictions = []
+        for file_name in file_names:
+            spectrograms = self.load_spectrograms(file_name)
+            reference.append(keras_model.predict(spectrograms, batch_size=self.batch_size, verbose=0))
+            predictions.append(model.predict(spectrograms, batch_size=self.batch_size))
+            report['files'][file_name] = agreement(reference[-1], predictions[-1])
+            if verbose:
+                print (file_name, report['files'][file_name])
+
+        report['total'] = agreement(np.concatenate(reference), np.concatenate(predictions))
+        if verbose:
+            print ('{} backend against Keras: {}'.format(self.backend, report['total']))
+
+        assert report['total']['argmax_agreement'] >= min_argmax_agreement, \
+            'The {} backend picks the same class as Keras for only {:.2%} of the segments'.format(
+            self.backend, report['total']['argmax_agreement'])
+        if max_abs_difference is not None:
+            assert report['total']['max_abs_difference'] <= max_abs_difference, \
+                'The {} backend differs from Keras by up to {:.2e}'.format(
+                self.backend, report['total']['max_abs_difference'])
+        return report
     
+    @profiled('save')
+    def save_predictions(self, file_name_no_extension, model_prediction):
+        '''
+        Save the predictions of one file to <file_name>.csv and return its
+        row of the summary: number of segments and the number of segments
+        assigned to each class.
+        '''
+        # Nonny to make modifications around here
+        # Find all predictions which had a softmax value 
+        # greater than some threshold
+        values = model_prediction
+        df = pd.DataFrame(values)
+        df.to_csv(file_name_no_extension+'.csv')
+        if self.binary_weights_name is not None:
+            self.save_group_labels(file_name_no_extension, model_prediction)
+        #print(values[0:100])
+        values_NG = values[:,0] >= 0.5
+        values_B = values[:,1]  >= 0.5
+        values_C = values[:,2]  >= 0.5
+        values_D = values[:,3]  >= 0.5
+        values = values.astype(np.int64)
+        
+        test_file = [file_name_no_extension,len(values_B),sum(values_NG),sum(values_B),sum(values_C),sum(values_D)]
+
+        #print(values)
+
+        return test_file
+
+    def read_and_downsample(self, file_name):
+        '''
+        Read an audio file, low pass filter it and downsample it.
+        '''
+        audio_amps, original_sample_rate = self.read_audio_file(file_name)
+        return self.lowpass_and_downsample(audio_amps, original_sample_rate)
+
+    def convert_file_to_image(self, filtered, filtered_sample_rate):
+        '''
+        Spectrograms of every segment of a downsampled file, ready for the model.
+        '''
+        spectrograms = self.convert_recording_to_image(filtered, self.segment_duration, 
+                                filtered_sample_rate,0, int(len(filtered)/filtered_sample_rate), 
+                                self.hop_seconds, self.chunk_size)
+        return self.add_keras_dim(spectrograms)
+
+    def memory_stage(self, name):
+        '''
+        Context manager accounting the peak memory of a stage against the
+        memory budget, if there is one.
+        '''
+        if self.governor is None:
+            return contextlib.nullcontext()
+        return self.governor.stage(name)
+
+    def plan_memory(self, file_name, model):
+        '''
+        Choose the block length, batch size and chunk size for file_name
+        which keep within the memory budget, and return the block length
+        to use (None for the whole file). Raises MemoryError if the file
+        cannot fit.
+        '''
+        if self.governor is None:
+            return self.block_duration
+
+        plan = self.governor.plan_prediction(self, file_name, model)
+        print ('Memory plan:', plan)
+        # The tuned batch size, unless it does not fit
+        self.batch_size = plan['batch_size']
+        if self.tuned is not None:
+            self.batch_size = min(self.batch_size, self.tuned['batch_size'])
+        self.chunk_size = plan['chunk_size']
+        if plan['block_duration'] is None:
+            return self.block_duration
+        if self.block_duration is None:
+            return plan['block_duration']
+        return min(self.block_duration, plan['block_duration'])
+
+    def predict_file_prefiltered(self, model, file_name):
+        '''
+        Predict every segment of an audio file, but compute spectrograms
+        and run the model only for the windows the prefilter keeps. The
+        others get the prefilter's skipped score. Returns the predictions
+        and which windows were kept.
+        '''
+        print ('Reading audio file, applying filter and downsampling')
+        filtered, sample_rate = self.read_and_downsample(file_name)
+        end_index = int(len(filtered)/sample_rate)
+        _, _, _, number_windows = self.window_layout(len(filtered), self.segment_duration, 
+                                                     sample_rate, 0, end_index, self.hop_seconds)
+
+        with profiler.stage('prefilter'):
+            scores = self.prefilter.window_scores(filtered, sample_rate, self.segment_duration,
+                                                  self.hop_seconds, number_windows)
+            keep = self.prefilter.keep(scores)
+        counts = self.prefilter.record(file_name[:file_name.rfind('.')], scores, keep, 
+                                       self.segment_duration, self.hop_seconds)
+        print ('Prefilter:', counts)
+
+        predictions = np.tile(self.prefilter.skipped_score, (number_windows, 1))
+        # Runs of consecutive kept windows, each converted with one STFT
+        edges = np.diff(np.concatenate([[0], keep.astype(np.int8), [0]]))
+        for start, end in zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)):
+            spectrograms = self.convert_recording_to_image(filtered, self.segment_duration, sample_rate,
+                                    start * self.hop_seconds, 
+                                    (end - 1) * self.hop_seconds + self.segment_duration,
+                                    self.hop_seconds, self.chunk_size)
+            with profiler.stage('inference'):
+                predictions[start:end] = model.predict(self.add_keras_dim(spectrograms), 
+                                                       batch_size=self.batch_size)
+        return predictions, keep
+
+    def tune_prefilter(self, file_names=None, thresholds=np.arange(-3, 10.5, 0.5)):
+        '''
+        Skip rate and recall loss of the prefilter at each threshold over
+        file_names (by default the testing files) which have call labels,
+        without computing any spectrogram or running the model.
+        '''
+        if file_names is None:
+            file_names = self.testing_file_names()
+
+        all_scores = []
+        all_calls = []
+        for file_name in file_names:
+            filtered, sample_rate = self.read_and_downsample(file_name)
+            _, _, _, number_windows = self.window_layout(len(filtered), self.segment_duration, 
+                                        sample_rate, 0, int(len(filtered)/sample_rate), self.hop_seconds)
+            calls = self.prefilter.call_windows_of(file_name[:file_name.rfind('.')], number_windows,
+                                                   self.segment_duration, self.hop_seconds)
+            if calls is None:
+                continue
+            all_scores.append(self.prefilter.window_scores(filtered, sample_rate, self.segment_duration,
+                                                           self.hop_seconds, number_windows))
+            all_calls.append(calls)
+
+        if not all_scores:
+            raise ValueError('None of the files has call labels in {}'.format(self.prefilter.label_directory))
+        return self.prefilter.sweep(np.concatenate(all_scores), np.concatenate(all_calls), thresholds)
+
+    def feature_parameters(self):
+        '''
+        Every setting the spectrograms of a file depend on, used as part of
+        the feature cache key.
+        '''
+        return {'lowpass_cutoff': self.lowpass_cutoff,
+                'nyquist_rate': self.nyquist_rate,
+                'downsample_rate': self.downsample_rate,
+                'resampler': self.resampler,
+                'n_fft': self.n_ftt,
+                'hop_length': self.hop_length,
+                'n_mels': self.n_mels,
+                'f_min': self.f_min,
+                'f_max': self.f_max,
+                'segment_duration': self.segment_duration,
+                'hop_seconds': self.hop_seconds,
+                'pad_mode': stft_pad_mode(),
+                'dtype': policy_dtype().name}
+
+    def load_spectrograms(self, file_name):
+        '''
+        Spectrograms of every segment of an audio file, ready for the model.
+        Taken from the feature cache when one is set and it holds them.
+        '''
+        if self.feature_cache is not None:
+            key = self.feature_cache.key(file_name, self.feature_parameters())
+            spectrograms = self.feature_cache.get(key)
+            if spectrograms is not None:
+                print ('Spectrograms read from the feature cache')
+                return spectrograms
+
+        print ('Reading audio file, applying filter and downsampling')
+        filtered, filtered_sample_rate = self.read_and_downsample(file_name)
+
+        print ('Converting to spectrogram')
+        # Spectrograms of every segment, from one STFT of the whole file
+        spectrograms = self.convert_file_to_image(filtered, filtered_sample_rate)
+
+        if self.feature_cache is not None:
+            self.feature_cache.put(key, spectrograms)
+
+        return spectrograms
+
+    def predict_all_test_files_pipelined(self, verbose, decode_workers=2, feature_workers=2,
+                                         batch_size=None, max_pending=4):
+        '''
+        Same output as predict_all_test_files, but the stages run as a 
+        pipeline over many files at once:
+
+        - decode, filter and downsample in a pool of decode_workers threads,
+        - spectrograms in a pool of feature_workers processes,
+        - model.predict in this process, batch_size segments at a time
+          (by default self.batch_size, the autotuned batch size if any).
+
+        The prefilter and shared_convolution do not apply here: every
+        window is converted to a spectrogram in the feature workers and
+        predicted by the whole model. Use predict_all_test_files for them.
+
+        At most max_pending files are between reading and prediction at 
+        any time, which bounds the memory held in the queues. Files are
+        scheduled longest first so that a long recording started last does
+        not leave the other workers idle at the end.
+        '''
+        
+        if verbose == True:
+            print ('Annotations path:',self.annotations_path+"*.svl")
+            print ('Audio path',self.audio_path+"*.wav")
+
+        if batch_size is None:
+            batch_size = self.batch_size
+        if self.prefilter is not None or self.shared_convolution:
+            print ('The pipelined prediction ignores the prefilter and shared_convolution')
+        
+        # Read all names of the testing files
+        testing_files = pd.read_csv(self.testing_files, header=None)
+
+        file_names = []
+        for testing_file in testing_files.values:
+            file = self.annotations_path+'/'+testing_file[0]+'.svl'
+            file_names.append(file[file.rfind('/')+1:file.find('.')])
+
+        # Check if the .wav files exist before processing
+        to_process = [file_name for file_name in file_names 
+                      if os.path.exists(self.audio_path+file_name+'.wav')]
+
+        # Longest first
+        to_process.sort(key=lambda file_name: sf.info(self.audio_path+file_name+'.wav').duration, 
+                        reverse=True)
+        to_process = collections.deque(to_process)
+
+        if self.governor is not None:
+            # Every file between reading and prediction holds its audio or
+            # spectrograms, and every feature worker is a process of its own
+            longest = sf.info(self.audio_path+to_process[0]+'.wav') if to_process else None
+            if longest is not None:
+                needed = self.governor.prediction_memory(self, longest.duration, longest.samplerate,
+                                                         None, batch_size, self.chunk_size, 0)
+                max_pending = self.governor.plan_workers(needed, max_pending, 'files in the pipeline')
+                feature_workers = self.governor.plan_workers(needed + WORKER_PROCESS_BYTES, 
+                                                             min(feature_workers, max_pending),
+                                                             'feature workers')
+                decode_workers = min(decode_workers, max_pending)
+                print ('Memory plan: {} files in the pipeline, {} decode and {} feature workers'.format(
+                       max_pending, decode_workers, feature_workers))
+
+        # Start the worker processes before TensorFlow sets up its threads
+        decode_pool = concurrent.futures.ThreadPoolExecutor(decode_workers)
+        feature_pool = concurrent.futures.ProcessPoolExecutor(feature_workers,
+                                    mp_context=multiprocessing.get_context('spawn'))
+
+        # Load the correct model
+        model = self.load_model()
+
+        decoding = {}
+        converting = {}
+        results = {}
+        try:
+            while to_process or decoding or converting:
+
+                # Keep the pipeline full, up to max_pending files
+                while to_process and len(decoding) + len(converting) < max_pending:
+                    file_name = to_process.popleft()
+
+                    if self.feature_cache is not None:
+                        key = self.feature_cache.key(self.audio_path+file_name+'.wav', 
+                                                     self.feature_parameters())
+                        spectrograms = self.feature_cache.get(key)
+                        if spectrograms is not None:
+                            print ('Predicting from the feature cache:', file_name)
+                            with profiler.stage('inference', file_name):
+                                model_prediction = model.predict(spectrograms, batch_size=batch_size)
+                            results[file_name] = self.save_predictions(file_name, model_prediction)
+                            continue
+
+                    print ('Reading:', file_name)
+                    decoding[decode_pool.submit(self.read_and_downsample, 
+                                                self.audio_path+file_name+'.wav')] = file_name
+
+                if not decoding and not converting:
+                    continue
+
+                done, _ = concurrent.futures.wait(list(decoding) + list(converting), 
+                                                  return_when=concurrent.futures.FIRST_COMPLETED)
+
+                for future in done:
+                    if future in decoding:
+                        file_name = decoding.pop(future)
+                        filtered, filtered_sample_rate = future.result()
+                        print ('Converting to spectrogram:', file_name)
+                        converting[feature_pool.submit(self.convert_file_to_image, 
+                                                       filtered, filtered_sample_rate)] = file_name
+                    else:
+                        file_name = converting.pop(future)
+                        spectrograms = future.result()
+                        if self.feature_cache is not None:
+                            self.feature_cache.put(self.feature_cache.key(self.audio_path+file_name+'.wav', 
+                                                   self.feature_parameters()), spectrograms)
+
+                        print ('Predicting:', file_name)
+                        with profiler.stage('inference', file_name):
+                            model_prediction = model.predict(spectrograms, batch_size=batch_size)
+                        results[file_name] = self.save_predictions(file_name, model_prediction)
+        finally:
+            decode_pool.shutdown(cancel_futures=True)
+            feature_pool.shutdown(cancel_futures=True)
+
+        # Summary in the order of the testing file
+        Test_files = [results[file_name] for file_name in file_names if file_name in results]
+        pd.DataFrame(Test_files).to_csv('Test Files.csv')
+
+        if self.feature_cache is not None:
+            print ('Feature cache:', self.feature_cache.stats())
+        if isinstance(model, CascadeModel):
+            print ('Cascade:', model.stats())
+        return
+
     def predict_all_test_files(self, verbose):
         '''
         Create X and Y values which are inputs to a ML algorithm.
@@ -211,53 +992,60 @@ class PredictionHelper:
             print ('Processing:',file_name_no_extension)
             
             df_data_file_name.append(file_name_no_extension)
+            profiler.set_file(file_name_no_extension)
             
             # Check if the .wav file exists before processing
             if "Raw_Data/Test"+"\\"+file_name_no_extension+".wav" in glob.glob(self.audio_path+"*.wav"):
 
-                # Read audio file
-                audio_amps, original_sample_rate = self.read_audio_file(self.audio_path+file_name_no_extension+'.wav')
-                    
-                print ('Applying filter')
-                # Low pass filter
-                filtered = self.butter_lowpass_filter(audio_amps, self.lowpass_cutoff, self.nyquist_rate)
-
-                print ('Downsample')
-                # Downsample
-                filtered, filtered_sample_rate = self.downsample_file(filtered, 
-                                                                      original_sample_rate, self.downsample_rate)
-
-                print ('Creating segments')
-                # Split the file into segments for prediction
-                segments = self.create_X_new(filtered, self.segment_duration, 
-                                        filtered_sample_rate,0, int(len(filtered)/filtered_sample_rate), file_name_no_extension, False)
-                print ('Converting to spectrogram')
-                spectrograms = self.convert_all_to_image(segments)
-                plt.imshow((spectrograms[12]))
-                print ('Predicting')
-                spectrograms = self.add_keras_dim(spectrograms)
-                model_prediction = model.predict(spectrograms)
-                # Nonny to make modifications around here
-                # Find all predictions which had a softmax value 
-                # greater than some threshold
-                values = model_prediction
-                df = pd.DataFrame(values)
-                df.to_csv(file_name_no_extension+'.csv')
-                #print(values[0:100])
-                values_NG = values[:,0] >= 0.5
-                values_B = values[:,1]  >= 0.5
-                values_C = values[:,2]  >= 0.5
-                values_D = values[:,3]  >= 0.5
-                values = values.astype(np.int)
-                
-                test_file = [file_name_no_extension,len(values_B),sum(values_NG),sum(values_B),sum(values_C),sum(values_D)]
-                Test_files.append(test_file)
+                block_duration = self.plan_memory(self.audio_path+file_name_no_extension+'.wav', model)
+                if block_duration is not None and (self.prefilter is not None or self.shared_convolution):
+                    # Only the memory plan can get here, see __init__
+                    print ('Warning: the file only fits in memory in blocks of {} s, so the prefilter '
+                           'and shared_convolution are not used for it'.format(block_duration))
+
+                if self.prefilter is not None and block_duration is None:
+                    print ('Predicting the windows kept by the prefilter')
+                    model_prediction, _ = self.predict_file_prefiltered(model, 
+                                                self.audio_path+file_name_no_extension+'.wav')
+                elif self.shared_convolution and block_duration is None:
+                    print ('Predicting with the first convolution shared across windows')
+                    with self.memory_stage('shared_convolution'):
+                        filtered, filtered_sample_rate = self.read_and_downsample(
+                                                self.audio_path+file_name_no_extension+'.wav')
+                        model_prediction = model.predict_recording(self, filtered, filtered_sample_rate,
+                                                                   self.chunk_size, self.batch_size)
+                elif block_duration is None:
+                    with self.memory_stage('spectrograms'):
+                        spectrograms = self.load_spectrograms(self.audio_path+file_name_no_extension+'.wav')
+                    plt.imshow((spectrograms[12,:,:,0]))
+                    print ('Predicting')
+                    with profiler.stage('inference'), self.memory_stage('inference'):
+                        model_prediction = model.predict(spectrograms, batch_size=self.batch_size)
 
-                #print(values)
+                    # Clean up
+                    del spectrograms
+                else:
+                    print ('Predicting block by block')
+                    # Bounded memory: read, filter, downsample and predict
+                    # block_duration seconds at a time
+                    with self.memory_stage('streaming'):
+                        model_prediction = self.predict_file_streaming(model, 
+                                                self.audio_path+file_name_no_extension+'.wav', 
+                                                block_duration)
+
+                test_file = self.save_predictions(file_name_no_extension, model_prediction)
+                Test_files.append(test_file)
 
-                # Clean up
-                del spectrograms, filtered, audio_amps
                 gc.collect()
                 gc.collect()
         pd.DataFrame(Test_files).to_csv('Test Files.csv')
+
+        if self.feature_cache is not None:
+            print ('Feature cache:', self.feature_cache.stats())
+        if isinstance(model, CascadeModel):
+            print ('Cascade:', model.stats())
+        if self.governor is not None:
+            print ('Peak memory per stage (MB):', self.governor.report())
+        if self.prefilter is not None:
+            print ('Prefilter:', self.prefilter.report())
         return
\ No newline at end of file
@@ -0,0 +1,423 @@
+'''
+A long running prediction service which keeps the model loaded, so that
+submitting a recording costs only its own feature extraction and inference.
+
+    python Prediction_Service.py --weights weights_model5_2022.hdf5 --port 8765
+    python Prediction_Service.py --weights weights_model5_2022.hdf5 --unix-socket /tmp/gibbon.sock
+
+Requests, as JSON over HTTP (on localhost or a Unix socket):
+
+    POST /predict  {"file": "Raw_Data/Test/recording.wav", "save": false}
+    GET  /stats    queue depth, batch sizes and latencies
+    GET  /health
+
+The spectrograms of concurrent requests are computed in parallel, one
+thread per request, and their windows are merged into batches of up to
+max_batch_size for the model. A batch is run once it is full or its oldest
+window has waited max_latency seconds.
+'''
+import argparse
+import collections
+import concurrent.futures
+import http.client
+import http.server
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+
+import numpy as np
+
+from PredictionHelper import PredictionHelper
+from Feature_Cache import FeatureCache
+
+
+class PendingRequest:
+    '''
+    The spectrograms of one request and its predictions, filled in as the
+    batches holding its windows are run.
+    '''
+
+    def __init__(self, spectrograms, number_parts):
+        self.spectrograms = spectrograms
+        self.predictions = None
+        self.remaining = number_parts
+        self.future = concurrent.futures.Future()
+        self.submitted = time.perf_counter()
+
+
+class MicroBatcher:
+    '''
+    Runs model on the windows of many requests at once.
+
+    submit() splits the spectrograms of a request into parts of at most
+    max_batch_size windows and queues them. A single thread takes parts
+    off the queue and runs the model on them together, as soon as the batch
+    has max_batch_size windows or the first part of it has waited
+    max_latency seconds. Windows are predicted independently, so the
+    predictions do not depend on which batch a window ends up in.
+
+    predict() has the signature of the Keras predict method, so a
+    MicroBatcher can stand in for the model, e.g. in
+    PredictionHelper.predict_file_streaming.
+    '''
+
+    def __init__(self, model, max_batch_size=256, max_latency=0.05):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.reset_stats()
+        self.thread = threading.Thread(target=self.run, name='micro-batcher', daemon=True)
+        self.thread.start()
+
+    def reset_stats(self):
+        with self.lock:
+            self.queued_windows = 0
+            self.pending_requests = 0
+            self.requests = 0
+            self.windows = 0
+            self.batches = 0
+            self.batch_sizes = collections.Counter()
+            self.inference_seconds = 0.0
+            self.latency_seconds = 0.0
+            self.max_latency_seconds = 0.0
+
+    def submit(self, spectrograms):
+        '''
+        Queue the spectrograms (windows, 128, 188, 1) of a request. Returns a
+        Future of their predictions.
+        '''
+        spectrograms = np.asarray(spectrograms)
+        starts = range(0, len(spectrograms), self.max_batch_size)
+        request = PendingRequest(spectrograms, len(starts))
+        with self.lock:
+            self.requests = self.requests + 1
+            self.pending_requests = self.pending_requests + 1
+            self.queued_windows = self.queued_windows + len(spectrograms)
+
+        if len(spectrograms) == 0:
+            self.finish(request, np.zeros((0, 0), dtype=np.float32))
+        for start in starts:
+            self.queue.put((request, start, min(start + self.max_batch_size, len(spectrograms)),
+                            time.perf_counter()))
+        return request.future
+
+    def predict(self, spectrograms, batch_size=None, verbose=None):
+        return self.submit(spectrograms).result()
+
+    def finish(self, request, predictions):
+        latency = time.perf_counter() - request.submitted
+        with self.lock:
+            self.pending_requests = self.pending_requests - 1
+            self.latency_seconds = self.latency_seconds + latency
+            self.max_latency_seconds = max(self.max_latency_seconds, latency)
+        request.future.set_result(predictions)
+
+    def next_batch(self, carried):
+        '''
+        Parts making up the next batch, and the part taken off the queue
+        which did not fit in it (or None). None if the batcher was closed.
+        '''
+        part = carried if carried is not None else self.queue.get()
+        if part is None:
+            return None, None
+
+        parts = [part]
+        size = part[2] - part[1]
+        deadline = part[3] + self.max_latency
+        while size < self.max_batch_size:
+            try:
+                part = self.queue.get(timeout=max(deadline - time.perf_counter(), 0))
+            except queue.Empty:
+                break
+            if part is None:
+                # Run what is collected, then stop
+                return parts, None
+            if size + part[2] - part[1] > self.max_batch_size:
+                return parts, part
+            parts.append(part)
+            size = size + part[2] - part[1]
+        return parts, None
+
+    def run(self):
+        carried = None
+        while True:
+            parts, carried = self.next_batch(carried)
+            if parts is None:
+                return
+            self.run_batch(parts)
+
+    def run_batch(self, parts):
+        batch = np.concatenate([request.spectrograms[start:end] for request, start, end, _ in parts])
+        with self.lock:
+            self.queued_windows = self.queued_windows - len(batch)
+
+        try:
+            start_time = time.perf_counter()
+            predictions = self.model.predict(batch, batch_size=len(batch), verbose=0)
+            seconds = time.perf_counter() - start_time
+        except Exception as error:
+            for request, _, _, _ in parts:
+                if not request.future.done():
+                    with self.lock:
+                        self.pending_requests = self.pending_requests - 1
+                    request.future.set_exception(error)
+            return
+
+        with self.lock:
+            self.batches = self.batches + 1
+            self.windows = self.windows + len(batch)
+            self.batch_sizes[len(batch)] += 1
+            self.inference_seconds = self.inference_seconds + seconds
+
+        offset = 0
+        for request, start, end, _ in parts:
+            if request.future.done():
+                # An earlier part of this request failed
+                offset = offset + end - start
+                continue
+            if request.predictions is None:
+                request.predictions = np.empty((len(request.spectrograms),) + predictions.shape[1:],
+                                               dtype=predictions.dtype)
+            request.predictions[start:end] = predictions[offset:offset + end - start]
+            offset = offset + end - start
+            request.remaining = request.remaining - 1
+            if request.remaining == 0:
+                self.finish(request, request.predictions)
+
+    def stats(self):
+        '''
+        Queue depth (windows and requests waiting), number of requests,
+        windows and batches so far, the batch size distribution, and
+        inference time and request latency.
+        '''
+        with self.lock:
+            completed = self.requests - self.pending_requests
+            return {'queue_depth_windows': self.queued_windows,
+                    'queue_depth_requests': self.pending_requests,
+                    'requests': self.requests,
+                    'windows': self.windows,
+                    'batches': self.batches,
+                    'mean_batch_size': self.windows / self.batches if self.batches > 0 else 0.0,
+                    'batch_sizes': {str(size): count for size, count in sorted(self.batch_sizes.items())},
+                    'max_batch_size': self.max_batch_size,
+                    'max_latency': self.max_latency,
+                    'inference_seconds': self.inference_seconds,
+                    'mean_request_seconds': self.latency_seconds / completed if completed > 0 else 0.0,
+                    'max_request_seconds': self.max_latency_seconds}
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+class PredictionService:
+    '''
+    The model of a PredictionHelper, loaded once and shared by every request
+    through a MicroBatcher. predict_file gives the same predictions for a
+    recording as predict_all_test_files.
+    '''
+
+    def __init__(self, helper, max_batch_size=256, max_latency=0.05):
+        self.helper = helper
+        self.model = helper.load_model()
+        self.batcher = MicroBatcher(self.model, max_batch_size, max_latency)
+        self.started = time.time()
+
+    def predict_file(self, file_name, save=False):
+        '''
+        Predictions (windows, classes) of the recording file_name, and its
+        row of the summary if save is True, when they are also saved to
+        <file_name without extension>.csv.
+        '''
+        if self.helper.block_duration is None:
+            spectrograms = self.helper.load_spectrograms(file_name)
+            predictions = self.batcher.submit(spectrograms).result()
+        else:
+            predictions = self.helper.predict_file_streaming(self.batcher, file_name,
+                                                             self.helper.block_duration)
+
+        summary = None
+        if save:
+            summary = self.helper.save_predictions(os.path.splitext(file_name)[0], predictions)
+        return predictions, summary
+
+    def stats(self):
+        stats = self.batcher.stats()
+        stats['uptime_seconds'] = time.time() - self.started
+        stats['backend'] = self.helper.backend
+        if self.helper.feature_cache is not None:
+            stats['feature_cache'] = self.helper.feature_cache.stats()
+        return stats
+
+    def close(self):
+        self.batcher.close()
+
+
+class ServiceHandler(http.server.BaseHTTPRequestHandler):
+    '''
+    HTTP requests to a PredictionService, server.service.
+    '''
+
+    def send_json(self, status, content):
+        body = json.dumps(content, default=lambda value: value.tolist()
+                          if isinstance(value, np.ndarray) else int(value)).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self.send_json(200, self.server.service.stats())
+        elif self.path == '/health':
+            self.send_json(200, {'status': 'ok'})
+        else:
+            self.send_json(404, {'error': 'Unknown path {}'.format(self.path)})
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self.send_json(404, {'error': 'Unknown path {}'.format(self.path)})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            file_name = request['file']
+        except (ValueError, KeyError, TypeError):
+            self.send_json(400, {'error': 'Expected a JSON body {"file": <path of a recording>}'})
+            return
+        if not os.path.exists(file_name):
+            self.send_json(404, {'error': 'No such file: {}'.format(file_name)})
+            return
+
+        start = time.perf_counter()
+        try:
+            predictions, summary = self.server.service.predict_file(file_name, request.get('save', False))
+        except Exception as error:
+            self.send_json(500, {'error': '{}: {}'.format(type(error).__name__, error)})
+            return
+        self.send_json(200, {'file': file_name,
+                             'segments': len(predictions),
+                             'seconds': time.perf_counter() - start,
+                             'predictions': predictions,
+                             'summary': summary})
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return str(self.client_address[0]) if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            http.server.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(service, host='127.0.0.1', port=8765, unix_socket=None, verbose=False):
+    '''
+    HTTP server for service on host:port, or on the Unix socket unix_socket
+    if given. Call serve_forever() on it to start serving.
+    '''
+    if unix_socket is not None:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = ThreadingUnixHTTPServer(unix_socket, ServiceHandler)
+    else:
+        server = http.server.ThreadingHTTPServer((host, port), ServiceHandler)
+    server.service = service
+    server.verbose = verbose
+    return server
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, unix_socket, timeout=None):
+        http.client.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.unix_socket = unix_socket
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_socket)
+
+
+class ServiceClient:
+    '''
+    Client of a running prediction service.
+    '''
+
+    def __init__(self, host='127.0.0.1', port=8765, unix_socket=None, timeout=None):
+        self.host = host
+        self.port = port
+        self.unix_socket = unix_socket
+        self.timeout = timeout
+
+    def request(self, method, path, content=None):
+        if self.unix_socket is not None:
+            connection = UnixHTTPConnection(self.unix_socket, self.timeout)
+        else:
+            connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            body = json.dumps(content) if content is not None else None
+            connection.request(method, path, body, {'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            result = json.loads(response.read())
+        finally:
+            connection.close()
+        if response.status != 200:
+            raise RuntimeError('Prediction service: {}'.format(result.get('error', response.status)))
+        return result
+
+    def predict(self, file_name, save=False):
+        '''
+        Predictions (windows, classes) of the recording file_name, a path
+        as seen by the service.
+        '''
+        result = self.request('POST', '/predict', {'file': os.path.abspath(file_name), 'save': save})
+        return np.array(result['predictions'], dtype=np.float32).reshape(result['segments'], -1)
+
+    def stats(self):
+        return self.request('GET', '/stats')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve predictions with a model kept in memory.')
+    parser.add_argument('--weights', default='weights_model5_2022.hdf5')
+    parser.add_argument('--backend', default='keras', choices=['keras', 'onnx', 'tflite'])
+    parser.add_argument('--backend-file', help='exported .onnx or .tflite model')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix-socket', help='serve on this Unix socket instead of host:port')
+    parser.add_argument('--max-batch-size', type=int, default=256)
+    parser.add_argument('--max-latency', type=float, default=0.05,
+                        help='longest a window waits for its batch to fill, in seconds')
+    parser.add_argument('--block-duration', type=int,
+                        help='predict recordings block by block, this many (whole) seconds at a time')
+    parser.add_argument('--feature-cache', help='directory of the spectrogram cache')
+    parser.add_argument('--verbose', action='store_true')
+    arguments = parser.parse_args()
+
+    # Same settings as Prediction.ipynb
+    helper = PredictionHelper('Raw_Data/Test', 2000, 4800, 2400, 10, 1024, 256, 128, 4000, 9000,
+                              arguments.weights, block_duration=arguments.block_duration,
+                              feature_cache=FeatureCache(arguments.feature_cache)
+                              if arguments.feature_cache else None,
+                              backend=arguments.backend, backend_file=arguments.backend_file)
+    service = PredictionService(helper, arguments.max_batch_size, arguments.max_latency)
+    server = make_server(service, arguments.host, arguments.port, arguments.unix_socket, arguments.verbose)
+    print ('Serving predictions on', arguments.unix_socket or '{}:{}'.format(arguments.host, arguments.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
@@ -0,0 +1,82 @@
+import hashlib
+import json
+import os
+from os import path
+
+
+def parameter_fingerprint(parameters):
+    ''' SHA-256 of a dictionary of preprocessing parameters. '''
+    return hashlib.sha256(json.dumps(parameters, sort_keys=True).encode()).hexdigest()
+
+
+class PreprocessingManifest:
+    '''
+    Records, for every preprocessed recording, the hashes of its audio and
+    label files, the fingerprint of the parameters used and the output
+    files written. A recording whose inputs, parameters and outputs are
+    unchanged does not need to be processed again.
+
+    The manifest is saved as JSON after every update, so an interrupted
+    run keeps the recordings it finished.
+    '''
+
+    def __init__(self, manifest_file):
+        self.manifest_file = manifest_file
+        if path.exists(manifest_file):
+            with open(manifest_file) as fp:
+                self.records = json.load(fp)
+        else:
+            self.records = {}
+
+    def file_hash(self, file_name):
+        '''
+        SHA-256 of a file. The hash stored in the manifest is reused while
+        the file's size and modification time are unchanged.
+        '''
+        stat = os.stat(file_name)
+        for record in self.records.values():
+            known = record.get('inputs', {}).get(file_name)
+            if known is not None and known['size'] == stat.st_size and known['mtime'] == stat.st_mtime:
+                return known
+
+        sha256 = hashlib.sha256()
+        with open(file_name, 'rb') as fp:
+            for block in iter(lambda: fp.read(1024 * 1024), b''):
+                sha256.update(block)
+        return {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha256': sha256.hexdigest()}
+
+    def describe(self, input_files, parameters, output_files):
+        '''
+        Manifest record for a recording with the given input files,
+        parameters and output files.
+        '''
+        return {'inputs': {file_name: self.file_hash(file_name) for file_name in input_files},
+                'parameters': parameter_fingerprint(parameters),
+                'outputs': list(output_files)}
+
+    def is_up_to_date(self, recording, record):
+        '''
+        True if recording was processed from the same inputs with the same
+        parameters and all of its outputs still exist.
+        '''
+        known = self.records.get(recording)
+        if known is None or known['parameters'] != record['parameters']:
+            return False
+        if known['outputs'] != record['outputs']:
+            return False
+        if set(known['inputs']) != set(record['inputs']):
+            return False
+        for file_name, description in record['inputs'].items():
+            if known['inputs'][file_name]['sha256'] != description['sha256']:
+                return False
+        return all(path.exists(output) for output in record['outputs'])
+
+    def update(self, recording, record):
+        '''
+        Store the record of a processed recording and save the manifest.
+        '''
+        self.records[recording] = record
+        temporary_file = self.manifest_file + '.tmp'
+        with open(temporary_file, 'w') as fp:
+            json.dump(self.records, fp, indent=1)
+        os.replace(temporary_file, self.manifest_file)
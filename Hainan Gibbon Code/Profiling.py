@@ -0,0 +1,189 @@
+import cProfile
+import collections
+import contextlib
+import csv
+import functools
+import json
+import pstats
+import threading
+import time
+
+
+class StageTimer:
+    '''
+    Context manager timing one run of a stage, see Profiler.stage.
+    '''
+
+    def __init__(self, profiler, name, file_name):
+        self.profiler = profiler
+        self.name = name
+        self.file_name = file_name
+
+    def __enter__(self):
+        local = self.profiler.local
+        if self.file_name is None:
+            self.file_name = getattr(local, 'file_name', None)
+        local.active = getattr(local, 'active', ()) + (self.name,)
+        if self.name == self.profiler.profile_stage:
+            self.profiler.profile.enable()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self.start
+        if self.name == self.profiler.profile_stage:
+            self.profiler.profile.disable()
+        self.profiler.local.active = self.profiler.local.active[:-1]
+        self.profiler.add_time(self.name, self.file_name, seconds)
+        return False
+
+
+class Profiler:
+    '''
+    Timers and counters per pipeline stage and per file.
+
+    Disabled by default, when every hook returns straight away. enable()
+    starts collecting; stages are timed with the profiled decorator or
+    the stage() context manager, and attributed to the file set with
+    set_file(). save_report() writes the totals as JSON or CSV.
+
+    One stage, e.g. 'spectrogram', can also be run under cProfile; its
+    statistics are saved next to the report.
+
+    Stages run in worker threads are collected too. Stages run in worker
+    processes (the feature workers of predict_all_test_files_pipelined,
+    execute_preprocessing_all_files_parallel) are not.
+    '''
+
+    def __init__(self):
+        self.enabled = False
+        self.profile_stage = None
+        self.profile = None
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        # (stage, file) -> [calls, seconds]
+        self.timings = collections.defaultdict(lambda: [0, 0.0])
+        # (counter, file) -> total
+        self.counters = collections.defaultdict(float)
+        self.start_time = time.time()
+
+    def enable(self, profile_stage=None):
+        '''
+        Start collecting, from scratch. If profile_stage is given, that
+        stage also runs under cProfile.
+        '''
+        self.reset()
+        self.profile_stage = profile_stage
+        self.profile = cProfile.Profile() if profile_stage is not None else None
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def set_file(self, file_name):
+        ''' File the stages run from now on in this thread belong to. '''
+        self.local.file_name = file_name
+
+    def stage(self, name, file_name=None):
+        '''
+        Context manager timing the code it wraps as a run of stage name.
+        A stage run inside another run of the same stage is not counted
+        twice.
+        '''
+        if not self.enabled or name in getattr(self.local, 'active', ()):
+            return contextlib.nullcontext()
+        return StageTimer(self, name, file_name)
+
+    def add_time(self, name, file_name, seconds):
+        with self.lock:
+            timing = self.timings[(name, file_name)]
+            timing[0] = timing[0] + 1
+            timing[1] = timing[1] + seconds
+
+    def count(self, name, value=1, file_name=None):
+        ''' Add value to counter name, e.g. the number of windows. '''
+        if not self.enabled:
+            return
+        if file_name is None:
+            file_name = getattr(self.local, 'file_name', None)
+        with self.lock:
+            self.counters[(name, file_name)] += value
+
+    def report(self):
+        '''
+        Per stage and per file timings, the same summed over all files,
+        and the counters.
+        '''
+        with self.lock:
+            timings = dict(self.timings)
+            counters = dict(self.counters)
+
+        stages = []
+        totals = collections.defaultdict(lambda: [0, 0.0])
+        for (name, file_name), (calls, seconds) in sorted(timings.items(), key=lambda item: str(item[0])):
+            stages.append({'stage': name, 'file': file_name, 'calls': calls,
+                           'seconds': seconds, 'mean_seconds': seconds / calls})
+            totals[name][0] += calls
+            totals[name][1] += seconds
+
+        return {'wall_seconds': time.time() - self.start_time,
+                'totals': [{'stage': name, 'calls': calls, 'seconds': seconds,
+                            'mean_seconds': seconds / calls}
+                           for name, (calls, seconds) in sorted(totals.items(), key=lambda item: -item[1][1])],
+                'stages': stages,
+                'counters': [{'counter': name, 'file': file_name, 'value': value}
+                             for (name, file_name), value in sorted(counters.items(), key=lambda item: str(item[0]))]}
+
+    def save_report(self, file_name='profile_report.json'):
+        '''
+        Save the report as JSON, or as CSV if file_name ends with .csv, and
+        print the totals. The cProfile statistics of the profiled stage, if
+        any, are saved to <file_name>.prof.
+        '''
+        report = self.report()
+        if file_name.endswith('.csv'):
+            with open(file_name, 'w', newline='') as fp:
+                writer = csv.writer(fp)
+                writer.writerow(['kind', 'stage', 'file', 'calls', 'seconds', 'value'])
+                for row in report['totals']:
+                    writer.writerow(['total', row['stage'], '', row['calls'], row['seconds'], ''])
+                for row in report['stages']:
+                    writer.writerow(['stage', row['stage'], row['file'] or '', row['calls'], row['seconds'], ''])
+                for row in report['counters']:
+                    writer.writerow(['counter', row['counter'], row['file'] or '', '', '', row['value']])
+        else:
+            with open(file_name, 'w') as fp:
+                json.dump(report, fp, indent=1)
+
+        print ('{:>20} {:>8} {:>12}'.format('stage', 'calls', 'seconds'))
+        for row in report['totals']:
+            print ('{stage:>20} {calls:8d} {seconds:12.3f}'.format(**row))
+        print ('Profile report saved to:', file_name)
+
+        if self.profile is not None:
+            self.profile.dump_stats(file_name + '.prof')
+            pstats.Stats(self.profile).sort_stats('cumulative').print_stats(20)
+            print ('cProfile statistics of stage {} saved to: {}'.format(self.profile_stage,
+                                                                        file_name + '.prof'))
+        return report
+
+
+profiler = Profiler()
+
+
+def profiled(stage):
+    '''
+    Decorator timing every call of a function as a run of stage.
+    '''
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not profiler.enabled:
+                return function(*args, **kwargs)
+            with profiler.stage(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,385 @@
+'''
+Online detection: read audio as it is recorded, from stdin, a FIFO or a WAV
+file which is still being written, and score the latest segment_duration
+window every hop_seconds.
+
+    arecord -f S16_LE -r 16000 -c 1 -t wav | python Realtime_Detection.py --source -
+    python Realtime_Detection.py --source recorder.wav --follow --output detections.csv
+
+One line is written per window, as soon as it is scored:
+
+    start,end,p0,p1,p2,p3,latency
+
+start and end are seconds from the start of the stream, p0-p3 the class
+probabilities (as in the .csv files of predict_all_test_files) and latency
+the seconds from the arrival of the last audio the window depends on to
+the line being written. The probabilities match predict_all_test_files on
+the same audio, within float error.
+'''
+import argparse
+import collections
+import os
+import struct
+import sys
+import time
+
+import numpy as np
+
+from PredictionHelper import PredictionHelper
+from Dtype_Policy import policy_dtype
+
+
+class RingBuffer:
+    '''
+    The last capacity samples of a stream, addressed by their position in
+    the whole stream.
+    '''
+
+    def __init__(self, capacity, dtype):
+        self.data = np.zeros(capacity, dtype=dtype)
+        self.capacity = capacity
+        # Number of samples written so far
+        self.total = 0
+
+    def append(self, samples):
+        if len(samples) > self.capacity:
+            raise ValueError('Cannot append {} samples to a ring buffer of {}'.format(
+                             len(samples), self.capacity))
+        start = self.total % self.capacity
+        first = min(len(samples), self.capacity - start)
+        self.data[start:start + first] = samples[:first]
+        self.data[:len(samples) - first] = samples[first:]
+        self.total = self.total + len(samples)
+
+    def get(self, start, end):
+        ''' Copy of samples start to end of the stream. '''
+        if start < self.total - self.capacity or end > self.total or start > end:
+            raise IndexError('Samples {} to {} are not in the ring buffer, which holds {} to {}'.format(
+                             start, end, max(self.total - self.capacity, 0), self.total))
+        indices = np.arange(start, end) % self.capacity
+        return self.data[indices]
+
+
+def read_wav_header(stream):
+    '''
+    Read the header of a WAV stream up to the start of its samples, without
+    seeking. Returns the sample rate, number of channels, sample width in
+    bytes and whether the samples are floating point.
+    '''
+    def read_exactly(size):
+        data = b''
+        while len(data) < size:
+            more = stream.read(size - len(data))
+            if not more:
+                raise ValueError('The stream ended inside its WAV header')
+            data = data + more
+        return data
+
+    riff, _, wave = struct.unpack('<4sI4s', read_exactly(12))
+    if riff != b'RIFF' or wave != b'WAVE':
+        raise ValueError('Not a WAV stream; use raw=True for headerless PCM')
+
+    audio_format = None
+    while True:
+        chunk_id, chunk_size = struct.unpack('<4sI', read_exactly(8))
+        if chunk_id == b'data':
+            break
+        chunk = read_exactly(chunk_size + chunk_size % 2)
+        if chunk_id == b'fmt ':
+            audio_format, channels, sample_rate, _, _, bits = struct.unpack('<HHIIHH', chunk[:16])
+            if audio_format == 0xFFFE:
+                # WAVE_FORMAT_EXTENSIBLE: the format is the start of the sub-format GUID
+                audio_format = struct.unpack('<H', chunk[24:26])[0]
+    if audio_format not in (1, 3):
+        raise ValueError('Only PCM and IEEE float WAV streams are supported')
+    return sample_rate, channels, bits // 8, audio_format == 3
+
+def decode_pcm(data, channels, sample_width, is_float, dtype):
+    '''
+    Mono samples in dtype from interleaved PCM bytes, scaled and mixed down
+    as librosa.load does.
+    '''
+    if is_float:
+        samples = np.frombuffer(data, dtype='<f{}'.format(sample_width)).astype(dtype)
+    elif sample_width == 1:
+        samples = (np.frombuffer(data, dtype=np.uint8).astype(dtype) - 128) / 128
+    elif sample_width == 3:
+        # Little endian 24 bit: pad each sample to 32 bits
+        padded = np.zeros((len(data) // 3, 4), dtype=np.uint8)
+        padded[:, 1:] = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3)
+        samples = padded.view('<i4')[:, 0].astype(dtype) / 2**31
+    else:
+        samples = np.frombuffer(data, dtype='<i{}'.format(sample_width)).astype(dtype) / 2**(8 * sample_width - 1)
+    return samples.reshape(-1, channels).mean(axis=1).astype(dtype, copy=False)
+
+
+class AudioStream:
+    '''
+    Audio arriving on stdin (source '-'), a FIFO or a file which is still
+    being written (follow=True).
+
+    WAV streams are read from their header. raw=True reads headerless PCM
+    with the given sample_rate, channels and sample_width instead. A
+    followed file is polled every poll_interval seconds and ends after
+    idle_timeout seconds without new audio.
+    '''
+
+    def __init__(self, source, raw=False, sample_rate=16000, channels=1, sample_width=2,
+                 follow=False, poll_interval=0.1, idle_timeout=10):
+        self.stream = sys.stdin.buffer if source == '-' else open(source, 'rb')
+        self.follow = follow
+        self.poll_interval = poll_interval
+        self.idle_timeout = idle_timeout
+        if raw:
+            self.sample_rate, self.channels, self.sample_width, self.is_float = \
+                sample_rate, channels, sample_width, False
+        else:
+            self.sample_rate, self.channels, self.sample_width, self.is_float = \
+                read_wav_header(self.stream)
+        self.frame_size = self.channels * self.sample_width
+
+    def read(self, size):
+        data = self.stream.read(size)
+        if data or not self.follow:
+            return data
+        # Wait for the writer to append more
+        waited = 0
+        while not data and waited < self.idle_timeout:
+            time.sleep(self.poll_interval)
+            waited = waited + self.poll_interval
+            data = self.stream.read(size)
+        return data
+
+    def chunks(self, chunk_duration=0.1):
+        '''
+        Yield the mono audio in the policy dtype as it arrives, about
+        chunk_duration seconds at a time, with the time it was read.
+        '''
+        dtype = policy_dtype()
+        chunk_bytes = max(1, int(chunk_duration * self.sample_rate)) * self.frame_size
+        remainder = b''
+        while True:
+            data = self.read(chunk_bytes)
+            if not data:
+                break
+            data = remainder + data
+            usable = len(data) - len(data) % self.frame_size
+            remainder = data[usable:]
+            if usable > 0:
+                yield decode_pcm(data[:usable], self.channels, self.sample_width, self.is_float, dtype), \
+                      time.perf_counter()
+
+    def close(self):
+        if self.stream is not sys.stdin.buffer:
+            self.stream.close()
+
+
+class RealtimeDetector:
+    '''
+    Scores the windows of an audio stream as its samples arrive.
+
+    The audio is low pass filtered and downsampled one second at a time,
+    with context_duration seconds of audio on either side which are trimmed
+    off again, as in PredictionHelper.stream_audio_file. The raw audio is
+    held in a ring buffer of a few seconds and the downsampled audio in one
+    holding a single window, so memory does not grow with the stream.
+
+    Each second can only be downsampled once context_duration seconds
+    after it have arrived, so the latency of a window is at least
+    context_duration, plus the time to filter, compute one spectrogram and
+    run the model. Windows taking longer than latency_budget seconds are
+    counted and reported.
+    '''
+
+    def __init__(self, helper, model, sample_rate, context_duration=1, latency_budget=None):
+        if context_duration != int(context_duration) or context_duration < 0:
+            raise ValueError('context_duration must be a whole number of seconds')
+        window_samples = helper.segment_duration * helper.downsample_rate
+        hop_samples = helper.hop_seconds * helper.downsample_rate
+        if hop_samples != int(hop_samples) or window_samples != int(window_samples):
+            raise ValueError('segment_duration and hop_seconds must cover whole samples at the downsampled rate')
+
+        self.helper = helper
+        self.model = model
+        self.sample_rate = sample_rate
+        self.context_length = int(context_duration * sample_rate)
+        self.block_length = sample_rate
+        self.window_samples = int(window_samples)
+        self.hop_samples = int(hop_samples)
+        self.latency_budget = latency_budget
+
+        dtype = policy_dtype()
+        self.raw = RingBuffer(2 * self.context_length + 3 * self.block_length, dtype)
+        self.downsampled = RingBuffer(self.window_samples + 2 * helper.downsample_rate, dtype)
+        # Next second of raw audio to downsample, and next window to score
+        self.next_block = 0
+        self.next_window = 0
+        # Arrival time of the last sample of each second which is not yet scored
+        self.arrivals = collections.deque()
+        self.latencies = []
+        self.over_budget = 0
+
+    def downsample_block(self, final=False):
+        '''
+        Downsample the next second of raw audio, or what is left of it at
+        the end of the stream.
+        '''
+        start = self.next_block * self.block_length
+        end = min(start + self.block_length, self.raw.total)
+        chunk_start = max(start - self.context_length, 0)
+        chunk_end = min(end + self.context_length, self.raw.total)
+        chunk = self.raw.get(chunk_start, chunk_end)
+
+        filtered, filtered_sample_rate = self.helper.lowpass_and_downsample(chunk, self.sample_rate)
+
+        # Trim the context off again
+        trim = (start - chunk_start) * filtered_sample_rate // self.sample_rate
+        if final:
+            self.downsampled.append(filtered[trim:])
+        else:
+            self.downsampled.append(filtered[trim:trim + (end - start) * filtered_sample_rate // self.sample_rate])
+        self.next_block = self.next_block + 1
+
+    def score_windows(self, end_seconds):
+        '''
+        Score every window which ends within end_seconds seconds and whose
+        audio is downsampled. Returns a row per window.
+        '''
+        rows = []
+        downsample_rate = self.helper.downsample_rate
+        while True:
+            window_start = self.next_window * self.hop_samples
+            window_end = window_start + self.window_samples
+            if window_end > self.downsampled.total or window_end > end_seconds * downsample_rate:
+                return rows
+
+            window = self.downsampled.get(window_start, window_end)
+            spectrograms = self.helper.convert_recording_to_image(window, self.helper.segment_duration,
+                                        downsample_rate, 0, self.helper.segment_duration,
+                                        self.helper.hop_seconds)
+            probabilities = self.model.predict(self.helper.add_keras_dim(spectrograms), batch_size=1,
+                                               verbose=0)[0]
+
+            # Arrival of the last second this window needed, with its context
+            last_second = int(np.ceil(window_end / downsample_rate)) - 1
+            needed = min(last_second + self.context_length // self.sample_rate,
+                         int(np.ceil(self.raw.total / self.sample_rate)) - 1)
+            while self.arrivals and self.arrivals[0][0] < needed:
+                self.arrivals.popleft()
+            arrival = self.arrivals[0][1] if self.arrivals else time.perf_counter()
+            latency = time.perf_counter() - arrival
+            self.latencies.append(latency)
+            if self.latency_budget is not None and latency > self.latency_budget:
+                self.over_budget = self.over_budget + 1
+
+            rows.append((window_start / downsample_rate, window_end / downsample_rate,
+                         probabilities, latency))
+            self.next_window = self.next_window + 1
+
+    def process(self, samples, arrival_time=None):
+        '''
+        Add newly arrived samples (mono, at sample_rate) and return the rows
+        of the windows which could be scored as a result.
+        '''
+        if arrival_time is None:
+            arrival_time = time.perf_counter()
+        rows = []
+        for start in range(0, len(samples), self.block_length):
+            piece = samples[start:start + self.block_length]
+            seconds_before = self.raw.total // self.sample_rate
+            self.raw.append(piece)
+            for second in range(seconds_before, self.raw.total // self.sample_rate):
+                self.arrivals.append((second, arrival_time))
+
+            # A second can be downsampled once its context has arrived
+            while (self.next_block + 1) * self.block_length + self.context_length <= self.raw.total:
+                self.downsample_block()
+            rows.extend(self.score_windows(self.raw.total // self.sample_rate))
+        return rows
+
+    def finish(self):
+        '''
+        Downsample the rest of the stream, without context after it, and
+        return the rows of the windows left to score. Like
+        predict_all_test_files, only windows within the whole seconds of
+        the stream are scored.
+        '''
+        if self.raw.total % self.sample_rate:
+            self.arrivals.append((self.raw.total // self.sample_rate, time.perf_counter()))
+        while self.next_block * self.block_length < self.raw.total:
+            final = (self.next_block + 1) * self.block_length >= self.raw.total
+            self.downsample_block(final)
+        return self.score_windows(self.raw.total // self.sample_rate)
+
+    def latency_report(self):
+        ''' Mean, 95th percentile and largest latency of the windows, in seconds. '''
+        latencies = np.array(self.latencies)
+        if len(latencies) == 0:
+            return {'windows': 0}
+        return {'windows': len(latencies),
+                'mean_latency': float(latencies.mean()),
+                'p95_latency': float(np.percentile(latencies, 95)),
+                'max_latency': float(latencies.max()),
+                'latency_budget': self.latency_budget,
+                'over_budget': self.over_budget}
+
+
+def detect_stream(helper, stream, output=sys.stdout, model=None, context_duration=1,
+                  latency_budget=None, chunk_duration=0.1):
+    '''
+    Score an AudioStream with PredictionHelper helper until it ends,
+    writing a CSV line per window to output. Returns the probabilities of
+    every window and the latency report.
+    '''
+    if model is None:
+        model = helper.load_model()
+    detector = RealtimeDetector(helper, model, stream.sample_rate, context_duration, latency_budget)
+
+    def write(rows):
+        for start, end, probabilities, latency in rows:
+            output.write('{:g},{:g},{},{:.3f}\n'.format(start, end, ','.join('{:.6f}'.format(p)
+                                                                         for p in probabilities), latency))
+            predictions.append(probabilities)
+        output.flush()
+
+    predictions = []
+    output.write('start,end,{},latency\n'.format(','.join('p{}'.format(i) for i in range(4))))
+    for samples, arrival_time in stream.chunks(chunk_duration):
+        write(detector.process(samples, arrival_time))
+    write(detector.finish())
+
+    report = detector.latency_report()
+    print ('Latency:', report, file=sys.stderr)
+    return np.array(predictions), report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Detect gibbon calls in audio as it is recorded.')
+    parser.add_argument('--source', default='-', help='WAV file, FIFO, or - for stdin')
+    parser.add_argument('--follow', action='store_true', help='keep reading a file which is being written')
+    parser.add_argument('--raw', action='store_true', help='headerless 16 bit PCM instead of WAV')
+    parser.add_argument('--sample-rate', type=int, default=16000, help='sample rate of raw PCM')
+    parser.add_argument('--channels', type=int, default=1, help='channels of raw PCM')
+    parser.add_argument('--weights', default='weights_model5_2022.hdf5')
+    parser.add_argument('--backend', default='keras', choices=['keras', 'onnx', 'tflite'])
+    parser.add_argument('--backend-file', help='exported .onnx or .tflite model')
+    parser.add_argument('--context', type=int, default=1,
+                        help='seconds of audio after each second needed to downsample it')
+    parser.add_argument('--latency-budget', type=float, help='seconds; windows over it are counted')
+    parser.add_argument('--output', help='CSV file for the detections, stdout by default')
+    arguments = parser.parse_args()
+
+    # Same settings as Prediction.ipynb
+    helper = PredictionHelper('Raw_Data/Test', 2000, 4800, 2400, 10, 1024, 256, 128, 4000, 9000,
+                              arguments.weights, backend=arguments.backend,
+                              backend_file=arguments.backend_file)
+    stream = AudioStream(arguments.source, arguments.raw, arguments.sample_rate, arguments.channels,
+                         follow=arguments.follow)
+    output = open(arguments.output, 'w') if arguments.output else sys.stdout
+    try:
+        detect_stream(helper, stream, output, context_duration=arguments.context,
+                      latency_budget=arguments.latency_budget)
+    finally:
+        stream.close()
+        if output is not sys.stdout:
+            output.close()
@@ -0,0 +1,346 @@
+import json
+import os
+import pickle
+from os import path
+
+import numpy as np
+
+from Dtype_Policy import policy_dtype
+
+INDEX_FILE = 'index.json'
+
+# Compact storage codecs for ShardWriter. None stores the samples as they are.
+CODECS = (None, 'float16', 'uint8')
+
+
+def social_groups(file_name):
+    ''' Social groups a recording belongs to, using the same rule as
+    Train_Helper_Social_Group.load_training_images: A and D recordings are
+    group D, B recordings group B and C recordings group C.
+    '''
+    groups = []
+    if file_name.find('B') != -1 or file_name.find('AB') != -1:
+        groups.append('B')
+    if file_name.find('C') != -1:
+        groups.append('C')
+    if file_name.find('A') != -1 or file_name.find('D') != -1:
+        groups.append('D')
+    return groups
+
+
+def encode_samples(samples, codec):
+    '''
+    Encode samples with a storage codec. Returns the encoded samples and,
+    for uint8, the (min, max) of every sample, otherwise None.
+
+    float16 halves the size of float32 samples. uint8 scales each sample
+    to its own min and max and quantises it to 256 levels, a quarter of
+    the size plus 8 bytes per sample.
+    '''
+    if codec is None:
+        return samples, None
+    if codec == 'float16':
+        return samples.astype(np.float16), None
+    if codec == 'uint8':
+        axes = tuple(range(1, samples.ndim))
+        sample_min = samples.min(axis=axes, keepdims=True)
+        sample_max = samples.max(axis=axes, keepdims=True)
+        sample_range = np.where(sample_max > sample_min, sample_max - sample_min, 1)
+        encoded = np.rint((samples - sample_min) / sample_range * 255).astype(np.uint8)
+        scales = np.stack([sample_min.reshape(-1), sample_max.reshape(-1)], axis=1).astype(np.float32)
+        return encoded, scales
+    raise ValueError('Unknown codec: {}'.format(codec))
+
+def decode_samples(encoded, scales, codec, dtype=None):
+    '''
+    Undo encode_samples, giving samples of dtype (default the policy dtype
+    for float16 and uint8, otherwise unchanged).
+    '''
+    if codec is None:
+        return encoded if dtype is None else encoded.astype(dtype, copy=False)
+    if dtype is None:
+        dtype = policy_dtype()
+    if codec == 'float16':
+        return encoded.astype(dtype)
+    if codec == 'uint8':
+        shape = (-1,) + (1,) * (encoded.ndim - 1)
+        sample_min = scales[:, 0].astype(dtype).reshape(shape)
+        sample_range = (scales[:, 1] - scales[:, 0]).astype(dtype).reshape(shape)
+        return encoded.astype(dtype) * (sample_range / 255) + sample_min
+    raise ValueError('Unknown codec: {}'.format(codec))
+
+
+class ShardWriter:
+    '''
+    Writes spectrograms (or any fixed-shape samples) into contiguous .npy
+    shards of about shard_size samples and records where every recording's
+    samples are in index.json.
+
+    codec ('float16' or 'uint8', see encode_samples) stores the samples in
+    compact form; they are decoded again when read from ShardedDataset.
+    '''
+
+    def __init__(self, directory, shard_size=4096, codec=None):
+        if codec not in CODECS:
+            raise ValueError('Unknown codec: {}'.format(codec))
+        self.directory = directory
+        self.shard_size = shard_size
+        self.codec = codec
+        self.shards = []
+        self.entries = []
+        self.buffer = []
+        self.scale_buffer = []
+        self.buffer_count = 0
+        self.sample_shape = None
+        self.dtype = None
+        os.makedirs(self.directory, exist_ok=True)
+
+    def add(self, file_name, class_name, samples, groups=None):
+        '''
+        Add the samples of one recording. class_name is 'gibbon' or 'noise'
+        and groups the social groups of the recording.
+        '''
+        samples = np.asarray(samples)
+        if len(samples) == 0:
+            return
+
+        if self.sample_shape is None:
+            self.sample_shape = list(samples.shape[1:])
+            self.dtype = samples.dtype.str
+        elif list(samples.shape[1:]) != self.sample_shape:
+            raise ValueError('Samples of {} have shape {}, expected {}'.format(
+                             file_name, samples.shape[1:], self.sample_shape))
+
+        if self.buffer_count > 0 and self.buffer_count + len(samples) > self.shard_size:
+            self.flush()
+
+        self.entries.append({'file': file_name,
+                             'class': class_name,
+                             'social_groups': groups if groups is not None else [],
+                             'shard': len(self.shards),
+                             'offset': self.buffer_count,
+                             'count': len(samples)})
+        encoded, scales = encode_samples(samples.astype(self.dtype, copy=False), self.codec)
+        self.buffer.append(encoded)
+        if scales is not None:
+            self.scale_buffer.append(scales)
+        self.buffer_count = self.buffer_count + len(samples)
+
+    def flush(self):
+        '''
+        Write the buffered samples to a new shard.
+        '''
+        if self.buffer_count == 0:
+            return
+        shard_name = 'shard_{:05d}.npy'.format(len(self.shards))
+        np.save(path.join(self.directory, shard_name), np.concatenate(self.buffer))
+        shard = {'file': shard_name, 'count': self.buffer_count}
+        if len(self.scale_buffer) > 0:
+            shard['scales'] = 'scales_{:05d}.npy'.format(len(self.shards))
+            np.save(path.join(self.directory, shard['scales']), np.concatenate(self.scale_buffer))
+        self.shards.append(shard)
+        self.buffer = []
+        self.scale_buffer = []
+        self.buffer_count = 0
+
+    def close(self):
+        '''
+        Write the last shard and the index.
+        '''
+        self.flush()
+        index = {'version': 1,
+                 'sample_shape': self.sample_shape,
+                 'dtype': self.dtype,
+                 'codec': self.codec,
+                 'shards': self.shards,
+                 'entries': self.entries}
+        with open(path.join(self.directory, INDEX_FILE), 'w') as fp:
+            json.dump(index, fp, indent=1)
+
+
+class ShardedArray:
+    '''
+    Read-only, array-like view over a selection of samples in a sharded
+    dataset. Nothing is read until samples are indexed; np.asarray() reads
+    the whole selection. Samples stored with a codec are decoded as they
+    are read.
+    '''
+
+    def __init__(self, dataset, entries):
+        self.dataset = dataset
+        self.entries = entries
+        self.ends = np.cumsum([entry['count'] for entry in entries], dtype=np.int64)
+        self.shape = (int(self.ends[-1]) if len(entries) > 0 else 0,) + tuple(dataset.sample_shape)
+        self.dtype = dataset.dtype
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, item):
+        if isinstance(item, (int, np.integer)):
+            if item < 0:
+                item = item + len(self)
+            return self.take(np.array([item]))[0]
+        if isinstance(item, slice):
+            return self.take(np.arange(len(self))[item])
+        return self.take(np.asarray(item))
+
+    def take(self, indices):
+        '''
+        Samples at the given positions of the selection, in that order.
+        '''
+        indices = np.asarray(indices, dtype=np.int64)
+        out = np.empty((len(indices),) + tuple(self.dataset.sample_shape), dtype=self.dtype)
+        entry_ids = np.searchsorted(self.ends, indices, side='right')
+        for entry_id in np.unique(entry_ids):
+            entry = self.entries[entry_id]
+            mask = entry_ids == entry_id
+            positions = indices[mask] - (self.ends[entry_id] - entry['count'])
+            rows = entry['offset'] + positions
+            out[mask] = self.dataset.read(entry['shard'], rows)
+        return out
+
+    def __array__(self, dtype=None, copy=None):
+        out = self.take(np.arange(len(self)))
+        return out if dtype is None else out.astype(dtype)
+
+
+class ShardedDataset:
+    '''
+    Dataset written by ShardWriter. Opening it only reads index.json; the
+    shards are memory-mapped the first time they are used.
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(path.join(directory, INDEX_FILE)) as fp:
+            index = json.load(fp)
+        self.sample_shape = index['sample_shape'] or []
+        self.codec = index.get('codec')
+        if self.codec is not None:
+            self.dtype = policy_dtype()
+        else:
+            self.dtype = np.dtype(index['dtype']) if index['dtype'] else np.float32
+        self.shards = index['shards']
+        self.entries = index['entries']
+        self.open_shards = {}
+        self.open_scales = {}
+
+    def shard(self, shard_id):
+        if shard_id not in self.open_shards:
+            self.open_shards[shard_id] = np.load(path.join(self.directory,
+                                                 self.shards[shard_id]['file']), mmap_mode='r')
+        return self.open_shards[shard_id]
+
+    def scales(self, shard_id):
+        if 'scales' not in self.shards[shard_id]:
+            return None
+        if shard_id not in self.open_scales:
+            self.open_scales[shard_id] = np.load(path.join(self.directory,
+                                                 self.shards[shard_id]['scales']))
+        return self.open_scales[shard_id]
+
+    def read(self, shard_id, rows):
+        '''
+        Decoded samples at the given rows of a shard.
+        '''
+        scales = self.scales(shard_id)
+        return decode_samples(self.shard(shard_id)[rows], 
+                              None if scales is None else scales[rows], self.codec, self.dtype)
+
+    def select(self, class_name=None, social_group=None, files=None):
+        '''
+        ShardedArray over the samples of the given class and social group,
+        restricted to the recordings in files (names without extension).
+        '''
+        if files is not None:
+            files = set(files)
+        entries = [entry for entry in self.entries
+                   if (class_name is None or entry['class'] == class_name)
+                   and (social_group is None or social_group in entry['social_groups'])
+                   and (files is None or entry['file'] in files)]
+        return ShardedArray(self, entries)
+
+
+def is_sharded_dataset(directory):
+    return path.exists(path.join(directory, INDEX_FILE))
+
+def read_file_names(training_file):
+    ''' Names, without extension, of the recordings listed in a file such
+    as Training_Files.txt.
+    '''
+    file_names = []
+    with open(training_file) as fp:
+        for line in fp:
+            file_name = line.strip()
+            if file_name:
+                file_names.append(file_name[:file_name.find('.wav')])
+    return file_names
+
+def convert_pickles_to_shards(training_folder, training_file, output_directory,
+                              suffix, shard_size=4096, codec=None):
+    ''' Convert the g_<file><suffix> and n_<file><suffix> pickles of every
+    recording in training_file into a sharded dataset, optionally stored
+    with a compact codec ('float16' or 'uint8').
+
+    The suffix depends on what wrote the pickles: '_img.pkl' for the
+    spectrograms of Train_Helper_Binary, '_augmented_img.pkl' for those of
+    Train_Helper_Social_Group and '.pkl' for the extracted segments.
+    '''
+    writer = ShardWriter(output_directory, shard_size, codec)
+
+    for file_name in read_file_names(training_file):
+        print ('Converting:', file_name)
+
+        gibbon_file = training_folder+'g_'+file_name+suffix
+        if path.exists(gibbon_file):
+            with open(gibbon_file, 'rb') as fp:
+                writer.add(file_name, 'gibbon', pickle.load(fp), social_groups(file_name))
+
+        noise_file = training_folder+'n_'+file_name+suffix
+        if path.exists(noise_file):
+            with open(noise_file, 'rb') as fp:
+                writer.add(file_name, 'noise', pickle.load(fp), social_groups(file_name))
+
+    writer.close()
+    print ('Sharded dataset saved to:', output_directory)
+
+def codec_report(model, X, Y, codecs=CODECS, batch_size=256):
+    '''
+    Accuracy of model on (X, Y), e.g. the validation set, when X is stored
+    with each codec and decoded again, so a codec can be chosen knowing its
+    cost. Also reports the agreement with the predictions of the first
+    codec (by default None, the original samples), the largest decoding
+    error and the bytes stored per sample.
+    '''
+    X = np.asarray(X)
+    labels = np.argmax(Y, 1)
+    reference = None
+    report = []
+    for codec in codecs:
+        predictions = []
+        error = 0.0
+        for start in range(0, len(X), batch_size):
+            samples = X[start:start + batch_size]
+            encoded, scales = encode_samples(samples, codec)
+            decoded = decode_samples(encoded, scales, codec, policy_dtype())
+            error = max(error, float(np.abs(decoded - samples).max()))
+            predictions.append(np.argmax(model.predict(decoded, verbose=0), 1))
+        predictions = np.concatenate(predictions)
+        if reference is None:
+            reference = predictions
+
+        sample_bytes = encoded[0].nbytes + (0 if scales is None else scales[0].nbytes)
+        report.append({'codec': codec or X.dtype.name,
+                       'accuracy': float(np.mean(predictions == labels)),
+                       'agreement': float(np.mean(predictions == reference)),
+                       'max_error': error,
+                       'bytes_per_sample': sample_bytes,
+                       'compression': X[0].nbytes / sample_bytes})
+
+    print ('{:>10} {:>9} {:>10} {:>10} {:>12}'.format('codec', 'accuracy', 'agreement', 'max error', 'compression'))
+    for row in report:
+        print ('{codec:>10} {accuracy:9.4f} {agreement:10.4f} {max_error:10.2e} {compression:11.1f}x'.format(**row))
+
+    return report
@@ -0,0 +1,219 @@
+import numpy as np
+import tensorflow as tf
+
+from Spectrogram_Helper import power_to_db, normalise_images
+from Profiling import profiler
+
+
+class SharedConvolutionModel:
+    '''
+    Inference-only form of a trained network_2D model which runs its first
+    convolution once over the whole recording instead of once per window.
+
+    Windows one second apart overlap by 90%, so most of what the first
+    convolution computes for a window it has already computed for its
+    neighbours. The network cannot be made fully convolutional end to end:
+    every window is scaled to [0, 1] by its own minimum and maximum dB
+    before the model sees it, and the layers after the first ReLU depend on
+    that scaling. The first convolution is linear though, so on the
+    unscaled dB spectrogram of the recording
+
+        conv((db - low) / (high - low)) = (conv(db) - low * sum(kernel)) / (high - low)
+
+    conv(db) is computed once, on the STFT grid of
+    PredictionHelper.recording_grid with the kernel dilated to the frame
+    hop, and every window takes its columns from it and applies its own
+    scaling. Per window only the columns which see the edge frames (padded
+    per window), the scaling and the rest of the network are computed. The
+    first convolution is most of the FLOPs of network_2D (see flops).
+
+    Windows where power_to_db's top_db clipping is active are not affine
+    in the unscaled dB, and are run through the whole model instead.
+
+    predict() runs the whole model on spectrograms, so the model can also
+    be used where spectrograms are already computed.
+    '''
+
+    def __init__(self, model, amin=1e-10, top_db=80.0):
+        conv = model.layers[0]
+        if not isinstance(conv, tf.keras.layers.Conv2D) or conv.padding != 'valid' \
+                or tuple(conv.strides) != (1, 1) or tuple(conv.dilation_rate) != (1, 1):
+            raise ValueError('The first layer must be a Conv2D with valid padding, stride 1 and no dilation')
+        if conv.activation not in (tf.keras.activations.relu, tf.keras.activations.linear):
+            raise ValueError('The first convolution must have a relu or linear activation')
+
+        # Dropout does nothing at inference, then the first max pooling
+        layer_index = 1
+        while isinstance(model.layers[layer_index], tf.keras.layers.Dropout):
+            layer_index = layer_index + 1
+        pool = model.layers[layer_index]
+        if not isinstance(pool, tf.keras.layers.MaxPooling2D) or pool.padding != 'valid' \
+                or tuple(pool.pool_size) != tuple(pool.strides):
+            raise ValueError('The first convolution must be followed by a non-overlapping MaxPooling2D')
+
+        self.model = model
+        self.kernel, self.bias = [weight.astype(np.float32) for weight in conv.get_weights()]
+        self.kernel_sum = self.kernel.sum(axis=(0, 1, 2))
+        self.activation = conv.activation
+        self.pool_size = tuple(pool.pool_size)
+        self.amin = amin
+        self.top_db = top_db
+
+        # The rest of the trained network, from the output of the first max pooling
+        inputs = tf.keras.Input(shape=tuple(pool.output.shape[1:]))
+        outputs = inputs
+        for layer in model.layers[layer_index + 1:]:
+            outputs = layer(outputs)
+        self.head = tf.keras.Model(inputs, outputs)
+
+    def predict(self, spectrograms, batch_size=None, verbose=None):
+        return self.model.predict(spectrograms, batch_size=batch_size, verbose=0)
+
+    def convolve(self, images):
+        ''' First convolution, before the bias, of (windows, n_mels, columns) images. '''
+        return tf.nn.conv2d(images[..., None], self.kernel, strides=1, padding='VALID').numpy()
+
+    def convolve_dilated(self, span, stride):
+        '''
+        First convolution, before the bias, of span (n_mels, grid frames)
+        with the kernel dilated by stride along time. The stride phases of
+        span are convolved as one batch with the undilated kernel, which is
+        faster than a dilated convolution.
+        '''
+        width = span.shape[1] - (self.kernel.shape[1] - 1) * stride
+        phase_length = -(-span.shape[1] // stride)
+        phases = np.zeros((stride, span.shape[0], phase_length), dtype=np.float32)
+        for phase in range(stride):
+            phases[phase, :, :len(range(phase, span.shape[1], stride))] = span[:, phase::stride]
+        convolved = self.convolve(phases)
+
+        shared = np.empty((convolved.shape[1], width, convolved.shape[3]), dtype=np.float32)
+        for phase in range(stride):
+            shared[:, phase::stride] = convolved[phase, :, :len(range(phase, width, stride))]
+        return shared
+
+    def predict_recording(self, helper, audio, sample_rate, chunk_size=256, batch_size=None):
+        '''
+        Predictions for every window of downsampled audio, equal within
+        float tolerance to predicting the spectrograms of
+        helper.convert_recording_to_image.
+        '''
+        end_index = int(len(audio) / sample_rate)
+        grid = helper.recording_grid(audio, helper.segment_duration, sample_rate, 0, end_index,
+                                     helper.hop_seconds)
+        if grid is None:
+            spectrograms = helper.convert_recording_to_image(audio, helper.segment_duration, sample_rate,
+                                                             0, end_index, helper.hop_seconds)
+            return self.predict(helper.add_keras_dim(spectrograms), batch_size)
+
+        kernel_width = self.kernel.shape[1]
+        pool_height, pool_width = self.pool_size
+        stride = grid['stride']
+        hop_grid = grid['hop_samples'] // grid['step']
+        number_rows = helper.n_mels - self.kernel.shape[0] + 1
+        number_columns = grid['number_frames'] - kernel_width + 1
+        pooled_rows = number_rows // pool_height
+        pooled_columns = number_columns // pool_width
+
+        # Convolution columns whose frames all come from the grid, and the
+        # pooling groups made only of them
+        first_column = grid['first_inner']
+        end_column = grid['end_inner'] - kernel_width + 1
+        groups = np.arange(pooled_columns)
+        inner = (groups * pool_width >= first_column) & (groups * pool_width + pool_width <= end_column)
+        inner_groups = groups[inner]
+        edge_groups = groups[~inner]
+
+        # Unscaled dB of the grid, (n_mels, grid frames)
+        grid_db = (10.0 * np.log10(np.maximum(self.amin, grid['grid']))).T.astype(np.float32)
+
+        number_windows = grid['number_windows']
+        predictions = []
+        for start in range(0, number_windows, chunk_size):
+            windows = np.arange(start, min(start + chunk_size, number_windows))
+            offsets = (windows - windows[0]) * hop_grid
+
+            with profiler.stage('spectrogram'):
+                images = power_to_db(helper.window_mel_images(grid, windows), self.amin, top_db=None)
+            low = images.min(axis=(1, 2))
+            high = images.max(axis=(1, 2))
+            clipped = low < high - self.top_db
+
+            with profiler.stage('shared_convolution'):
+                # Grid frames of this chunk's windows, convolved once with
+                # the kernel dilated to the frame hop
+                first = windows[0] * hop_grid + first_column * stride - grid['first_grid']
+                last = windows[-1] * hop_grid + (end_column - 1) * stride - grid['first_grid']
+                span = grid_db[:, first:last + 1 + (kernel_width - 1) * stride]
+                shared = self.convolve_dilated(span, stride)
+
+                # The scaling is positive and the same over a window, so it
+                # and the ReLU commute with max pooling: pool the shared
+                # convolution once, then scale each window's pooled values
+                shared = shared[:pooled_rows * pool_height]
+                shared = shared.reshape(pooled_rows, pool_height, shared.shape[1], shared.shape[2]).max(axis=1)
+                width = shared.shape[1] - (pool_width - 1) * stride
+                maxima = shared[:, :width]
+                for k in range(1, pool_width):
+                    maxima = np.maximum(maxima, shared[:, k * stride:k * stride + width])
+
+                pooled = np.empty((len(windows), pooled_rows, pooled_columns, maxima.shape[2]), dtype=np.float32)
+                pooled[:, :, inner_groups] = maxima[:, offsets[:, None] 
+                                                    + (inner_groups * pool_width - first_column) * stride
+                                                   ].transpose(1, 0, 2, 3)
+
+                # Groups with a column which sees the edge frames, per window
+                for group in edge_groups:
+                    columns = np.empty((len(windows), pooled_rows, pool_width, maxima.shape[2]), dtype=np.float32)
+                    for k, column in enumerate(range(group * pool_width, (group + 1) * pool_width)):
+                        if first_column <= column < end_column:
+                            values = shared[:, offsets + (column - first_column) * stride].transpose(1, 0, 2)
+                        else:
+                            values = self.convolve(images[:, :, column:column + kernel_width])[:, :, 0]
+                            values = values[:, :pooled_rows * pool_height].reshape(len(windows), pooled_rows, 
+                                                                                  pool_height, -1).max(axis=2)
+                        columns[:, :, k] = values
+                    pooled[:, :, group] = columns.max(axis=2)
+
+                scale = (1 / (high - low)).astype(np.float32)[:, None, None, None]
+                activations = np.asarray(self.activation((pooled - low[:, None, None, None] * self.kernel_sum)
+                                                         * scale + self.bias))
+
+            with profiler.stage('inference'):
+                # Called directly: predict's per call set up costs more
+                # than the small head itself
+                chunk_predictions = np.array(self.head(activations, training=False))
+                if clipped.any():
+                    spectrograms = normalise_images(np.maximum(images[clipped],
+                                                    high[clipped, None, None] - self.top_db))
+                    chunk_predictions[clipped] = self.predict(spectrograms[..., None], batch_size)
+            predictions.append(chunk_predictions)
+
+        profiler.count('windows', number_windows)
+        return np.concatenate(predictions)
+
+    def flops(self, number_windows, hop_columns, number_edge_columns=3):
+        '''
+        Multiply-adds of predicting number_windows windows one hop_columns
+        grid frames apart, window by window and with the shared first
+        convolution, of which number_edge_columns columns per window see
+        the edge frames and are computed per window.
+        '''
+        kernel_height, kernel_width, channels, filters = self.kernel.shape
+        input_shape = self.model.input_shape[1:]
+        rows = input_shape[0] - kernel_height + 1
+        columns = input_shape[1] - kernel_width + 1
+        per_column = rows * kernel_height * kernel_width * channels * filters
+
+        head = 0
+        for layer in self.head.layers:
+            if isinstance(layer, tf.keras.layers.Conv2D):
+                kernel = layer.get_weights()[0]
+                head += int(np.prod(layer.output.shape[1:3])) * kernel.size
+            elif isinstance(layer, tf.keras.layers.Dense):
+                head += layer.get_weights()[0].size
+
+        windowed = number_windows * (columns * per_column + head)
+        shared = (number_windows * hop_columns * per_column
+                  + number_windows * (number_edge_columns * per_column + head))
+        return {'window_by_window': windowed, 'shared_convolution': shared, 'ratio': shared / windowed}
@@ -0,0 +1,83 @@
+import inspect
+from functools import lru_cache
+
+import numpy as np
+import librosa
+from scipy import signal
+
+# Sample rate librosa assumes when none is given
+LIBROSA_DEFAULT_SR = 22050
+
+
+def stft_pad_mode():
+    ''' Padding mode used by librosa.stft when center=True. This changed
+    between librosa releases ('reflect' before 0.10, 'constant' after), so
+    read it from the installed version to stay equivalent to
+    librosa.feature.melspectrogram.
+    '''
+    return inspect.signature(librosa.stft).parameters['pad_mode'].default
+
+@lru_cache(maxsize=None)
+def fft_window(n_fft, dtype=np.float64):
+    ''' Periodic Hann window, as used by librosa.stft. '''
+    return signal.get_window('hann', n_fft, fftbins=True).astype(dtype)
+
+@lru_cache(maxsize=None)
+def mel_basis(sr, n_fft, n_mels, f_min, f_max):
+    ''' Mel filterbank, built once per set of parameters. '''
+    return librosa.filters.mel(sr=sr, n_fft=n_fft, n_mels=n_mels, fmin=f_min, fmax=f_max)
+
+def frames_to_mel(frames, sr, n_fft, n_mels, f_min, f_max, power=2.0):
+    ''' Convert frames of shape (..., n_fft) into mel energies of shape
+    (..., n_mels), in the dtype of frames.
+    '''
+    spectrum = np.abs(np.fft.rfft(frames * fft_window(n_fft, frames.dtype), axis=-1))
+    if power != 1.0:
+        spectrum = spectrum ** power
+    return (spectrum @ mel_basis(sr, n_fft, n_mels, f_min, f_max).T).astype(frames.dtype, copy=False)
+
+def power_to_db(S, amin=1e-10, top_db=80.0):
+    ''' Same as librosa.power_to_db (ref=1.0) applied separately to each
+    image in a batch of shape (N, n_mels, n_frames).
+    '''
+    log_spec = 10.0 * np.log10(np.maximum(amin, S))
+    if top_db is not None:
+        log_spec = np.maximum(log_spec, log_spec.max(axis=(1,2), keepdims=True) - top_db)
+    return log_spec
+
+def normalise_images(images, eps=1e-8):
+    ''' Standardise and min-max scale each image in a batch of shape
+    (N, n_mels, n_frames), as done by PredictionHelper.convert_single_to_image.
+    '''
+    mean = images.mean(axis=(1,2), keepdims=True)
+    std = images.std(axis=(1,2), keepdims=True)
+    spec_norm = (images - mean) / (std + eps)
+    spec_min = spec_norm.min(axis=(1,2), keepdims=True)
+    spec_max = spec_norm.max(axis=(1,2), keepdims=True)
+    return (spec_norm - spec_min) / (spec_max - spec_min)
+
+def melspectrogram_batch(audio, sr, n_fft, hop_length, n_mels, f_min, f_max, 
+                         power=2.0, chunk_size=32, out=None):
+    ''' Same as calling librosa.feature.melspectrogram (center=True) on every
+    row of audio, an array of shape (N, samples), but the STFT of
+    chunk_size rows is computed in one go and the mel filterbank is only
+    built once. Results are written into out, of shape
+    (N, n_mels, n_frames), which is allocated in the dtype of audio if not
+    given.
+    '''
+    pad = n_fft // 2
+    number_frames = 1 + audio.shape[1] // hop_length
+    if out is None:
+        out = np.empty((audio.shape[0], n_mels, number_frames), dtype=audio.dtype)
+
+    pad_mode = stft_pad_mode()
+    for start in range(0, audio.shape[0], chunk_size):
+        padded = np.pad(audio[start:start + chunk_size], ((0,0),(pad,pad)), mode=pad_mode)
+        frames = np.lib.stride_tricks.as_strided(padded,
+                                 shape=(padded.shape[0], number_frames, n_fft),
+                                 strides=(padded.strides[0], hop_length * padded.strides[1], padded.strides[1]),
+                                 writeable=False)
+        mel = frames_to_mel(frames, sr, n_fft, n_mels, f_min, f_max, power)
+        out[start:start + chunk_size] = mel.transpose(0,2,1)
+
+    return out
@@ -23,17 +23,24 @@ import librosa
 from CNN_Network_Binary import *
 from Extract_Audio_Helper import *
 from Augmentation import augment_data,augment_background, convert_to_image
+from Sharded_Dataset import is_sharded_dataset, CODECS
+from Training_Pipeline import split_positions, streaming_dataset, ordered_labels
+from Training_Pipeline import augmented_dataset, augmented_steps_per_epoch
+from Train_Helper_Common import (preprocess_all_files_parallel, open_sharded_sources, run_experiment,
+                                 save_experiment, model_codec_report)
+from Dtype_Policy import policy_dtype, enforce_dtype
+from Profiling import profiler
 
 def execute_audio_extraction(audio_directory, audio_file_name, sample_rate, timestamp_directory,
-                            number_seconds_to_extract, save_location):
-    
-    print ('Reading audio file (this can take some time)...')
-    # Read in audio file
-    librosa_audio, librosa_sample_rate = librosa.load(audio_directory+audio_file_name, 
-                                                  sr=sample_rate)
-    
-    print ()
-    print ('Reading done.')
+                            number_seconds_to_extract, save_location, annotated_only=False):
+    '''
+    Extract the labelled gibbon calls and background noise of a recording
+    and pickle them to save_location.
+
+    If annotated_only is set, only the regions of the recording covered by
+    the labelled windows are decoded and resampled instead of the whole
+    file.
+    '''
     
     # Read gibbon labelled timestamp file
     gibbon_timestamps = read_and_process_gibbon_timestamps(timestamp_directory, 
@@ -42,7 +49,26 @@ def execute_audio_extraction(audio_directory, audio_file_name, sample_rate, time
     # Read non-gibbon labelled timestamp file
     non_gibbon_timestamps = read_and_process_nongibbon_timestamps(timestamp_directory,
                                    'n_'+audio_file_name[:audio_file_name.find('.wav')]+'.data', 
-                                               librosa_sample_rate, sep=',')
+                                               sample_rate, sep=',')
+
+    if annotated_only:
+        print ('Reading annotated regions of the audio file...')
+        # Same windows as the extraction below
+        spans = merge_spans(gibbon_call_spans(gibbon_timestamps, number_seconds_to_extract, 1, sample_rate)
+                            + nongibbon_call_spans(non_gibbon_timestamps, number_seconds_to_extract, 5, sample_rate),
+                            sample_rate)
+        librosa_audio = load_audio_spans(audio_directory+audio_file_name, spans, sample_rate)
+        librosa_sample_rate = sample_rate
+    else:
+        print ('Reading audio file (this can take some time)...')
+        # Read in audio file
+        with profiler.stage('decode'):
+            librosa_audio, librosa_sample_rate = librosa.load(audio_directory+audio_file_name, 
+                                                          sr=sample_rate, dtype=policy_dtype())
+    
+    print ()
+    print ('Reading done.')
+    
     # Extract gibbon calls
     gibbon_extracted = extract_all_gibbon_calls(librosa_audio, gibbon_timestamps,
                                             number_seconds_to_extract,1, librosa_sample_rate,0)
@@ -51,8 +77,9 @@ def execute_audio_extraction(audio_directory, audio_file_name, sample_rate, time
     noise_extracted = extract_all_nongibbon_calls(librosa_audio, non_gibbon_timestamps,
                                               number_seconds_to_extract,5, librosa_sample_rate,0)
     # Save the extracted data to disk
-    pickle.dump(gibbon_extracted, open(save_location+'g_'+audio_file_name[:audio_file_name.find('.wav')]+'.pkl', "wb" ))
-    pickle.dump(noise_extracted, open(save_location+'n_'+audio_file_name[:audio_file_name.find('.wav')]+'.pkl', "wb" )) 
+    with profiler.stage('save'):
+        pickle.dump(gibbon_extracted, open(save_location+'g_'+audio_file_name[:audio_file_name.find('.wav')]+'.pkl', "wb" ))
+        pickle.dump(noise_extracted, open(save_location+'n_'+audio_file_name[:audio_file_name.find('.wav')]+'.pkl', "wb" )) 
     
     del librosa_audio
     print ()
@@ -107,13 +134,12 @@ def execute_augmentation(gibbon_extracted,
     print ('gibbon_extracted_augmented_image:', gibbon_extracted_augmented_image.shape)
     print ('non_gibbon_extracted_augmented_image:', non_gibbon_extracted_augmented_image.shape)
     
-    pickle.dump(gibbon_extracted_augmented_image, 
-            open(augment_image_directory+'g_'+audio_file_name[:audio_file_name.find('.wav')]+'_img.pkl', "wb" ))
+    with profiler.stage('save'):
+        pickle.dump(gibbon_extracted_augmented_image, 
+                open(augment_image_directory+'g_'+audio_file_name[:audio_file_name.find('.wav')]+'_img.pkl', "wb" ))
 
-    pickle.dump(non_gibbon_extracted_augmented_image, 
-                open(augment_image_directory+'n_'+audio_file_name[:audio_file_name.find('.wav')]+'_img.pkl', "wb" ))
-    
-    del non_gibbon_extracted_augmented, gibbon_extracted_augmented
+        pickle.dump(non_gibbon_extracted_augmented_image, 
+                    open(augment_image_directory+'n_'+audio_file_name[:audio_file_name.find('.wav')]+'_img.pkl', "wb" ))
     
     print()
     print ('Augmenting done. Pickle files saved to...')
@@ -172,6 +198,7 @@ def execute_preprocessing_all_files(training_file, audio_directory,
         while line:   
             file_name = line.strip()
             print ('Processing file: {}'.format(file_name))
+            profiler.set_file(file_name)
             
             ## Extract segments from audio files
             gibbon_extracted, non_gibbon_extracted = execute_audio_extraction(audio_directory, 
@@ -188,8 +215,82 @@ def execute_preprocessing_all_files(training_file, audio_directory,
             # Read next line
             line = fp.readline()
 
+
+def preprocessing_outputs(file_name, save_location, augment_directory, augment_image_directory):
+    '''
+    Files written by execute_audio_extraction and execute_augmentation for
+    a recording (file_name without extension).
+    '''
+    return [save_location+'g_'+file_name+'.pkl',
+            save_location+'n_'+file_name+'.pkl',
+            augment_image_directory+'g_'+file_name+'_img.pkl',
+            augment_image_directory+'n_'+file_name+'_img.pkl']
+
+def preprocess_single_file(file_name, audio_directory, sample_rate, timestamp_directory,
+                           number_seconds_to_extract, save_location,
+                           augmentation_amount_noise, augmentation_probability, 
+                           augmentation_amount_gibbon, seed, augment_directory, augment_image_directory,
+                           annotated_only=False):
+    '''
+    Extract and augment one recording, run in a worker process by
+    execute_preprocessing_all_files_parallel.
+    '''
+    print ('Processing file: {}'.format(file_name))
+    
+    gibbon_extracted, non_gibbon_extracted = execute_audio_extraction(audio_directory, 
+                               file_name, sample_rate, timestamp_directory,
+                                 number_seconds_to_extract, save_location, annotated_only)
+    
+    execute_augmentation(gibbon_extracted, 
+                         non_gibbon_extracted, number_seconds_to_extract, sample_rate,
+                         augmentation_amount_noise, augmentation_probability, 
+                         augmentation_amount_gibbon, seed, augment_directory, augment_image_directory,
+                         file_name)
+    return file_name
+
+def execute_preprocessing_all_files_parallel(training_file, audio_directory, 
+                            sample_rate, timestamp_directory,
+                            number_seconds_to_extract, save_location,
+                            augmentation_amount_noise, augmentation_probability, 
+                            augmentation_amount_gibbon, seed, augment_directory, augment_image_directory,
+                            workers=None, manifest_file=None, annotated_only=False, max_rss=None):
+    '''
+    Same as execute_preprocessing_all_files, but recordings are processed
+    in a pool of worker processes and only when something changed.
+
+    A manifest (augment_image_directory + 'manifest.json' by default) 
+    records the hash of each recording's audio and label files, the
+    fingerprint of the parameters and the outputs written. Recordings 
+    whose record is unchanged and whose outputs exist are skipped, so 
+    adding recordings to training_file only processes the new ones.
+
+    With a memory budget max_rss (e.g. '2G') the number of workers is
+    reduced until the largest recording fits in every worker, and a
+    MemoryError is raised before starting if it cannot fit at all.
+    '''
+    
+    preprocess_all_files_parallel('binary', preprocess_single_file, preprocessing_outputs,
+                                  training_file, audio_directory, sample_rate, timestamp_directory,
+                                  number_seconds_to_extract, save_location,
+                                  augmentation_amount_noise, augmentation_probability,
+                                  augmentation_amount_gibbon, seed, augment_directory, augment_image_directory,
+                                  workers, manifest_file, annotated_only, max_rss)
+
             
-def load_training_images(training_folder, training_file):
+def load_training_images(training_folder, training_file, lazy=False):
+    '''
+    Read the spectrograms of every recording in training_file.
+
+    If lazy is set and training_folder holds a sharded dataset (see 
+    Sharded_Dataset.convert_pickles_to_shards), array-like views into the
+    memory-mapped shards are returned instead and nothing is read up front.
+    '''
+
+    if lazy and is_sharded_dataset(training_folder):
+        # Open the sharded dataset, samples are only read when used
+        gibbon_X, noise_X = open_sharded_sources(training_folder, training_file, 
+                                                 [('gibbon', None), ('noise', None)])
+        return gibbon_X, noise_X
 
     training_data = []
     gibbon_X = []
@@ -217,8 +318,8 @@ def load_training_images(training_folder, training_file):
             line = fp.readline()
 
 
-    gibbon_X = np.asarray(gibbon_X)
-    noise_X = np.asarray(noise_X)
+    gibbon_X = enforce_dtype(np.asarray(gibbon_X), 'load_training_images')
+    noise_X = enforce_dtype(np.asarray(noise_X), 'load_training_images')
 
     print()
     print ('Gibbon features:', gibbon_X.shape)
@@ -343,4 +444,132 @@ def train_model(number_iterations, augment_image_directory, training_file):
         print('Results saved to:')
         print('Experiments/train_test_performance_{}.txt'.format(seed))
         print('-------------------')
-        time.sleep(1)
\ No newline at end of file
+        time.sleep(1)
+
+
+def train_model_streaming(number_iterations, augment_image_directory, training_file,
+                          batch_size=8, epochs=5, shuffle_buffer=2048):
+    '''
+    Same as train_model, but the spectrograms are streamed from the sharded
+    dataset in augment_image_directory (see Sharded_Dataset.py) through a 
+    tf.data pipeline instead of being loaded into memory, so the dataset
+    can be larger than RAM.
+    '''
+    
+    print('Opening data...')
+    gibbon_X, non_gibbon_X = load_training_images(augment_image_directory, training_file, lazy=True)
+    sources = [gibbon_X, non_gibbon_X]
+    classes = [1, 0]
+    class_names=['0','1']
+    
+    seed = create_seed()
+        
+    for experiment_id in range(0,number_iterations):
+
+        print('Iteration {} starting...'.format(experiment_id))
+
+        print ('experiment_id: {}'.format(experiment_id))
+        
+        train_positions, val_positions = split_positions(sources, test_size=0.20, seed=seed)
+
+        train_data = streaming_dataset(sources, classes, 2, train_positions, batch_size,
+                                       shuffle_buffer=shuffle_buffer, seed=seed)
+        val_data = streaming_dataset(sources, classes, 2, val_positions, batch_size, shuffle=False)
+        train_eval = streaming_dataset(sources, classes, 2, train_positions, batch_size, shuffle=False)
+        val_eval = val_data
+        Y_train = ordered_labels(sources, classes, 2, train_positions)
+        Y_val = ordered_labels(sources, classes, 2, val_positions)
+
+        # Check shape
+        print ('Y_train:',Y_train.shape)
+        print ('Y_val:',Y_val.shape)
+
+        model, history, seconds = run_experiment(network, train_data, val_data, seed, epochs)
+        
+        # Evaluate on unshuffled pipelines so the labels line up
+        train_acc = accuracy_score(np.argmax(model.predict(train_eval),1), np.argmax(Y_train,1))
+        print("training accuracy = ",train_acc)
+
+        val_prediction = np.argmax(model.predict(val_eval),1)
+        val_acc = accuracy_score(val_prediction, np.argmax(Y_val,1))
+        print("validation accuracy = ",val_acc)
+
+        # Compute confusion matrix
+        cnf_matrix = confusion_matrix(np.argmax(Y_val,1), val_prediction)
+        np.set_printoptions(precision=2)
+
+        print ()
+        print ('Plotting performance on validation data.')
+        # Plot normalized confusion matrix
+        plt.figure()
+        plot_confusion_matrix(cnf_matrix, classes=class_names, normalize=True,
+                              title='Normalized confusion matrix')
+
+        plt.show()
+
+        save_experiment(experiment_id, seed, train_acc, val_acc, seconds, history)
+
+
+def train_model_online_augmentation(number_iterations, extracted_directory, training_file,
+                                    augmentation_amount, augmentation_probability,
+                                    sample_rate, number_seconds_to_extract, seed=None,
+                                    batch_size=8, epochs=5):
+    '''
+    Train on segments augmented on the fly (time shift and 0.9/0.1 blending
+    with background noise, then spectrogram) inside the input pipeline, 
+    instead of the augmented pickles written by execute_augmentation.
+
+    extracted_directory holds the segments extracted by 
+    execute_audio_extraction as a sharded dataset, e.g. from
+    convert_pickles_to_shards(save_location, training_file, extracted_directory, suffix='.pkl').
+    The augmented batches only depend on seed.
+    '''
+    
+    print('Opening data...')
+    gibbon_X, non_gibbon_X = load_training_images(extracted_directory, training_file, lazy=True)
+    sources = [gibbon_X, non_gibbon_X]
+    
+    if seed is None:
+        seed = create_seed()
+        
+    for experiment_id in range(0,number_iterations):
+
+        print('Iteration {} starting...'.format(experiment_id))
+
+        print ('experiment_id: {}'.format(experiment_id))
+        
+        train_positions, val_positions = split_positions(sources, test_size=0.20, seed=seed)
+        steps_per_epoch = augmented_steps_per_epoch(len(train_positions[0]), augmentation_amount,
+                                                    augmentation_probability, batch_size)
+
+        train_data = augmented_dataset([gibbon_X], [1], [non_gibbon_X], 2, steps_per_epoch, epochs, 
+                                       batch_size, sample_rate, number_seconds_to_extract, seed,
+                                       [train_positions[0]], [train_positions[1]])
+        # Validation segments are not augmented
+        val_data = streaming_dataset(sources, [1, 0], 2, val_positions, batch_size, 
+                                     shuffle=False, transform=convert_to_image)
+        Y_val = ordered_labels(sources, [1, 0], 2, val_positions)
+
+        print ('Batches per epoch:', steps_per_epoch)
+        print ('Y_val:',Y_val.shape)
+
+        model, history, seconds = run_experiment(network, train_data, val_data, seed, epochs,
+                                                 steps_per_epoch, summary=False)
+
+        val_acc = accuracy_score(np.argmax(model.predict(val_data),1), np.argmax(Y_val,1))
+        print("validation accuracy = ",val_acc)
+
+        save_experiment(experiment_id, seed, history.history['accuracy'][-1], val_acc, seconds, history)
+
+def storage_codec_report(weights_file, augment_image_directory, file_list, codecs=CODECS):
+    '''
+    Accuracy of the model with weights_file on the spectrograms of the
+    recordings in file_list (e.g. the validation files) when they are
+    stored with each storage codec of Sharded_Dataset, to choose the codec
+    for convert_pickles_to_shards.
+    '''
+    gibbon_X, noise_X = load_training_images(augment_image_directory, file_list)
+    X, Y = prepare_X_and_Y(gibbon_X, noise_X)
+    del gibbon_X, noise_X
+
+    return model_codec_report(network, weights_file, X, Y, codecs)
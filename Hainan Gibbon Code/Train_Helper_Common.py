@@ -0,0 +1,199 @@
+'''
+Parts of the training pipeline shared by Train_Helper_Binary and
+Train_Helper_Social_Group: parallel, incremental preprocessing, lazy
+loading of sharded datasets, the training loop of the streaming models and
+the storage codec report. Each helper passes in what differs: its network,
+its classes and the functions which extract and augment one recording.
+'''
+import concurrent.futures
+import multiprocessing
+import os
+import pickle
+import time
+
+import numpy as np
+from tensorflow.keras.callbacks import ModelCheckpoint
+
+from Extract_Audio_Helper import (read_and_process_gibbon_timestamps, read_and_process_nongibbon_timestamps,
+                                  gibbon_call_spans, nongibbon_call_spans)
+from Sharded_Dataset import ShardedDataset, read_file_names, codec_report
+from Preprocessing_Manifest import PreprocessingManifest
+from Memory_Governor import MemoryGovernor, WORKER_PROCESS_BYTES
+
+
+def preprocess_all_files_parallel(helper_name, preprocess_single_file, preprocessing_outputs,
+                                  training_file, audio_directory, sample_rate, timestamp_directory,
+                                  number_seconds_to_extract, save_location,
+                                  augmentation_amount_noise, augmentation_probability,
+                                  augmentation_amount_gibbon, seed, augment_directory, augment_image_directory,
+                                  workers=None, manifest_file=None, annotated_only=False, max_rss=None):
+    '''
+    Extract and augment the recordings in training_file in a pool of worker
+    processes, only when something changed (see the helpers'
+    execute_preprocessing_all_files_parallel).
+
+    preprocess_single_file(file_name, ...) processes one recording in a
+    worker and preprocessing_outputs(name, ...) lists the files it writes.
+    helper_name is part of the manifest's parameters, so the binary and
+    social group outputs are never taken for each other.
+
+    The workers are spawned rather than forked, since TensorFlow is already
+    imported in this process.
+    '''
+    if manifest_file is None:
+        manifest_file = augment_image_directory + 'manifest.json'
+    manifest = PreprocessingManifest(manifest_file)
+
+    parameters = {'helper': helper_name,
+                  'sample_rate': sample_rate,
+                  'number_seconds_to_extract': number_seconds_to_extract,
+                  'augmentation_amount_noise': augmentation_amount_noise,
+                  'augmentation_probability': augmentation_probability,
+                  'augmentation_amount_gibbon': augmentation_amount_gibbon,
+                  'seed': seed,
+                  'annotated_only': annotated_only}
+
+    records = {}
+    with open(training_file) as fp:
+        for line in fp:
+            file_name = line.strip()
+            if not file_name:
+                continue
+            name = file_name[:file_name.find('.wav')]
+            inputs = [audio_directory+file_name,
+                      timestamp_directory+'g_'+name+'.data',
+                      timestamp_directory+'n_'+name+'.data']
+            record = manifest.describe(inputs, parameters,
+                                       preprocessing_outputs(name, save_location,
+                                                             augment_directory, augment_image_directory))
+            if manifest.is_up_to_date(file_name, record):
+                print ('Up to date: {}'.format(file_name))
+            else:
+                records[file_name] = record
+
+    print ('{} recordings to process'.format(len(records)))
+
+    if max_rss is not None and len(records) > 0:
+        workers = plan_preprocessing_workers(MemoryGovernor(max_rss), records, audio_directory, sample_rate,
+                                             timestamp_directory, number_seconds_to_extract,
+                                             max(augmentation_amount_noise, augmentation_amount_gibbon),
+                                             workers)
+
+    with concurrent.futures.ProcessPoolExecutor(workers,
+                                                mp_context=multiprocessing.get_context('spawn')) as pool:
+        futures = {}
+        for file_name in records:
+            futures[pool.submit(preprocess_single_file, file_name, audio_directory,
+                                sample_rate, timestamp_directory, number_seconds_to_extract,
+                                save_location, augmentation_amount_noise, augmentation_probability,
+                                augmentation_amount_gibbon, seed, augment_directory,
+                                augment_image_directory, annotated_only)] = file_name
+
+        for future in concurrent.futures.as_completed(futures):
+            file_name = futures[future]
+            future.result()
+            manifest.update(file_name, records[file_name])
+            print ('Done: {}'.format(file_name))
+
+def plan_preprocessing_workers(governor, file_names, audio_directory, sample_rate, timestamp_directory,
+                               number_seconds_to_extract, augmentation_amount, workers=None):
+    '''
+    Number of preprocessing workers for which the largest of file_names
+    fits in every worker within the governor's budget. Every segment is
+    counted with augmentation_amount augmented copies, the larger of the
+    two augmentation amounts, so the same budget holds for both helpers.
+    '''
+    needed = 0
+    for file_name in file_names:
+        name = file_name[:file_name.find('.wav')]
+        gibbon_timestamps = read_and_process_gibbon_timestamps(timestamp_directory, 'g_'+name+'.data',
+                                                               sample_rate, sep=',')
+        non_gibbon_timestamps = read_and_process_nongibbon_timestamps(timestamp_directory, 'n_'+name+'.data',
+                                                                      sample_rate, sep=',')
+        number_segments = (len(gibbon_call_spans(gibbon_timestamps, number_seconds_to_extract, 1, sample_rate))
+                           + len(nongibbon_call_spans(non_gibbon_timestamps, number_seconds_to_extract, 5, sample_rate)))
+        needed = max(needed, governor.preprocessing_memory(audio_directory+file_name, sample_rate,
+                                                           number_segments, number_seconds_to_extract,
+                                                           augmentation_amount))
+    workers = governor.plan_workers(needed + WORKER_PROCESS_BYTES, workers or os.cpu_count(),
+                                    'preprocessing workers')
+    print ('Memory plan: {} workers, about {} MB each'.format(workers, (needed + WORKER_PROCESS_BYTES) // 1024**2))
+    return workers
+
+def open_sharded_sources(training_folder, training_file, selections):
+    '''
+    Array-like views into the memory-mapped shards of the sharded dataset
+    in training_folder, one per (class name, social group) of selections,
+    restricted to the recordings in training_file. Nothing is read up front.
+    '''
+    dataset = ShardedDataset(training_folder)
+    file_names = read_file_names(training_file)
+    sources = [dataset.select(class_name, social_group, file_names)
+               for class_name, social_group in selections]
+
+    print()
+    for (class_name, social_group), source in zip(selections, sources):
+        print ('{} features:'.format(class_name if social_group is None else social_group + ' ' + class_name),
+               source.shape)
+    return sources
+
+def run_experiment(network, train_data, val_data, seed, epochs, steps_per_epoch=None, summary=True):
+    '''
+    Train a new model from network() on the train_data pipeline, keeping the
+    weights with the best validation accuracy in
+    Experiments/weights_<seed>.hdf5, and load them back.
+
+    Returns the model, its history and the training time in seconds.
+    '''
+    # Call backs to save weights
+    filepath= "Experiments/weights_{}.hdf5".format(seed)
+    checkpoint = ModelCheckpoint(filepath, monitor='val_accuracy',verbose=1, save_best_only=True, mode='max')
+
+    model = network()
+    model.compile(loss='categorical_crossentropy', optimizer='adam',metrics=['accuracy'])
+
+    if summary:
+        model.summary()
+
+    start = time.time()
+
+    history = model.fit(train_data, validation_data=val_data,
+              steps_per_epoch=steps_per_epoch,
+              epochs=epochs,
+              verbose=2,
+              callbacks=[checkpoint])
+    end = time.time()
+
+    model.load_weights(filepath)
+    return model, history, end - start
+
+def save_experiment(experiment_id, seed, train_acc, val_acc, seconds, history):
+    '''
+    Save the accuracies and training time of an experiment to
+    Experiments/train_test_performance_<seed>.txt and its history to
+    Experiments/history_<seed>.txt.
+    '''
+    performance = []
+    performance.append(train_acc)
+    performance.append(val_acc)
+    performance.append(seconds)
+
+    np.savetxt('Experiments/train_test_performance_{}.txt'.format(seed), np.asarray(performance), fmt='%f')
+
+    with open('Experiments/history_{}.txt'.format(seed), 'wb') as file_out:
+            pickle.dump(history.history, file_out)
+
+    print('Iteration {} ended...'.format(experiment_id))
+    print('Results saved to:')
+    print('Experiments/train_test_performance_{}.txt'.format(seed))
+    print('-------------------')
+    time.sleep(1)
+
+def model_codec_report(network, weights_file, X, Y, codecs):
+    '''
+    codec_report of network() with weights_file on (X, Y).
+    '''
+    model = network()
+    model.load_weights(weights_file)
+
+    return codec_report(model, X, Y, codecs)
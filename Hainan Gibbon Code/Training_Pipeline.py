@@ -0,0 +1,183 @@
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.utils import to_categorical
+
+from Augmentation import convert_to_image, time_shift_batch
+from Dtype_Policy import policy_dtype
+
+
+def split_positions(sources, test_size=0.20, seed=None):
+    ''' Randomly split the samples of every source into training and
+    validation positions, like train_test_split but without reading them.
+    Returns two lists with a sorted array of positions per source.
+    '''
+    rng = np.random.RandomState(seed)
+    train_positions = []
+    val_positions = []
+    for source in sources:
+        permutation = rng.permutation(len(source))
+        number_val = int(round(len(source) * test_size))
+        val_positions.append(np.sort(permutation[:number_val]))
+        train_positions.append(np.sort(permutation[number_val:]))
+    return train_positions, val_positions
+
+def ordered_labels(sources, classes, number_classes, positions=None):
+    ''' One-hot labels of the samples in the order an unshuffled
+    streaming_dataset yields them.
+    '''
+    if positions is None:
+        positions = [np.arange(len(source)) for source in sources]
+    Y = np.concatenate([np.full(len(position), class_id) for position, class_id in zip(positions, classes)])
+    return to_categorical(Y, number_classes)
+
+def streaming_dataset(sources, classes, number_classes, positions=None, batch_size=8,
+                      shuffle=True, shuffle_buffer=2048, read_size=64, seed=None,
+                      transform=None):
+    '''
+    tf.data pipeline which reads the samples of several sources batch by
+    batch instead of holding them all in memory.
+
+    sources: array-likes of samples, e.g. the ShardedArray views returned by
+             load_training_images(..., lazy=True) or plain numpy arrays
+    classes: class id of the samples of each source
+    positions: samples of each source to use (default all), e.g. from
+               split_positions
+
+    Runs of read_size neighbouring samples are read together in parallel
+    workers, so reads from the shards stay mostly sequential. When shuffle
+    is set the order of the runs is shuffled and the samples are then
+    shuffled again through a buffer of shuffle_buffer samples, which
+    bounds the memory used whatever the size of the dataset.
+
+    transform, if given, is applied to every run of samples after reading,
+    e.g. convert_to_image to stream spectrograms of extracted segments.
+    '''
+    if positions is None:
+        positions = [np.arange(len(source)) for source in sources]
+
+    # Table of runs: source, first and last position in positions[source]
+    runs = np.asarray([(source_id, start, min(start + read_size, len(position)))
+                       for source_id, position in enumerate(positions)
+                       for start in range(0, len(position), read_size)], dtype=np.int64).reshape(-1, 3)
+
+    sample_shape = tuple(sources[0].shape[1:])
+    if transform is not None:
+        sample_shape = transform(np.asarray(sources[0][:1])).shape[1:]
+    dtype = policy_dtype()
+    labels = to_categorical(np.arange(number_classes), number_classes).astype(dtype)
+
+    def read_run(run_id):
+        source_id, start, end = runs[run_id]
+        X = np.asarray(sources[source_id][positions[source_id][start:end]])
+        if transform is not None:
+            X = transform(X)
+        X = X.astype(dtype, copy=False)
+        Y = np.repeat(labels[classes[source_id]][None], end - start, axis=0)
+        return X, Y
+
+    def read_run_tensor(run_id):
+        X, Y = tf.numpy_function(read_run, [run_id], (tf.as_dtype(dtype), tf.as_dtype(dtype)))
+        X.set_shape((None,) + sample_shape)
+        Y.set_shape((None, number_classes))
+        return X, Y
+
+    dataset = tf.data.Dataset.from_tensor_slices(np.arange(len(runs)))
+    if shuffle:
+        dataset = dataset.shuffle(len(runs), seed=seed, reshuffle_each_iteration=True)
+    dataset = dataset.map(read_run_tensor, num_parallel_calls=tf.data.AUTOTUNE,
+                          deterministic=not shuffle)
+    dataset = dataset.unbatch()
+    if shuffle:
+        dataset = dataset.shuffle(shuffle_buffer, seed=seed, reshuffle_each_iteration=True)
+    return dataset.batch(batch_size).prefetch(tf.data.AUTOTUNE)
+
+def take_samples(sources, positions, ids):
+    ''' Samples number ids of the concatenation of sources (restricted to
+    positions), and the source each one comes from.
+    '''
+    ends = np.cumsum([len(position) for position in positions])
+    source_ids = np.searchsorted(ends, ids, side='right')
+    samples = None
+    for source_id in np.unique(source_ids):
+        mask = source_ids == source_id
+        local = ids[mask] - (ends[source_id] - len(positions[source_id]))
+        values = np.asarray(sources[source_id][positions[source_id][local]])
+        if samples is None:
+            samples = np.empty((len(ids),) + values.shape[1:], dtype=values.dtype)
+        samples[mask] = values
+    return samples, source_ids
+
+def augment_batch(gibbon_sources, gibbon_classes, noise_sources, number_classes, 
+                  batch_size, sample_rate, alpha, rng, 
+                  gibbon_positions=None, noise_positions=None, noise_class=0):
+    '''
+    One batch of spectrograms augmented on the fly, half gibbon calls and
+    half background noise like the balanced output of execute_augmentation:
+
+    - gibbon: 0.9 * call + 0.1 * background shifted by 1 to alpha-1 seconds
+    - noise: background shifted by 1 to alpha-1 seconds
+
+    All random choices come from rng.
+    '''
+    if gibbon_positions is None:
+        gibbon_positions = [np.arange(len(source)) for source in gibbon_sources]
+    if noise_positions is None:
+        noise_positions = [np.arange(len(source)) for source in noise_sources]
+
+    number_gibbon = batch_size // 2
+    number_gibbon_samples = sum(len(position) for position in gibbon_positions)
+    number_noise_samples = sum(len(position) for position in noise_positions)
+
+    # Sorted ids keep the reads from the shards in order
+    gibbon_ids = np.sort(rng.integers(number_gibbon_samples, size=number_gibbon))
+    noise_ids = np.sort(rng.integers(number_noise_samples, size=batch_size))
+    shifts = rng.integers(1, alpha, size=batch_size) * sample_rate
+
+    gibbon, source_ids = take_samples(gibbon_sources, gibbon_positions, gibbon_ids)
+    noise, _ = take_samples(noise_sources, noise_positions, noise_ids)
+    noise = rng.permutation(time_shift_batch(noise, shifts))
+
+    audio = noise.astype(policy_dtype())
+    audio[:number_gibbon] = 0.9 * gibbon + 0.1 * noise[:number_gibbon]
+
+    classes = np.full(batch_size, noise_class)
+    classes[:number_gibbon] = np.asarray(gibbon_classes)[source_ids]
+
+    return convert_to_image(audio), to_categorical(classes, number_classes).astype(policy_dtype())
+
+def augmented_dataset(gibbon_sources, gibbon_classes, noise_sources, number_classes,
+                      steps_per_epoch, epochs, batch_size, sample_rate, alpha, seed,
+                      gibbon_positions=None, noise_positions=None):
+    '''
+    tf.data pipeline of batches augmented on the fly by augment_batch, in
+    parallel workers, so augmented segments are never written to disk.
+    
+    Batch number step is built from np.random.default_rng([seed, step]), 
+    so a run is reproducible from the seed whatever the number of workers.
+    Pass steps_per_epoch and epochs to model.fit as well.
+    '''
+    dtype = tf.as_dtype(policy_dtype())
+
+    def make_batch(step):
+        rng = np.random.default_rng([seed, int(step)])
+        return augment_batch(gibbon_sources, gibbon_classes, noise_sources, number_classes,
+                             batch_size, sample_rate, alpha, rng, 
+                             gibbon_positions, noise_positions)
+
+    def make_batch_tensor(step):
+        X, Y = tf.numpy_function(make_batch, [step], (dtype, dtype))
+        X.set_shape((batch_size, 128, 1 + alpha * sample_rate // 256, 1))
+        Y.set_shape((batch_size, number_classes))
+        return X, Y
+
+    dataset = tf.data.Dataset.range(steps_per_epoch * epochs)
+    dataset = dataset.map(make_batch_tensor, num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+def augmented_steps_per_epoch(number_gibbon_samples, augmentation_amount, 
+                              augmentation_probability, batch_size):
+    ''' Batches per epoch giving as many samples as the expected size of
+    the balanced augmented dataset written by execute_augmentation.
+    '''
+    expected = 2 * number_gibbon_samples * augmentation_amount * augmentation_probability
+    return max(1, int(np.ceil(expected / batch_size)))
@@ -0,0 +1,43 @@
+import os
+import sys
+
+import pytest
+
+CODE_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, CODE_DIRECTORY)
+
+WEIGHTS = os.path.join(CODE_DIRECTORY, 'weights_model5_2022.hdf5')
+
+# Settings of the prediction notebook, with the mel range of the synthetic calls
+HELPER_PARAMETERS = (2000, 4800, 2400, 10, 1024, 256, 128, 1000, 2000)
+
+
+@pytest.fixture(scope='session')
+def species_folder(tmp_path_factory):
+    '''
+    A species folder like Raw_Data/Test with one synthetic recording
+    (270 s, one 1-2 kHz call), its call labels and TestingFiles.txt.
+    '''
+    from Benchmark import write_synthetic_recording
+
+    folder = tmp_path_factory.mktemp('species')
+    write_synthetic_recording(str(folder), 'synthetic', 270, 1)
+    with open(os.path.join(folder, 'TestingFiles.txt'), 'w') as fp:
+        fp.write('synthetic\n')
+    return str(folder)
+
+
+@pytest.fixture(scope='session')
+def recording(species_folder):
+    return os.path.join(species_folder, 'synthetic.wav')
+
+
+@pytest.fixture
+def make_helper(species_folder):
+    ''' PredictionHelper for the species folder, ignoring any autotuned configuration. '''
+    from PredictionHelper import PredictionHelper
+
+    def make_helper(**parameters):
+        return PredictionHelper(species_folder, *HELPER_PARAMETERS, WEIGHTS,
+                                autotune_file=None, **parameters)
+    return make_helper
@@ -0,0 +1,23 @@
+import pytest
+
+
+@pytest.mark.parametrize('backend, quantisation, max_abs_difference', [
+    ('tflite', None, 1e-5),
+    ('tflite', 'int8', 0.05),
+    ('onnx', None, 1e-5),
+    ('onnx', 'int8', 0.05),
+])
+def test_exported_backend_agrees_with_keras(make_helper, tmp_path, backend, quantisation, max_abs_difference):
+    if backend == 'onnx':
+        pytest.importorskip('tf2onnx')
+        pytest.importorskip('onnxruntime')
+
+    backend_file = str(tmp_path / 'model.{}'.format(backend))
+    make_helper().export_backend(backend_file, quantisation, calibration_samples=50)
+
+    helper = make_helper(backend=backend, backend_file=backend_file)
+    report = helper.check_backend_agreement(min_argmax_agreement=0.99,
+                                            max_abs_difference=max_abs_difference, verbose=False)
+
+    assert report['total']['segments'] > 0
+    assert report['total']['decision_agreement'] >= 0.99
@@ -0,0 +1,74 @@
+import numpy as np
+import pandas as pd
+
+from Cascade import CascadeModel, group_labels
+
+
+class RecordingModel:
+    ''' Predicts fixed rows, indexed by the value each spectrogram is filled with, and records its inputs. '''
+
+    def __init__(self, rows):
+        self.rows = np.asarray(rows, dtype=np.float32)
+        self.inputs = []
+
+    def predict(self, spectrograms, batch_size=None, verbose=None):
+        indices = spectrograms[:, 0, 0, 0].astype(int)
+        self.inputs.append(indices)
+        return self.rows[indices]
+
+
+def spectrogram_batch(number_windows):
+    return np.arange(number_windows, dtype=np.float32)[:, None, None, None] * np.ones((1, 4, 6, 1), np.float32)
+
+
+def test_group_model_only_sees_flagged_windows():
+    gibbon = np.array([0.1, 0.9, 0.5, 0.2, 0.7])
+    binary = RecordingModel(np.stack([1 - gibbon, gibbon], axis=1))
+    group_rows = np.random.default_rng(0).dirichlet(np.ones(4), 5)
+    group = RecordingModel(group_rows)
+
+    cascade = CascadeModel(binary, group, threshold=0.5)
+    predictions = cascade.predict(spectrogram_batch(5))
+
+    # The detector scores every window, the classifier only those at or above the threshold
+    np.testing.assert_array_equal(binary.inputs[0], np.arange(5))
+    np.testing.assert_array_equal(group.inputs[0], [1, 2, 4])
+    np.testing.assert_allclose(predictions[[1, 2, 4]], group_rows[[1, 2, 4]])
+    np.testing.assert_array_equal(predictions[[0, 3]], [[1, 0, 0, 0], [1, 0, 0, 0]])
+
+    stats = cascade.stats()
+    assert stats['windows'] == 5
+    assert stats['stage_two_windows'] == 3
+    assert stats['stage_two_fraction'] == 0.6
+
+
+def test_nothing_flagged_skips_the_group_model():
+    binary = RecordingModel([[0.9, 0.1]] * 3)
+    group = RecordingModel(np.eye(4)[:3])
+    predictions = CascadeModel(binary, group).predict(spectrogram_batch(3))
+    assert group.inputs == []
+    assert (predictions.argmax(axis=1) == 0).all()
+
+
+def test_group_labels_per_second():
+    # 20 windows of 10 s, 1 s apart: 29 seconds. Windows 5 to 9 are 'C'.
+    predictions = np.tile([0.7, 0.1, 0.1, 0.1], (20, 1))
+    predictions[5:10] = [0.05, 0.05, 0.85, 0.05]
+    labels = group_labels(predictions, hop_seconds=1, segment_duration=10)
+
+    assert [second for second, _ in labels] == list(range(29))
+    # Second 10 is covered by windows 1 to 10, of which 5 are 'C'
+    assert dict(labels)[10] == 'C'
+    assert dict(labels)[0] == 'no-gibbon'
+    assert dict(labels)[28] == 'no-gibbon'
+
+
+def test_cascade_saves_group_labels(make_helper, tmp_path):
+    helper = make_helper(binary_weights_name='binary.weights.h5')
+    predictions = np.tile([0.1, 0.8, 0.05, 0.05], (3, 1))
+    helper.save_predictions(str(tmp_path / 'file'), predictions)
+
+    labels = pd.read_csv(tmp_path / 'file_groups.csv')
+    assert list(labels.columns) == ['Second', 'Group']
+    assert len(labels) == 12
+    assert (labels['Group'] == 'B').all()
@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+from Decimation import butterworth_chain, check_frequency_response, decimate
+
+# Prediction settings: low pass at 2000 Hz, downsample to 4800 Hz
+CUTOFF = 2000
+NEW_SAMPLE_RATE = 4800
+NYQUIST_RATE = 2400
+
+
+@pytest.mark.parametrize('original_sr', [16000, 44100, 48000])
+def test_frequency_response_against_butterworth_chain(original_sr):
+    report = check_frequency_response(original_sr, NEW_SAMPLE_RATE, CUTOFF, NYQUIST_RATE,
+                                      verbose=False)
+
+    # Pass band: flat, and within 0.5 dB of the Butterworth + kaiser_fast chain
+    assert np.abs(report['pass_band_fused']).max() <= 0.1
+    assert np.abs(report['pass_band_fused'] - report['pass_band_chain']).max() <= 0.5
+
+    # Stop band (above the new Nyquist frequency): at least 60 dB down, and
+    # no more aliasing than the chain
+    assert report['stop_band_fused'].max() <= -60
+    assert report['stop_band_fused'].max() <= report['stop_band_chain'].max()
+
+
+def test_same_length_as_chain():
+    audio = np.random.default_rng(0).standard_normal(16000 * 5 + 7).astype(np.float32)
+    fused = decimate(audio, 16000, NEW_SAMPLE_RATE, CUTOFF)
+    chain = butterworth_chain(audio, 16000, NEW_SAMPLE_RATE, CUTOFF, NYQUIST_RATE)
+    assert len(fused) == len(chain)
+    assert fused.dtype == np.float32
@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+from Dtype_Policy import (DTYPE_VARIABLE, STRICT_VARIABLE, check_dtype_policy, enforce_dtype,
+                          is_strict, set_dtype, set_strict)
+
+
+@pytest.fixture(autouse=True)
+def restore_policy(monkeypatch):
+    # The policy lives in environment variables, restored after each test
+    monkeypatch.setenv(DTYPE_VARIABLE, 'float32')
+    monkeypatch.setenv(STRICT_VARIABLE, '0')
+
+
+@pytest.mark.parametrize('dtype', ['float32', 'float64'])
+def test_no_stage_upcasts(dtype, capsys):
+    set_dtype(dtype)
+    check_dtype_policy()
+    assert 'No stage upcasts from {}.'.format(dtype) in capsys.readouterr().out
+    # Strict mode is only on during the check
+    assert not is_strict()
+
+
+def test_strict_mode_catches_an_upcast():
+    set_strict(True)
+    with pytest.raises(TypeError, match='upcasting_stage produced float64 instead of float32'):
+        enforce_dtype(np.zeros(4, dtype=np.float64), 'upcasting_stage')
+
+
+def test_lenient_mode_converts():
+    assert enforce_dtype(np.zeros(4, dtype=np.float64), 'stage').dtype == np.float32
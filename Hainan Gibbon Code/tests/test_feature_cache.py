@@ -0,0 +1,52 @@
+import gc
+import os
+import threading
+
+import numpy as np
+
+from Feature_Cache import FeatureCache
+
+
+def test_evict_keeps_entries_in_use(tmp_path):
+    array = np.arange(1000, dtype=np.float32)
+    cache = FeatureCache(str(tmp_path), max_size=int(1.5 * array.nbytes))
+    cache.put('first', array)
+    in_use = cache.get('first')[10:20]
+
+    # Over max_size, but the least recently used entry is still mapped
+    cache.put('second', array + 1)
+    assert os.path.exists(cache.entry_path('first'))
+    np.testing.assert_array_equal(in_use, array[10:20])
+
+    del in_use
+    gc.collect()
+    cache.put('third', array + 2)
+    assert not os.path.exists(cache.entry_path('first'))
+    assert cache.get('third') is not None
+
+
+def test_file_hash_from_many_threads(tmp_path):
+    file_names = []
+    for index in range(4):
+        file_name = str(tmp_path / 'audio_{}.bin'.format(index))
+        with open(file_name, 'wb') as fp:
+            fp.write(os.urandom(100000))
+        file_names.append(file_name)
+
+    cache = FeatureCache(str(tmp_path / 'cache'))
+    expected = {file_name: FeatureCache(str(tmp_path / 'reference')).file_hash(file_name)
+                for file_name in file_names}
+    results = []
+
+    def hash_files():
+        for file_name in file_names * 5:
+            results.append(cache.file_hash(file_name) == expected[file_name])
+
+    threads = [threading.Thread(target=hash_files) for thread in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(results) == 8 * 20 and all(results)
+    assert len(FeatureCache(str(tmp_path / 'cache')).hash_index) == 4
@@ -0,0 +1,26 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from Feature_Cache import FeatureCache
+
+
+def test_pipelined_prediction_with_feature_cache(make_helper, recording, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    reference_helper = make_helper()
+    reference = reference_helper.load_model().predict(reference_helper.load_spectrograms(recording), verbose=0)
+
+    cache = FeatureCache(str(tmp_path / 'cache'))
+    helper = make_helper(feature_cache=cache)
+
+    # The first run fills the cache in spawned feature workers, the second
+    # reads it back
+    for run in range(2):
+        helper.predict_all_test_files_pipelined(False, decode_workers=1, feature_workers=1)
+        predictions = pd.read_csv('synthetic.csv', index_col=0).values
+        np.testing.assert_allclose(predictions, reference, atol=1e-5)
+
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+    assert os.path.exists('Test Files.csv')
@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+
+from Band_Prefilter import BandPrefilter
+
+
+def calls_everywhere(sample_rate=4800, duration=300, seed=0):
+    ''' Noise with a 1-2 kHz sweep of 7 s every 9 s: every 10 s window overlaps a call. '''
+    rng = np.random.default_rng(seed)
+    audio = 0.05 * rng.standard_normal(duration * sample_rate)
+    t = np.arange(7 * sample_rate) / sample_rate
+    sweep = np.sin(2 * np.pi * np.cumsum(1000 + 1000 * t / 7) / sample_rate)
+    for start in range(5, duration - 7, 9):
+        audio[start * sample_rate:(start + 7) * sample_rate] += 0.2 * sweep
+    return audio.astype(np.float32)
+
+
+def test_call_dense_recording_is_not_skipped():
+    prefilter = BandPrefilter(1000, 2000)
+    scores = prefilter.window_scores(calls_everywhere(), 4800, 10, 1, 291)
+    assert prefilter.keep(scores).mean() > 0.95
+
+
+def test_background_is_skipped():
+    audio = calls_everywhere()
+    # The same noise with calls only in the first minute
+    audio[60 * 4800:] = 0.05 * np.random.default_rng(1).standard_normal(240 * 4800)
+    prefilter = BandPrefilter(1000, 2000)
+    keep = prefilter.keep(prefilter.window_scores(audio, 4800, 10, 1, 291))
+    assert keep[:50].all()
+    assert not keep[70:].any()
+
+
+def test_cannot_be_combined_with_blocks(make_helper):
+    with pytest.raises(ValueError):
+        make_helper(prefilter=BandPrefilter(1000, 2000), block_duration=60)
+    with pytest.raises(ValueError):
+        make_helper(shared_convolution=True, block_duration=60)
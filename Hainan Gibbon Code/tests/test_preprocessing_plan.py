@@ -0,0 +1,27 @@
+from Memory_Governor import MemoryGovernor, WORKER_PROCESS_BYTES
+from Train_Helper_Common import plan_preprocessing_workers
+
+
+class RecordingGovernor(MemoryGovernor):
+    ''' MemoryGovernor remembering the bytes per worker it was asked to plan. '''
+
+    def plan_workers(self, bytes_per_worker, requested, what='workers'):
+        self.bytes_per_worker = bytes_per_worker
+        return super().plan_workers(bytes_per_worker, requested, what)
+
+
+def plan(species_folder, augmentation_amount):
+    governor = RecordingGovernor('64G')
+    workers = plan_preprocessing_workers(governor, ['synthetic.wav'], species_folder + '/', 4800,
+                                         species_folder + '/', 10, augmentation_amount, workers=2)
+    return governor.bytes_per_worker - WORKER_PROCESS_BYTES, workers
+
+
+def test_plan_counts_the_augmented_copies(species_folder):
+    unaugmented, _ = plan(species_folder, 0)
+    augmented, workers = plan(species_folder, 10)
+
+    # One call and one background stretch, each 10 s segment with 10 augmented copies
+    segment = 10 * 4800 * 4 + 128 * (1 + 10 * 4800 // 256) * 4
+    assert augmented - unaugmented >= 2 * 10 * segment
+    assert workers == 2
@@ -0,0 +1,41 @@
+import io
+
+import numpy as np
+import pytest
+import soundfile as sf
+
+from Realtime_Detection import AudioStream, detect_stream
+
+
+@pytest.fixture(scope='module')
+def excerpt(recording, tmp_path_factory):
+    ''' The first 60.5 s of the synthetic recording, since the model is called once per window. '''
+    audio, sample_rate = sf.read(recording, frames=int(60.5 * 16000), dtype='int16')
+    file_name = str(tmp_path_factory.mktemp('realtime') / 'excerpt.wav')
+    sf.write(file_name, audio, sample_rate, 'PCM_16')
+    return file_name
+
+
+@pytest.mark.parametrize('resampler, context_duration', [('polyphase', 1), ('kaiser_fast', 2)])
+def test_realtime_matches_offline(make_helper, excerpt, resampler, context_duration):
+    helper = make_helper(resampler=resampler)
+    model = helper.load_model()
+    reference = model.predict(helper.convert_file_to_image(*helper.read_and_downsample(excerpt)), verbose=0)
+
+    # Chunks which do not line up with the seconds the detector downsamples
+    stream = AudioStream(excerpt)
+    output = io.StringIO()
+    try:
+        predictions, report = detect_stream(helper, stream, output, model, context_duration,
+                                            chunk_duration=0.37)
+    finally:
+        stream.close()
+
+    assert predictions.shape == reference.shape
+    np.testing.assert_allclose(predictions, reference, atol=1e-5)
+    assert report['windows'] == len(reference)
+
+    lines = output.getvalue().splitlines()
+    assert lines[0] == 'start,end,p0,p1,p2,p3,latency'
+    assert len(lines) == len(reference) + 1
+    assert lines[-1].startswith('{:g},{:g},'.format(len(reference) - 1, len(reference) - 1 + 10))
@@ -0,0 +1,28 @@
+import numpy as np
+
+from Shared_Convolution import SharedConvolutionModel
+
+
+def test_predict_recording_matches_window_by_window(make_helper, recording):
+    helper = make_helper()
+    model = helper.load_model()
+    filtered, sample_rate = helper.read_and_downsample(recording)
+    end_index = int(len(filtered) / sample_rate)
+
+    spectrograms = helper.convert_recording_to_image(filtered, helper.segment_duration, sample_rate,
+                                                     0, end_index, helper.hop_seconds)
+    reference = model.predict(helper.add_keras_dim(spectrograms), verbose=0)
+
+    # Chunks smaller than the recording, so chunk boundaries are covered
+    predictions = SharedConvolutionModel(model).predict_recording(helper, filtered, sample_rate,
+                                                                  chunk_size=100)
+
+    assert predictions.shape == reference.shape
+    np.testing.assert_allclose(predictions, reference, atol=1e-5)
+    assert (predictions.argmax(axis=1) == reference.argmax(axis=1)).all()
+
+
+def test_flops_of_shared_convolution_are_lower(make_helper):
+    model = make_helper().load_model()
+    flops = SharedConvolutionModel(model).flops(number_windows=1000, hop_columns=19)
+    assert flops['ratio'] < 1
@@ -0,0 +1,22 @@
+import numpy as np
+import pytest
+
+from Train_Helper_Binary import execute_audio_extraction
+
+
+@pytest.mark.parametrize('number_seconds_to_extract', [9, 10])
+def test_span_decoding_matches_full_decode(species_folder, tmp_path, number_seconds_to_extract):
+    folder = species_folder + '/'
+    extracted = {}
+    for annotated_only in (False, True):
+        save_location = tmp_path / str(annotated_only)
+        save_location.mkdir()
+        extracted[annotated_only] = execute_audio_extraction(folder, 'synthetic.wav', 4800, folder,
+                                                             number_seconds_to_extract, str(save_location) + '/',
+                                                             annotated_only=annotated_only)
+
+    for full, spans in zip(extracted[False], extracted[True]):
+        full, spans = np.asarray(full), np.asarray(spans)
+        assert len(full) > 0
+        assert spans.shape == full.shape
+        np.testing.assert_allclose(spans, full, atol=1e-5)
@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+
+
+@pytest.mark.parametrize('resampler', ['polyphase', 'kaiser_fast'])
+def test_streamed_audio_matches_whole_file(make_helper, recording, resampler):
+    helper = make_helper(resampler=resampler)
+    filtered, _ = helper.read_and_downsample(recording)
+
+    # 270 s in blocks of 60 s, so there is a short last block
+    streamed = np.concatenate(list(helper.stream_audio_file(recording, block_duration=60)))
+
+    assert streamed.shape == filtered.shape
+    np.testing.assert_allclose(streamed, filtered, atol=1e-5)
+
+
+def test_streamed_predictions_match_whole_file(make_helper, recording):
+    helper = make_helper()
+    model = helper.load_model()
+    reference = model.predict(helper.convert_file_to_image(*helper.read_and_downsample(recording)), verbose=0)
+
+    predictions = helper.predict_file_streaming(model, recording, block_duration=60)
+
+    assert predictions.shape == reference.shape
+    np.testing.assert_allclose(predictions, reference, atol=1e-5)
+    assert (predictions.argmax(axis=1) == reference.argmax(axis=1)).all()
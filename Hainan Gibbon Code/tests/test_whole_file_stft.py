@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+
+
+@pytest.mark.parametrize('hop_seconds', [1, 0.5])
+def test_whole_file_stft_matches_window_by_window(make_helper, recording, hop_seconds):
+    helper = make_helper(hop_seconds=hop_seconds)
+    filtered, sample_rate = helper.read_and_downsample(recording)
+    end_index = int(len(filtered) / sample_rate)
+
+    reference = helper.convert_all_to_image(helper.create_X_strided(filtered, helper.segment_duration,
+                                            sample_rate, 0, end_index, hop_seconds))
+    # Chunks smaller than the recording, so chunk boundaries are covered
+    spectrograms = helper.convert_recording_to_image(filtered, helper.segment_duration, sample_rate,
+                                                     0, end_index, hop_seconds, chunk_size=100)
+
+    assert spectrograms.shape == reference.shape
+    np.testing.assert_allclose(spectrograms, reference, atol=1e-4)
+
+
+def test_short_windows_fall_back_to_window_by_window(make_helper):
+    # Windows shorter than two FFTs cannot use the grid
+    helper = make_helper()
+    audio = np.random.default_rng(0).standard_normal(4800).astype(np.float32)
+    spectrograms = helper.convert_recording_to_image(audio, 0.2, 4800, 0, 1, 0.2)
+    reference = helper.convert_all_to_image(helper.create_X_strided(audio, 0.2, 4800, 0, 1, 0.2))
+    np.testing.assert_allclose(spectrograms, reference, atol=1e-6)